@@ -0,0 +1,21 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# FAISS検索や同期DBアクセスなど、イベントループを止めてしまう処理を逃がすためのスレッドプール
+# 上限を設けておくことで、混雑時にスレッドが際限なく増えるのを防ぐ
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", "8"))
+blocking_executor = ThreadPoolExecutor(
+    max_workers=BLOCKING_POOL_SIZE,
+    thread_name_prefix="blocking",
+)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """同期関数を専用スレッドプールで実行し、結果を待つ"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, partial(func, *args, **kwargs))
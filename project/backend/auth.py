@@ -0,0 +1,118 @@
+"""
+ログインセッション（Redis）の保存・取得と、エンドポイントに渡すログインユーザーの依存性。
+
+ほぼすべてのリクエストがセッションを引くので、
+- セッションはリクエストごとに1回だけ引く（current_user は FastAPI の依存性キャッシュと request.state で使い回す）
+- 引いた結果はプロセス内に SESSION_CACHE_TTL 秒だけ覚えておき、続くリクエストでは Redis に問い合わせない
+- ログアウト時はプロセス内の記憶も消す（他のワーカーの記憶は最大 SESSION_CACHE_TTL 秒残る）
+"""
+import os
+from typing import Optional
+from dotenv import load_dotenv
+from fastapi import Depends, HTTPException, Request
+from redis.exceptions import RedisError
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import LocalTTLCache
+from crud import get_calendar_async
+from database import get_db
+from models import user_calendar
+from redis_config import redis_async_client
+from schemas import CurrentUser
+
+load_dotenv()
+
+# セッションIDを入れるクッキーの名前
+SESSION_COOKIE = "session_id"
+# セッションの有効期限（秒）。クッキーの max_age と同じ1日
+SESSION_TTL = 86400
+# プロセス内でセッションを覚えておく秒数（0で無効）
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "5"))
+# プロセス内で覚えておくセッションの件数
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+
+# セッションID → ユーザーID（存在しないセッションは 0 として覚え、続けて Redis を引かないようにする）
+session_cache = LocalTTLCache(SESSION_CACHE_SIZE if SESSION_CACHE_TTL > 0 else 0, SESSION_CACHE_TTL)
+
+
+async def store_session(session_id: str, user_id: int):
+    """セッションをRedisに保存する（有効期限は SESSION_TTL）"""
+    await redis_async_client.setex(session_id, SESSION_TTL, str(user_id))
+    session_cache.set(session_id, user_id)
+
+
+async def get_session(session_id: Optional[str]) -> Optional[int]:
+    """セッションIDからユーザーIDを返す。プロセス内の記憶 → Redis の順に引く。見つからなければ None"""
+    if not session_id:
+        return None
+
+    user_id = session_cache.get(session_id)
+    if user_id is None:
+        try:
+            value = await redis_async_client.get(session_id)
+        except RedisError as e:
+            # Redis に繋がらないときは未ログインとして扱う（覚えておかない）
+            print(f"セッションの取得に失敗しました: {e}")
+            return None
+        user_id = int(value) if value else 0
+        session_cache.set(session_id, user_id)
+    return user_id or None
+
+
+async def delete_session(session_id: str):
+    """セッションをRedisとプロセス内の記憶から消す"""
+    session_cache.delete(session_id)
+    await redis_async_client.delete(session_id)
+
+
+async def current_user(request: Request) -> CurrentUser:
+    """
+    リクエストのログインユーザー。未ログインなら id=0 の CurrentUser を返す。
+    同じリクエストの中で何度呼ばれてもセッションを引くのは1回だけ。
+    """
+    user = getattr(request.state, "current_user", None)
+    if user is None:
+        session_id = request.cookies.get(SESSION_COOKIE)
+        user_id = await get_session(session_id)
+        user = CurrentUser(id=user_id or 0, session_id=session_id if user_id else None)
+        request.state.current_user = user
+    return user
+
+
+async def require_user(user: CurrentUser = Depends(current_user)) -> CurrentUser:
+    """ログインが必要なエンドポイント用。未ログインなら 401"""
+    if not user.is_authenticated:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return user
+
+
+async def own_calendar_id(calendar_id: int, user: CurrentUser, db: AsyncSession) -> int:
+    """
+    カレンダーがログインユーザーのものなら calendar_id を、そうでなければ 0 を返す
+    （検索結果の is_registered を他人のカレンダーで判定しないため）。カレンダーがなければ 404
+    """
+    calendar = await get_calendar_async(calendar_id, db)
+    return calendar_id if calendar.user_id == user.id else 0
+
+
+def own_calendar(calendar_id: int, user: CurrentUser, db: Session) -> user_calendar:
+    """
+    calendar_id がログインユーザーのカレンダーなら、そのカレンダー（db の ORM のオブジェクト。そのまま更新・削除に使える）を返す。
+    カレンダーがなければ 404、他人のカレンダー（未ログインを含む）なら 403
+    """
+    calendar = db.query(user_calendar).filter(user_calendar.id == calendar_id).first()
+    if not calendar:
+        raise HTTPException(status_code=404, detail="Calendar not found")
+    if calendar.user_id != user.id:
+        raise HTTPException(status_code=403, detail="You are not the owner of this calendar")
+    return calendar
+
+
+def require_own_calendar(
+    calendar_id: int, user: CurrentUser = Depends(current_user), db: Session = Depends(get_db)
+) -> user_calendar:
+    """
+    カレンダーを変更するエンドポイント用の依存性（own_calendar を参照）。
+    get_db はリクエスト内で使い回されるので、返すカレンダーはエンドポイントの db のものになる
+    """
+    return own_calendar(calendar_id, user, db)
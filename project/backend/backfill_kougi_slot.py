@@ -0,0 +1,71 @@
+import argparse
+import time
+from db_config import create_db_connection  # DB接続をインポート
+from kougi_slots import CREATE_KOUGI_SLOT_SQL, INSERT_KOUGI_SLOT_SQL, slot_rows
+from course_catalog import bump_catalog_version
+
+# 1回のSELECT/INSERTで扱う講義の件数
+BATCH_SIZE = 1000
+
+
+def backfill(connection, batch_size, rebuild=False):
+    """
+    aoyama_kougi.時限 を分解して kougi_slot を埋める。講義ID順に batch_size 件ずつ処理する。
+    rebuild=False の場合は、まだ kougi_slot に行がない講義だけを対象にする。
+    """
+    processed = 0
+    inserted = 0
+    last_id = 0
+    started = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute(CREATE_KOUGI_SLOT_SQL)
+        if rebuild:
+            cursor.execute("DELETE FROM kougi_slot")
+            connection.commit()
+
+        while True:
+            cursor.execute(
+                """
+                SELECT k.id, k.時限 FROM aoyama_kougi k
+                WHERE k.id > %s
+                  AND NOT EXISTS (SELECT 1 FROM kougi_slot s WHERE s.kougi_id = k.id)
+                ORDER BY k.id
+                LIMIT %s
+                """,
+                (last_id, batch_size),
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            values = [value for row in rows for value in slot_rows(row['id'], row['時限'])]
+            if values:
+                cursor.executemany(INSERT_KOUGI_SLOT_SQL, values)
+            connection.commit()
+
+            processed += len(rows)
+            inserted += len(values)
+            last_id = rows[-1]['id']
+            print(f"  {processed:,} 件の講義を分解しました（{inserted:,} コマ、{time.perf_counter() - started:.1f}秒）")
+    return processed, inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="aoyama_kougi.時限 を分解して kougi_slot を作成する")
+    parser.add_argument("--rebuild", action="store_true", help="kougi_slot を空にしてから全講義を入れ直す")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    connection = create_db_connection()
+    try:
+        processed, inserted = backfill(connection, args.batch_size, rebuild=args.rebuild)
+    finally:
+        connection.close()
+    print(f"✅ {processed:,} 件の講義から {inserted:,} コマを kougi_slot に登録しました。")
+    if processed:
+        # 各APIプロセスの講義カタログを読み直させる
+        bump_catalog_version()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+import os
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+import redis
+from database import SessionLocal
+from models import aoyama_kougi, kougi_slot, aoyama_openai_emb
+from kougi_slots import parse_jigen, split_day_period, expand_semesters
+from redis_config import redis_sync_client
+from text_index import TextIndex, TEXT_FIELDS
+
+# 学部・学期の「指定なし」
+NO_PREFERENCE = ["指定なし"]
+
+# 講義データの版（スクレイピングや kougi_slot の更新のたびに INCR する）
+CATALOG_VERSION_KEY = "course_catalog:version"
+# 版を確認する間隔（秒）。版が変わっていればカタログを読み直す
+CATALOG_CHECK_INTERVAL = float(os.getenv("CATALOG_CHECK_INTERVAL", "30"))
+
+
+class CourseCatalog:
+    """
+    aoyama_kougi の絞り込み用の列（開講・科目・教員・メッセージと kougi_slot のコマ、講義要約）をメモリに持ち、
+    検索条件に一致する講義IDのビットマップを返すクラス。
+
+    ビットマップは講義IDを添字とする bool 配列（長さ max(id)+1）で、
+    複数の条件は OR / AND のビット演算で組み合わせる。
+    学部は完全一致、キャンパス・曜日時限・学期は kougi_slot の値との一致、
+    科目・教員は text_index による部分一致（全角・半角、カタカナ・ひらがなの違いは無視）。
+    """
+
+    def __init__(self, ids, departments, slots, texts=None, version=None):
+        """
+        slots は (講義ID, slot) の組の並び。slot は kougi_slots.parse_jigen が返す dict と同じ形。
+        texts は全文検索する列 {"科目": [...], "教員": [...], "メッセージ": [...], "audi_text": [...]}（ids と同じ順）
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        self.size = int(ids.max()) + 1 if ids.size else 1
+        self.version = version
+
+        self.present = np.zeros(self.size, dtype=bool)
+        self.present[ids] = True
+
+        # 学部は文字列ではなく値の番号（コード）の配列で持つ
+        values, codes = np.unique(np.asarray([d or "" for d in departments], dtype=object), return_inverse=True)
+        self.department_codes = np.full(self.size, -1, dtype=np.int16)
+        self.department_codes[ids] = codes
+        self.department_bitmaps = {
+            value: self.department_codes == code for code, value in enumerate(values)
+        }
+
+        # コマの値ごとに講義IDを集めてビットマップにする（値の種類は多くないので全部作っておく）
+        groups = {name: defaultdict(list) for name in ("campus", "day", "period", "day_period", "label", "semester")}
+        for kougi_id, slot in slots:
+            # aoyama_kougi から消えた講義のコマは無視する
+            if kougi_id >= self.size or not self.present[kougi_id]:
+                continue
+            for name in ("campus", "day", "period", "label", "semester"):
+                if slot[name] is not None:
+                    groups[name][slot[name]].append(kougi_id)
+            if slot["day"] is not None:
+                groups["day_period"][(slot["day"], slot["period"])].append(kougi_id)
+        self.slot_bitmaps = {
+            name: {value: self._bitmap(id_list) for value, id_list in values.items()}
+            for name, values in groups.items()
+        }
+
+        # 科目・教員・メッセージの全文検索用の索引
+        self.text_index = TextIndex(ids, texts or {field: [""] * len(ids) for field in TEXT_FIELDS})
+
+    @classmethod
+    def load(cls, db, version=None):
+        rows = db.query(
+            aoyama_kougi.id, aoyama_kougi.開講, aoyama_kougi.時限,
+            aoyama_kougi.科目, aoyama_kougi.教員, aoyama_kougi.メッセージ,
+        ).all()
+        slot_rows = db.query(
+            kougi_slot.kougi_id, kougi_slot.label, kougi_slot.day, kougi_slot.period,
+            kougi_slot.campus, kougi_slot.semester,
+        ).all()
+        slots = [(row.kougi_id, row._asdict()) for row in slot_rows]
+        # 講義要約（ハイブリッド検索の語句一致に使う）
+        summaries = dict(db.query(aoyama_openai_emb.aoyama_kougi_id, aoyama_openai_emb.audi_text).all())
+
+        # kougi_slot が未作成の講義（backfill 前など）は、その場で 時限 を分解する
+        with_slots = {kougi_id for kougi_id, _ in slots}
+        for row in rows:
+            if row.id not in with_slots:
+                slots.extend((row.id, slot) for slot in parse_jigen(row.時限))
+
+        return cls(
+            [row.id for row in rows],
+            [row.開講 for row in rows],
+            slots,
+            texts={
+                "科目": [row.科目 for row in rows],
+                "教員": [row.教員 for row in rows],
+                "メッセージ": [row.メッセージ for row in rows],
+                "audi_text": [summaries.get(row.id) for row in rows],
+            },
+            version=version,
+        )
+
+    def __len__(self):
+        return int(self.present.sum())
+
+    def _bitmap(self, id_list):
+        bitmap = np.zeros(self.size, dtype=bool)
+        bitmap[np.asarray(id_list, dtype=np.int64)] = True
+        return bitmap
+
+    def _slot_bitmap(self, name, value):
+        bitmap = self.slot_bitmaps[name].get(value)
+        if bitmap is None:
+            return np.zeros(self.size, dtype=bool)
+        return bitmap
+
+    def _day_period_bitmap(self, combo):
+        day_period = split_day_period(combo)
+        if day_period is None:
+            # "不定" など曜日・時限でない指定はコマの表記そのもので引く
+            return self._slot_bitmap("label", combo)
+        day, period = day_period
+        if day is None:
+            return self._slot_bitmap("period", period)
+        if period is None:
+            return self._slot_bitmap("day", day)
+        return self._slot_bitmap("day_period", (day, period))
+
+    def _department_bitmap(self, value):
+        bitmap = self.department_bitmaps.get(value)
+        if bitmap is None:
+            return np.zeros(self.size, dtype=bool)
+        return bitmap
+
+    @staticmethod
+    def _any(bitmaps):
+        result = bitmaps[0].copy()
+        for bitmap in bitmaps[1:]:
+            result |= bitmap
+        return result
+
+    def facet_mask(self, request):
+        """
+        SearchRequest のファセット条件に一致する講義IDのビットマップを返す。
+        ファセット条件が1つもなければ None（全件）を返す。
+        """
+        mask = None
+
+        def narrow(bitmap):
+            nonlocal mask
+            mask = bitmap if mask is None else mask & bitmap
+
+        # キャンパス条件
+        if request.campuses:
+            narrow(self._any([self._slot_bitmap("campus", c) for c in request.campuses]))
+
+        # 曜日と時限の条件
+        if request.dayPeriodCombinations:
+            narrow(self._any([self._day_period_bitmap(c) for c in request.dayPeriodCombinations]))
+
+        # 学部条件
+        if request.departments and request.departments != NO_PREFERENCE:
+            narrow(self._any([self._department_bitmap(d) for d in request.departments]))
+
+        # 学期条件（"前期" は "前期集中" なども含める）
+        if request.semesters and request.semesters != NO_PREFERENCE:
+            narrow(self._any([self._slot_bitmap("semester", s) for s in expand_semesters(request.semesters)]))
+
+        return mask
+
+    def filter_mask(self, request):
+        """
+        SearchRequest の全条件（ファセット＋講義名・教員名の部分一致）に一致する講義IDのビットマップを返す。
+        条件が1つもなければ None（全件）を返す。
+        """
+        mask = self.facet_mask(request)
+
+        # 講義名条件
+        if request.courseName:
+            bitmap = self.mask_from_ids(self.text_index.contains("科目", request.courseName))
+            mask = bitmap if mask is None else mask & bitmap
+
+        # 教員名条件
+        if request.instructorName:
+            bitmap = self.mask_from_ids(self.text_index.contains("教員", request.instructorName))
+            mask = bitmap if mask is None else mask & bitmap
+
+        return mask
+
+    def rank_ids(self, id_list, request):
+        """講義名・教員名の指定があれば、id_list をそれとの関連度の高い順に並べ替える"""
+        queries = {"科目": request.courseName, "教員": request.instructorName}
+        return self.text_index.rank(id_list, {field: query for field, query in queries.items() if query})
+
+    def ids_from_mask(self, mask):
+        """ビットマップを講義IDのリスト（昇順）に変換する。None は全件"""
+        if mask is None:
+            mask = self.present
+        return np.flatnonzero(mask).tolist()
+
+    def mask_from_ids(self, id_list):
+        """講義IDのリストをビットマップに変換する"""
+        return ids_to_mask(id_list, self.size)
+
+
+def ids_to_mask(id_list, size=1):
+    """講義IDのリストを、講義IDを添字とする bool 配列に変換する"""
+    ids = np.asarray(id_list, dtype=np.int64)
+    if ids.size:
+        size = max(size, int(ids.max()) + 1)
+    mask = np.zeros(size, dtype=bool)
+    mask[ids] = True
+    return mask
+
+
+def catalog_version():
+    """Redis に置いた講義データの版を返す（Redis に繋がらなければ None）"""
+    try:
+        return int(redis_sync_client.get(CATALOG_VERSION_KEY) or 0)
+    except redis.RedisError as e:
+        print(f"講義カタログの版の確認に失敗しました: {e}")
+        return None
+
+
+def bump_catalog_version():
+    """講義データを更新したら呼ぶ。各プロセスのカタログが次の確認時に読み直される"""
+    return redis_sync_client.incr(CATALOG_VERSION_KEY)
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+_checked_at = 0.0
+
+
+def load_course_catalog(db=None, version=None):
+    """DBからカタログを読み込んで差し替える。読み込み中も古いカタログで検索できる"""
+    global _catalog, _checked_at
+    if version is None:
+        version = catalog_version()
+    session = db or SessionLocal()
+    try:
+        catalog = CourseCatalog.load(session, version=version)
+    finally:
+        if db is None:
+            session.close()
+    _catalog = catalog
+    _checked_at = time.monotonic()
+    return catalog
+
+
+def get_course_catalog(db=None, wait=True):
+    """
+    読み込み済みのカタログを返す。未読み込みならDBから読み込む（wait=False なら読み込まずに None を返す）。
+    CATALOG_CHECK_INTERVAL 秒ごとに Redis の版を確認し、変わっていれば読み直す。
+    """
+    global _checked_at
+    catalog = _catalog
+    if catalog is None:
+        if not wait:
+            return None
+        with _catalog_lock:
+            if _catalog is None:
+                load_course_catalog(db)
+        return _catalog
+
+    if time.monotonic() - _checked_at >= CATALOG_CHECK_INTERVAL and _catalog_lock.acquire(blocking=False):
+        # 読み直しは1スレッドだけが行い、他のリクエストは古いカタログで続ける
+        try:
+            _checked_at = time.monotonic()
+            version = catalog_version()
+            if version is not None and version != catalog.version:
+                print(f"講義カタログを読み直します（版 {catalog.version} → {version}）。")
+                load_course_catalog(db, version)
+        finally:
+            _catalog_lock.release()
+    return _catalog
+
+
+def get_course_catalog_or_none(db=None):
+    """
+    読み込み済みのカタログ。読み込み中・読み込みに失敗したときは待たずに None を返す
+    （呼び出し側は SQL やベクトル検索だけで続ける）。
+    """
+    try:
+        return get_course_catalog(db, wait=False)
+    except Exception as e:
+        print(f"講義カタログを使えません: {e}")
+        return None
@@ -1,9 +1,18 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import or_,text,and_
-from models import User,aoyama_kougi,user_kougi,user_calendar,chat_log,aoyama_openai_emb
+from sqlalchemy import or_,text,and_,select,union_all,literal,func
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import User,aoyama_kougi,user_kougi,user_calendar,chat_log,aoyama_openai_emb,kougi_slot
 from schemas import UserCreate,UserCalendarModel
+from course_catalog import get_course_catalog_or_none, ids_to_mask
+from database import SessionLocal
+from kougi_slots import DAY_PERIODS, parse_jigen, split_day_period, expand_semesters
+from write_behind import chat_log_writer
+from async_utils import run_blocking
+from public_calendar_stats import calendar_snapshot, apply_calendar_change
+from public_calendar_cache import bump_calendar_version, bump_public_calendar_version, forget_calendar_version
 from fastapi import HTTPException
 from datetime import datetime
+import json
 import numpy as np
 
 def get_users(db:Session):
@@ -12,6 +21,9 @@ def get_users(db:Session):
 def get_user(db:Session,user_id:int):
     return db.query(User).filter(User.id == user_id).first()
 
+async def get_user_async(db:AsyncSession,user_id:int):
+    return (await db.execute(select(User).where(User.id == user_id))).scalars().first()
+
 def get_user_by_name(db:Session,name:str):
     return db.query(User).filter(User.name == name).first()
 
@@ -30,81 +42,167 @@ def create_user(db:Session,user:UserCreate):
     db.refresh(db_user)
     return db_user
 
-# `aoyama_kougi` テーブルに対する検索条件を適用し、IDのみをリストで返す関数
+def _slot_condition(*conditions):
+    """kougi_slot の条件に当てはまるコマを持つ講義、という aoyama_kougi.id の条件を作る"""
+    return aoyama_kougi.id.in_(select(kougi_slot.kougi_id).where(*conditions))
+
+
+def _day_period_condition(combo):
+    """"月１" / "月" / "１" を kougi_slot の day・period の等価条件にする"""
+    day_period = split_day_period(combo)
+    if day_period is None:
+        # "不定" など曜日・時限でない指定はコマの表記そのもので引く
+        return kougi_slot.label == combo
+    day, period = day_period
+    conditions = []
+    if day is not None:
+        conditions.append(kougi_slot.day == day)
+    if period is not None:
+        conditions.append(kougi_slot.period == period)
+    return and_(*conditions)
+
+
+# 講義カタログの読み込みが終わるまで（起動直後や読み込みの失敗時）に使う、SQLで絞り込む版
+def filter_course_ids_sql(db, request):
+    session = db or SessionLocal()
+    try:
+        # ベースクエリで `id` カラムのみを選択
+        query = session.query(aoyama_kougi.id)
+
+        # キャンパス・曜日時限・学期は kougi_slot の索引で絞り込む（時限 の部分一致は使わない）
+        # キャンパス条件
+        if request.campuses:
+            query = query.filter(_slot_condition(kougi_slot.campus.in_(request.campuses)))
+
+        # 曜日と時限の条件
+        if request.dayPeriodCombinations:
+            day_period_conditions = [_day_period_condition(combo) for combo in request.dayPeriodCombinations]
+            query = query.filter(_slot_condition(or_(*day_period_conditions)))
+
+        # 学部条件
+        if request.departments and request.departments != ["指定なし"]:
+            query = query.filter(aoyama_kougi.開講.in_(request.departments))
+
+        # 学期条件（"前期" は "前期集中" なども含める）
+        if request.semesters and request.semesters != ["指定なし"]:
+            query = query.filter(_slot_condition(kougi_slot.semester.in_(expand_semesters(request.semesters))))
+
+        # 講義名条件
+        if request.courseName:
+            query = query.filter(aoyama_kougi.科目.like(f"%{request.courseName}%"))
+
+        # 教員名条件
+        if request.instructorName:
+            query = query.filter(aoyama_kougi.教員.like(f"%{request.instructorName}%"))
+
+        # 結果からIDのみをリストで返す
+        return [r[0] for r in query.all()]
+    finally:
+        if db is None:
+            session.close()
+
+
+# `aoyama_kougi` に対する検索条件を適用し、IDのみをリストで返す関数
+# 講義データはスクレイピングの間は変わらないので、DBではなくメモリ上のカタログ（NumPy のビット演算）で絞り込む
+# 講義名・教員名の指定があれば、それとの関連度の高い順に並べて返す
 def filter_course_ids(db, request):
-    # ベースクエリで `id` カラムのみを選択
-    query = db.query(aoyama_kougi.id)
+    catalog = get_course_catalog_or_none(db)
+    if catalog is None:
+        return filter_course_ids_sql(db, request)
+    return catalog.rank_ids(catalog.ids_from_mask(catalog.filter_mask(request)), request)
 
-    # キャンパス条件
-    if request.campuses:
-        campus_conditions = [aoyama_kougi.時限.like(f"%{campus}%") for campus in request.campuses]
-        query = query.filter(or_(*campus_conditions))
+# filter_course_ids と同じ条件を、講義IDのビットマップ（FAISSの絞り込み用）で返す関数（条件なしは None = 全件）
+def filter_course_mask(db, request):
+    catalog = get_course_catalog_or_none(db)
+    if catalog is None:
+        return ids_to_mask(filter_course_ids_sql(db, request))
+    return catalog.filter_mask(request)
 
-    # 曜日と時限の条件
-    if request.dayPeriodCombinations:
-        day_period_conditions = [aoyama_kougi.時限.like(f"%{combo}%") for combo in request.dayPeriodCombinations]
-        query = query.filter(or_(*day_period_conditions))
+# filter_course_ids の非同期版（カタログの確認・SQLでの絞り込みはスレッドプールで行い、カタログでの絞り込みはメモリ上で済ませる）
+async def filter_course_ids_async(request):
+    catalog = await run_blocking(get_course_catalog_or_none)
+    if catalog is None:
+        return await run_blocking(filter_course_ids_sql, None, request)
+    return catalog.rank_ids(catalog.ids_from_mask(catalog.filter_mask(request)), request)
 
-    # 学部条件
-    if request.departments and request.departments != ["指定なし"]:
-        department_conditions = [aoyama_kougi.開講 == department for department in request.departments]
-        query = query.filter(or_(*department_conditions))
 
-    # 学期条件
-    if request.semesters and request.semesters != ["指定なし"]:
-        semester_conditions = [aoyama_kougi.時限.like(f"%{semester}%") for semester in request.semesters]
-        query = query.filter(or_(*semester_conditions))
+KOUGI_COLUMNS = list(aoyama_kougi.__table__.columns)
 
-    # 講義名条件
-    if request.courseName:
-        query = query.filter(aoyama_kougi.科目.like(f"%{request.courseName}%"))
 
-    # 教員名条件
-    if request.instructorName:
-        query = query.filter(aoyama_kougi.教員.like(f"%{request.instructorName}%"))
+def read_db(db, id_list, calendar_id):
+    """
+    講義IDの一覧から講義情報を取得し、カレンダーに登録済みかどうか（is_registered）を付けて返す。
+    問い合わせは講義本体と登録済みIDの2回だけで、件数によらず一定。
+    結果は ORM オブジェクトではなく dict で、id_list の順番（検索結果の順位）を保つ。
+    """
+    if not id_list:
+        return []
 
-    # 結果からIDのみをリストで返す
-    result = query.all()
-    return [r[0] for r in result]  # `result` はタプルのリストになるため、各タプルの最初の要素 (ID) を抽出
+    # aoyama_kougi を列単位で取得（ORM オブジェクトを作らない）
+    rows = db.query(*KOUGI_COLUMNS).filter(aoyama_kougi.id.in_(id_list)).all()
 
+    # カレンダーに登録済みの講義IDをまとめて取得
+    registered_ids = {
+        kougi_id for (kougi_id,) in db.query(user_kougi.kougi_id).filter(
+            user_kougi.calendar_id == calendar_id,
+            user_kougi.kougi_id.in_(id_list),
+        )
+    }
 
-def read_db(db, id_list, calendar_id):
+    # id_list の順に並べ直す（重複や存在しないIDは除く）
+    return _order_kougi_rows(rows, registered_ids, id_list)
+
+
+async def read_db_async(db: AsyncSession, id_list, calendar_id):
+    """read_db の非同期版（AsyncSession を使い、DBの応答を待つ間イベントループを止めない）"""
     if not id_list:
         return []
 
-    # aoyama_kougi を取得
-    query = db.query(aoyama_kougi).filter(aoyama_kougi.id.in_(id_list))
-    result = query.all()
+    rows = (await db.execute(select(*KOUGI_COLUMNS).where(aoyama_kougi.id.in_(id_list)))).all()
+    registered_ids = set((await db.execute(
+        select(user_kougi.kougi_id).where(
+            user_kougi.calendar_id == calendar_id,
+            user_kougi.kougi_id.in_(id_list),
+        )
+    )).scalars())
+    return _order_kougi_rows(rows, registered_ids, id_list)
 
-    # 結果に `is_registered` を動的に追加
-    for kougi in result:
-        is_registered = db.query(user_kougi).filter(
-            user_kougi.kougi_id == kougi.id,
-            user_kougi.calendar_id == calendar_id
-        ).first() is not None
-        setattr(kougi, "is_registered", is_registered)  # 動的プロパティを追加
 
-    return result
+def _order_kougi_rows(rows, registered_ids, id_list):
+    """講義の行を dict にして is_registered を付け、id_list の順（重複や存在しないIDは除く）に並べる"""
+    kougi_by_id = {}
+    for row in rows:
+        kougi = row._asdict()
+        kougi["is_registered"] = kougi["id"] in registered_ids
+        kougi_by_id[kougi["id"]] = kougi
+    return [kougi_by_id[kougi_id] for kougi_id in dict.fromkeys(id_list) if kougi_id in kougi_by_id]
 
 
 
-def get_matching_kougi_ids(db: Session, kougi_id: int, calendar_id: int):
-    # 有効な時限のパターン
-    valid_periods = {f"{day}{period}" for day in "月火水木金土" for period in "１２３４５６"}
-        
-    # aoyama_kougiテーブルから時限カラムを取得
+def get_kougi_slot_labels(db: Session, kougi_id: int):
+    """講義のコマの表記（"月１" など。user_kougi.period に入れる値）を kougi_slot から取得する"""
+    labels = [
+        row.label
+        for row in db.query(kougi_slot.label)
+        .filter(kougi_slot.kougi_id == kougi_id, kougi_slot.label.isnot(None))
+        .order_by(kougi_slot.id)
+    ]
+    if labels:
+        return labels
+
+    # kougi_slot が未作成の講義（backfill 前など）は、その場で 時限 を分解する
     kougi = db.query(aoyama_kougi.時限).filter(aoyama_kougi.id == kougi_id).first()
 
     # kougiが見つからない、またはkougi.時限がない場合、エラーを投げる
     if not kougi or not kougi.時限:
         raise ValueError(f"kougi_id {kougi_id} に対応する kougi が見つからない、または 時限 が設定されていません。")
 
-    # 時限カラムの文字列全体を解析し、（の前2文字を抽出して有効な時限のみ保持
-    kougi_period = [
-        kougi.時限[i-2:i]
-        for i in range(len(kougi.時限))
-        if kougi.時限[i] == "（" and kougi.時限[i-2:i] in valid_periods
-    ]
+    return [slot["label"] for slot in parse_jigen(kougi.時限) if slot["label"]]
+
+
+def get_matching_kougi_ids(db: Session, kougi_id: int, calendar_id: int):
+    # 曜日・時限で表せるコマのみ重複判定の対象にする
+    kougi_period = [label for label in get_kougi_slot_labels(db, kougi_id) if label in DAY_PERIODS]
 
     if not kougi_period:
         return []
@@ -134,15 +232,8 @@ def insert_user_kougi(db: Session, kougi_id: int, calendar_id: int):
         kougi_id (int): 挿入対象の講義ID。
         calendar_id (int): 挿入対象のカレンダーID。
     """
-    # `aoyama_kougi` テーブルから該当する `時限` データを取得
-    kougi = db.query(aoyama_kougi).filter(aoyama_kougi.id == kougi_id).one()  # 必ず1件だけ取得できると仮定
-
-    # 時限データのリストを抽出
-    periods = [ 
-        kougi.時限[i-2:i]
-        for i in range(2,len(kougi.時限))
-        if kougi.時限[i] == "（"
-    ]
+    # `kougi_slot` から該当する講義のコマを取得
+    periods = get_kougi_slot_labels(db, kougi_id)
 
     # `user_kougi` にデータを挿入
     for period in periods:
@@ -155,6 +246,91 @@ def insert_user_kougi(db: Session, kougi_id: int, calendar_id: int):
 
     # 変更をコミット
     db.commit()
+    bump_calendar_version(calendar_id)
+
+def register_user_kougi_batch(db: Session, kougi_ids: list[int], calendar_id: int):
+    """
+    複数の講義をまとめてカレンダーに登録する。
+    講義のコマとカレンダーの登録済みのコマをそれぞれ1回の問い合わせで読み、重複の判定はメモリ上で行い、
+    登録する行は1回の INSERT と1回のコミットで書き込む。
+
+    kougi_ids の順に判定し、先に登録が決まった講義とも重複を判定する（同じ一括登録の中の講義どうしも重ならない）。
+    すでにカレンダーにある講義は、その講義自身と重複しているとして扱う。
+
+    Returns:
+        dict: registered（登録した講義IDのリスト）、
+              conflicts（[(講義ID, 重なる講義IDのリスト), ...]）、
+              errors（[{"kougi_id", "error"}, ...]）
+    """
+    kougi_ids = list(kougi_ids)
+    labels_by_kougi = _kougi_slot_labels_batch(db, set(kougi_ids))
+
+    # カレンダーに登録済みの講義と、曜日・時限ごとにそこを使っている講義
+    registered_ids = set()
+    occupied = {}
+    for kougi_id, period in db.query(user_kougi.kougi_id, user_kougi.period).filter(user_kougi.calendar_id == calendar_id):
+        registered_ids.add(kougi_id)
+        if period in DAY_PERIODS:
+            occupied.setdefault(period, []).append(kougi_id)
+
+    registered = []
+    conflicts = []
+    errors = []
+    rows = []
+    for kougi_id in kougi_ids:
+        labels = labels_by_kougi.get(kougi_id)
+        if not labels:
+            errors.append({
+                "kougi_id": kougi_id,
+                "error": f"kougi_id {kougi_id} に対応する kougi が見つからない、または 時限 が設定されていません。",
+            })
+            continue
+
+        # 曜日・時限で表せるコマのみ重複判定の対象にする
+        day_periods = [label for label in labels if label in DAY_PERIODS]
+        obstacles = [other for label in day_periods for other in occupied.get(label, [])]
+        if kougi_id in registered_ids and kougi_id not in obstacles:
+            obstacles.append(kougi_id)
+        if obstacles:
+            conflicts.append((kougi_id, list(dict.fromkeys(obstacles))))
+            continue
+
+        rows.extend({"calendar_id": calendar_id, "kougi_id": kougi_id, "period": label} for label in labels)
+        for label in day_periods:
+            occupied.setdefault(label, []).append(kougi_id)
+        registered_ids.add(kougi_id)
+        registered.append(kougi_id)
+
+    if rows:
+        db.execute(user_kougi.__table__.insert(), rows)
+        db.commit()
+        bump_calendar_version(calendar_id)
+
+    return {"registered": registered, "conflicts": conflicts, "errors": errors}
+
+
+def _kougi_slot_labels_batch(db: Session, kougi_ids):
+    """get_kougi_slot_labels を複数の講義についてまとめて行う（{講義ID: コマの表記のリスト}、見つからない講義は含めない）"""
+    if not kougi_ids:
+        return {}
+
+    labels_by_kougi = {}
+    for kougi_id, label in (
+        db.query(kougi_slot.kougi_id, kougi_slot.label)
+        .filter(kougi_slot.kougi_id.in_(kougi_ids), kougi_slot.label.isnot(None))
+        .order_by(kougi_slot.id)
+    ):
+        labels_by_kougi.setdefault(kougi_id, []).append(label)
+
+    # kougi_slot が未作成の講義（backfill 前など）は、その場で 時限 を分解する
+    missing = kougi_ids - labels_by_kougi.keys()
+    if missing:
+        for kougi_id, jigen in db.query(aoyama_kougi.id, aoyama_kougi.時限).filter(aoyama_kougi.id.in_(missing)):
+            labels = [slot["label"] for slot in parse_jigen(jigen) if slot["label"]]
+            if labels:
+                labels_by_kougi[kougi_id] = labels
+    return labels_by_kougi
+
 
 def delete_user_kougi(db: Session, kougi_id: int, calendar_id: int):
     """
@@ -173,6 +349,7 @@ def delete_user_kougi(db: Session, kougi_id: int, calendar_id: int):
 
     # 変更をコミット
     db.commit()
+    bump_calendar_version(calendar_id)
 
 def get_user_kougi(calendar_id: int, db: Session):
     # `user_kougi`から指定されたIDのカレンダーを取得
@@ -187,6 +364,12 @@ def get_user_kougi(calendar_id: int, db: Session):
     return registered_user_kougi
 
 
+def bump_public_calendars_if_changed(before, after):
+    """変更前後のどちらかが公開中なら、公開カレンダーの一覧・検索のキャッシュを無効にする（calendar_snapshot を渡す）"""
+    if (before and before["is_public"]) or (after and after["is_public"]):
+        bump_public_calendar_version()
+
+
 def create_calendar(calendar_data: UserCalendarModel, db: Session):
     """カレンダーの新規作成処理"""
     # PydanticモデルからSQLAlchemyモデルを生成
@@ -196,10 +379,98 @@ def create_calendar(calendar_data: UserCalendarModel, db: Session):
     db.add(new_calendar)  # 新しいレコードを追加    
     db.commit()  # 変更をコミット
     db.refresh(new_calendar)  # 挿入されたデータを更新
+
+    # 公開カレンダーの統計・一覧に反映
+    after = calendar_snapshot(new_calendar)
+    apply_calendar_change(None, after)
+    bump_public_calendars_if_changed(None, after)
     
     return new_calendar
 
 
+def search_public_calendars(db: Session, department=None, campus=None, semester=None, keyword=None, cursor=None, limit=50):
+    """
+    公開されているカレンダーを条件で絞り込み、新しい順（IDの降順）に limit 件返す。
+    絞り込みはすべてDB側で行う（学部は部分一致、キャンパス・学期は一致する要素があること、キーワードはカレンダー名の部分一致）。
+    cursor には前のページの next_cursor（最後のカレンダーID）を渡す。
+
+    Returns:
+        (カレンダーのリスト, 次のページの cursor。最後のページなら None)
+    """
+    query = db.query(user_calendar).filter(user_calendar.is_public == True)
+
+    # 学部（JSONの配列のいずれかの要素に部分一致）
+    if department:
+        pattern = "%" + department.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        query = query.filter(func.json_search(user_calendar.department, "one", pattern).isnot(None))
+
+    # キャンパス・学期（JSONの配列に要素として含まれる）
+    if campus:
+        query = query.filter(func.json_contains(user_calendar.campus, json.dumps(campus, ensure_ascii=False)) == 1)
+    if semester:
+        query = query.filter(func.json_contains(user_calendar.semester, json.dumps(semester, ensure_ascii=False)) == 1)
+
+    # キーワード検索（カレンダー名）
+    if keyword:
+        query = query.filter(user_calendar.calendar_name.contains(keyword, autoescape=True))
+
+    # キーセットページング（OFFSET を使わず、前のページの最後のIDより小さいものから読む）
+    if cursor:
+        query = query.filter(user_calendar.id < cursor)
+    calendars = query.order_by(user_calendar.id.desc()).limit(limit + 1).all()
+
+    next_cursor = calendars[limit - 1].id if len(calendars) > limit else None
+    return calendars[:limit], next_cursor
+
+
+def get_public_calendar_detail(db: Session, calendar_id: int):
+    """
+    公開カレンダーの詳細と登録講義を、カレンダー・user_kougi・aoyama_kougi を結合した1回の問い合わせで取得する。
+    カレンダーがなければ 404、公開されていなければ 403。
+    """
+    rows = (
+        db.query(
+            user_calendar.id, user_calendar.calendar_name, user_calendar.campus,
+            user_calendar.department, user_calendar.semester, user_calendar.sat_flag,
+            user_calendar.sixth_period_flag, user_calendar.is_public,
+            user_kougi.period, aoyama_kougi.id.label("kougi_id"),
+            aoyama_kougi.科目, aoyama_kougi.教員, aoyama_kougi.開講, aoyama_kougi.url,
+        )
+        .outerjoin(user_kougi, user_kougi.calendar_id == user_calendar.id)
+        .outerjoin(aoyama_kougi, aoyama_kougi.id == user_kougi.kougi_id)
+        .filter(user_calendar.id == calendar_id)
+        .order_by(user_kougi.kougi_id, user_kougi.period)
+        .all()
+    )
+    if not rows:
+        raise HTTPException(status_code=404, detail="Calendar not found")
+
+    calendar = rows[0]
+    if not calendar.is_public:
+        raise HTTPException(status_code=403, detail="This calendar is not public")
+
+    return {
+        "calendar_id": calendar.id,
+        "calendar_name": calendar.calendar_name,
+        "campus": calendar.campus,
+        "department": calendar.department,
+        "semester": calendar.semester,
+        "sat_flag": calendar.sat_flag,
+        "sixth_period_flag": calendar.sixth_period_flag,
+        # 講義が見つからない登録（aoyama_kougi から消えた講義など）は除く
+        "lectures": [
+            {
+                "period": row.period,
+                "subject": row.科目,
+                "teacher": row.教員,
+                "semester": row.開講,
+                "url": row.url,
+            }
+            for row in rows if row.kougi_id is not None
+        ],
+    }
+
+
 def update_calendar(calendar_data: UserCalendarModel, db: Session):
     """カレンダーの更新処理"""
     # 指定されたIDのカレンダーを検索
@@ -209,6 +480,8 @@ def update_calendar(calendar_data: UserCalendarModel, db: Session):
     if not calendar:
         raise HTTPException(status_code=404, detail="Calendar not found")
     
+    before = calendar_snapshot(calendar)
+
     # Pydanticモデルを辞書に変換して更新データを反映
     update_data = calendar_data.model_dump()
     for key, value in update_data.items():
@@ -216,6 +489,27 @@ def update_calendar(calendar_data: UserCalendarModel, db: Session):
     
     db.commit()  # 変更をコミット
     db.refresh(calendar)  # 更新されたデータを取得
+
+    # 公開カレンダーの統計・一覧と詳細に反映
+    after = calendar_snapshot(calendar)
+    apply_calendar_change(before, after)
+    bump_public_calendars_if_changed(before, after)
+    bump_calendar_version(calendar.id)
+    return calendar
+
+
+def set_calendar_public(calendar, is_public: bool, db: Session):
+    """カレンダー（ORM のオブジェクト）の公開設定を更新する"""
+    before = calendar_snapshot(calendar)
+    calendar.is_public = is_public
+    db.commit()
+    db.refresh(calendar)
+
+    # 公開カレンダーの統計・一覧と詳細に反映
+    after = calendar_snapshot(calendar)
+    apply_calendar_change(before, after)
+    bump_public_calendars_if_changed(before, after)
+    bump_calendar_version(calendar.id)
     return calendar
 
 
@@ -228,9 +522,15 @@ def delete_calendar(calendar_id: int, db: Session):
     if not calendar:
         raise HTTPException(status_code=404, detail="Calendar not found")
     
+    before = calendar_snapshot(calendar)
     db.delete(calendar)  # カレンダー削除
     db.commit()  # 変更をコミット
 
+    # 公開カレンダーの統計・一覧と詳細に反映
+    apply_calendar_change(before, None)
+    bump_public_calendars_if_changed(before, None)
+    forget_calendar_version(calendar_id)
+
 def get_calendar(calendar_id: int, db: Session):
     # `user_calendar`から指定されたIDのカレンダーを取得
     calendar = db.query(user_calendar).filter(user_calendar.id == calendar_id).first()
@@ -242,6 +542,16 @@ def get_calendar(calendar_id: int, db: Session):
     #return calendar
     return UserCalendarModel.model_validate(calendar)
 
+async def get_calendar_async(calendar_id: int, db: AsyncSession):
+    """get_calendar の非同期版"""
+    calendar = (await db.execute(select(user_calendar).where(user_calendar.id == calendar_id))).scalars().first()
+
+    # カレンダーが見つからない場合はエラー
+    if not calendar:
+        raise HTTPException(status_code=404, detail="Calendar not found")
+
+    return UserCalendarModel.model_validate(calendar)
+
 # ユーザーのdef_calendarを更新する関数
 def update_user_def_calendar(user_id: int,calendar_id: int, db: Session):
 
@@ -265,6 +575,10 @@ def calendar_list(user_id: int, db: Session):
     
     return calendar
 
+# calendar_list の非同期版
+async def calendar_list_async(user_id: int, db: AsyncSession):
+    return (await db.execute(select(user_calendar).where(user_calendar.user_id == user_id))).scalars().all()
+
 def insert_chat(user_id, user_input, generated_input, id_list,db):
     """
     chat_log テーブルに新規レコードを挿入する処理。
@@ -297,6 +611,23 @@ def insert_chat(user_id, user_input, generated_input, id_list,db):
     db.refresh(new_chat)  # 挿入されたデータを取得
     return new_chat
     
+def chat_log_row(user_id, user_input, generated_input, id_list):
+    """chat_log に入れる1行（dict）を作る。FAISS から返る np.int64 の講義IDは int にする"""
+    return {
+        "user_id": user_id,
+        "input": user_input,
+        "generated_input": generated_input,
+        "generated_idlist": [int(i) for i in id_list],
+        "timestamp": datetime.now(),
+    }
+
+def log_chat(user_id, user_input, generated_input, id_list):
+    """
+    chat_log への記録をキューに積む（書き込みは write_behind のスレッドがまとめて行う）。
+    リクエストの応答を待たせないので、/answer からはこちらを使う。
+    """
+    return chat_log_writer.put(chat_log_row(user_id, user_input, generated_input, id_list))
+    
 def get_kougi_summary(id_list,db):
     if not id_list:
         return []
@@ -307,43 +638,79 @@ def get_kougi_summary(id_list,db):
     results_dict = [row._asdict() for row in results]
     return results_dict
 
+async def get_kougi_summary_async(id_list, db: AsyncSession):
+    """get_kougi_summary の非同期版"""
+    if not id_list:
+        return []
+
+    results = await db.execute(
+        select(aoyama_openai_emb.aoyama_kougi_id, aoyama_openai_emb.audi_text)
+        .where(aoyama_openai_emb.aoyama_kougi_id.in_(id_list))
+    )
+    return [row._asdict() for row in results]
+
 def duplicate_calendar(db: Session, user_id: int, source_calendar_id: int):
     """
-    指定されたカレンダーを、指定されたユーザーの所有としてコピーを作成する
+    指定されたカレンダーを、指定されたユーザーの所有としてコピーを作成し、新しいカレンダーのIDを返す
     """
-    # 1. 元のカレンダー情報を取得
-    source_cal = db.query(user_calendar).filter(user_calendar.id == source_calendar_id).first()
-    if not source_cal:
-        raise HTTPException(status_code=404, detail="Source calendar not found")
+    return duplicate_calendars(db, [(user_id, source_calendar_id)], check_access=False)[0]
 
-    # 2. 新しいカレンダーを作成（名前には「のコピー」をつけるなど工夫）
-    new_cal = user_calendar(
-        user_id=user_id,
-        calendar_name=f"{source_cal.calendar_name}のコピー",
-        campus=source_cal.campus,
-        department=source_cal.department,
-        semester=source_cal.semester,
-        sat_flag=source_cal.sat_flag,
-        sixth_period_flag=source_cal.sixth_period_flag,
-        is_public=False # コピーしたものはデフォルトで非公開にする
-    )
-    
-    db.add(new_cal)
-    db.commit()
-    db.refresh(new_cal) # 新しく発行されたIDを取得
 
-    # 3. 元のカレンダーに紐づく講義一覧を取得
-    source_lectures = db.query(user_kougi).filter(user_kougi.calendar_id == source_calendar_id).all()
+def duplicate_calendars(db: Session, pairs, check_access=True):
+    """
+    (コピー先のユーザーID, コピー元のカレンダーID) の組ごとにカレンダーをコピーし、新しいカレンダーのIDのリストを pairs の順で返す。
+    講義（user_kougi）は全組まとめて1回の INSERT … SELECT でコピーし、全体を1つのトランザクションで行う。
+    check_access=True の場合、コピー元は公開されているか、コピー先のユーザー自身のものでなければならない（403）。
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return []
 
-    # 4. 新しいカレンダーIDで講義を登録し直す
-    for lecture in source_lectures:
-        new_lecture = user_kougi(
-            calendar_id=new_cal.id,
-            kougi_id=lecture.kougi_id,
-            period=lecture.period
+    # 1. 元のカレンダー情報をまとめて取得
+    source_ids = {source_id for _, source_id in pairs}
+    sources = {cal.id: cal for cal in db.query(user_calendar).filter(user_calendar.id.in_(source_ids))}
+    for user_id, source_id in pairs:
+        source_cal = sources.get(source_id)
+        if not source_cal:
+            raise HTTPException(status_code=404, detail="Source calendar not found")
+        if check_access and not source_cal.is_public and source_cal.user_id != user_id:
+            raise HTTPException(status_code=403, detail="This calendar is not public")
+
+    try:
+        # 2. 新しいカレンダーを作成（名前には「のコピー」をつける）。flush で新しいIDだけ発行し、まだコミットしない
+        new_cals = []
+        for user_id, source_id in pairs:
+            source_cal = sources[source_id]
+            new_cals.append(user_calendar(
+                user_id=user_id,
+                calendar_name=f"{source_cal.calendar_name}のコピー",
+                campus=source_cal.campus,
+                department=source_cal.department,
+                semester=source_cal.semester,
+                sat_flag=source_cal.sat_flag,
+                sixth_period_flag=source_cal.sixth_period_flag,
+                is_public=False # コピーしたものはデフォルトで非公開にする
+            ))
+        db.add_all(new_cals)
+        db.flush()
+        # コミットすると ORM のオブジェクトは期限切れになり、id を読むたびに SELECT が走るので、ここで取り出しておく
+        new_ids = [new_cal.id for new_cal in new_cals]
+
+        # 3. 元のカレンダーの講義を、コピー元ID → 新しいIDの対応表と結合して1回でコピーする
+        mapping = union_all(*[
+            select(literal(source_id).label("source_id"), literal(new_id).label("new_id"))
+            for (_, source_id), new_id in zip(pairs, new_ids)
+        ]).subquery("mapping")
+        db.execute(
+            user_kougi.__table__.insert().from_select(
+                ["calendar_id", "kougi_id", "period"],
+                select(mapping.c.new_id, user_kougi.kougi_id, user_kougi.period)
+                .join(mapping, user_kougi.calendar_id == mapping.c.source_id),
+            )
         )
-        db.add(new_lecture)
-    
-    db.commit()
-    
-    return new_cal
\ No newline at end of file
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return new_ids
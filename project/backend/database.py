@@ -1,18 +1,160 @@
+import os
+import threading
+import time
+import pymysql
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from db_config import dbConfig
 
 user = dbConfig['user']
 password = dbConfig['password']
 host = dbConfig['host']
+port = dbConfig['port']
 database = dbConfig['database']
+charset = dbConfig['charset']
+
+SQLALCHEMY_DATABASE_URL = f'mysql+pymysql://{user}:{password}@{host}:{port}/{database}?charset={charset}'
+# async def のエンドポイントから使う非同期の接続（aiomysql）
+ASYNC_SQLALCHEMY_DATABASE_URL = f'mysql+aiomysql://{user}:{password}@{host}:{port}/{database}?charset={charset}'
+
+# 接続プールの設定（プールはプロセス＝uvicorn のワーカーごとに持つ）
+# 常に保持する接続数。既定は同期処理のスレッドプール（BLOCKING_POOL_SIZE）と同じ数
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", os.getenv("BLOCKING_POOL_SIZE", "8")))
+# 混雑時に一時的に追加できる接続数
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "4"))
+# 空きの接続を待つ秒数。過ぎたら TimeoutError
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# この秒数より古い接続は作り直す（MySQL の wait_timeout＝既定8時間より短くする）
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))
+# 貸し出す前に接続が生きているか確かめる（夜間に切られた接続で失敗しないように）
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# 接続・読み込み・書き込みのタイムアウト（秒）
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+DB_READ_TIMEOUT = int(os.getenv("DB_READ_TIMEOUT", "30"))
+DB_WRITE_TIMEOUT = int(os.getenv("DB_WRITE_TIMEOUT", "30"))
+
+
+# 接続の貸し出しを待った時間の集計（/db/pool/stats で返す）
+pool_wait_stats = {"checkouts": 0, "wait_total_ms": 0.0, "wait_max_ms": 0.0, "timeouts": 0}
+_pool_wait_lock = threading.Lock()
+
+
+class TimedQueuePool(QueuePool):
+    """接続の貸し出しを待った時間を pool_wait_stats に記録する QueuePool"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            with _pool_wait_lock:
+                pool_wait_stats["timeouts"] += 1
+            raise
+        waited_ms = (time.perf_counter() - started) * 1000
+        with _pool_wait_lock:
+            pool_wait_stats["checkouts"] += 1
+            pool_wait_stats["wait_total_ms"] += waited_ms
+            pool_wait_stats["wait_max_ms"] = max(pool_wait_stats["wait_max_ms"], waited_ms)
+        return connection
 
-SQLALCHEMY_DATABASE_URL = f'mysql+pymysql://{user}:{password}@{host}/{database}'
 
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL
+    SQLALCHEMY_DATABASE_URL,
+    poolclass=TimedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args={
+        "connect_timeout": DB_CONNECT_TIMEOUT,
+        "read_timeout": DB_READ_TIMEOUT,
+        "write_timeout": DB_WRITE_TIMEOUT,
+    },
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# 非同期エンジン。DBの応答を待つ間もイベントループを止めないので、1ワーカーで多くのリクエストを並行して待てる
+# プールの設定は同期エンジンと同じ値を使う（同期・非同期でそれぞれ別のプールを持つ）
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args={"connect_timeout": DB_CONNECT_TIMEOUT},
+)
+# commit 後も取得済みの値を読めるように expire_on_commit=False にする（非同期では遅延読み込みができないため）
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
+
+
+# エンドポイントの依存性（同じリクエストの中では同じセッションが使い回される）
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+class PooledConnection:
+    """
+    engine のプールから借りた PyMySQL の接続。
+    cursor() は従来の create_db_connection と同じく DictCursor を返し、close() で接続をプールに返す。
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self, cursorclass=pymysql.cursors.DictCursor):
+        return self._connection.cursor(cursorclass)
+
+    def close(self):
+        self._connection.close()
+
+    def __getattr__(self, name):
+        # commit / rollback などはそのまま PyMySQL の接続に渡す
+        return getattr(self._connection, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def raw_connection():
+    """プールから PyMySQL の接続を借りる（使い終わったら close() でプールに返す）"""
+    return PooledConnection(engine.raw_connection())
+
+
+def pool_stats():
+    """接続プールの状態（貸し出し中・追加分・待ち時間）。async は非同期エンジンのプール"""
+    pool = engine.pool
+    with _pool_wait_lock:
+        waits = dict(pool_wait_stats)
+    checkouts = waits["checkouts"]
+    async_pool = async_engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checkouts": checkouts,
+        "timeouts": waits["timeouts"],
+        "wait_avg_ms": round(waits["wait_total_ms"] / checkouts, 3) if checkouts else 0.0,
+        "wait_max_ms": round(waits["wait_max_ms"], 3),
+        "async": {
+            "size": async_pool.size(),
+            "checked_in": async_pool.checkedin(),
+            "checked_out": async_pool.checkedout(),
+            "overflow": async_pool.overflow(),
+        },
+    }
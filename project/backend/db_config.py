@@ -16,17 +16,13 @@ dbConfig = {
 }
 
 def create_db_connection():
-    """MySQLに直接接続するユーティリティ関数"""
-    connection = pymysql.connect(
-        host=dbConfig["host"],
-        port=dbConfig["port"],
-        user=dbConfig["user"],
-        password=dbConfig["password"],
-        database=dbConfig["database"],
-        charset=dbConfig["charset"],
-        cursorclass=pymysql.cursors.DictCursor
-    )
-    return connection
+    """
+    MySQLに直接接続するユーティリティ関数。
+    接続は毎回作らず database.engine の接続プールから借りる。close() でプールに返す。
+    """
+    # database が dbConfig を読み込むので、循環しないようにここで読み込む
+    from database import raw_connection
+    return raw_connection()
 
 # データベース接続をテスト
 if __name__ == "__main__":
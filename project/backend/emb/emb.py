@@ -1,11 +1,11 @@
 from openai import OpenAI
-import json
 import os
 import sys
-import time
 from dotenv import load_dotenv
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from db_config import create_db_connection  # DB接続をインポート
+from embedding_service import embedding_service, EMBEDDING_BATCH_SIZE
+from emb_codec import encode_vector, DEFAULT_VECTOR_DTYPE
 
 load_dotenv()
 
@@ -93,66 +93,75 @@ def raw_audience_info(kamoku, jigen, kyouin, tani, kaiko, gakunen, message, text
     return content.strip() 
 
 
-def get_embedding(text, retries=5, backoff_factor=1):
-    for attempt in range(retries):
-        try:
-            response = client.embeddings.create(
-                model="text-embedding-3-small",
-                input=text
-            )
-            return response.data[0].embedding
-        except Exception as e:
-            print(f"Error on attempt {attempt + 1}: {e}")
-            if attempt < retries - 1:
-                wait_time = backoff_factor * (2 ** attempt)
-                print(f"Retrying after {wait_time} seconds...")
-                time.sleep(wait_time)
-            else:
-                print("Max retries reached. Raising exception.")
-                raise
+def get_embedding(text):
+    # リトライ・キャッシュは embedding_service 側で行う
+    return embedding_service.embed(text)[0].tolist()
 
-def store_embedding_in_db(id, text, embedding):
+def get_embeddings(texts):
+    # 複数の文章を EMBEDDING_BATCH_SIZE 件ずつまとめてベクトル化する
+    return list(embedding_service.embed_texts(texts))
+
+# ベクトルの保存形式（f4: float32 / f2: float16）
+EMBEDDING_STORE_DTYPE = os.getenv("EMBEDDING_STORE_DTYPE", DEFAULT_VECTOR_DTYPE)
+
+def ensure_embedding_table(cursor):
+    # テーブルが存在しない場合は作成
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS aoyama_openai_emb (
+        aoyama_kougi_id INT PRIMARY KEY,
+        audi_text TEXT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci,  
+        openai_emb JSON,
+        openai_emb_bin BLOB,
+        openai_emb_dtype VARCHAR(4)
+    )
+    """
+    cursor.execute(create_table_query)
+
+    # 外部キー制約を追加
+    try:
+        alter_table_query = """
+        ALTER TABLE aoyama_openai_emb
+        ADD CONSTRAINT fk_aoyama_kougi
+        FOREIGN KEY (aoyama_kougi_id) REFERENCES aoyama_kougi(id)
+        ON DELETE CASCADE
+        """
+        cursor.execute(alter_table_query)
+    except Exception as e:
+        # 外部キー制約がすでに存在する場合は何もしない
+        print()
+
+def store_embeddings_in_db(rows):
+    """
+    (講義ID, 受講者情報, ベクトル) のリストを1つの接続・1回の executemany でまとめて保存する。
+    ベクトルはJSONではなくバイナリ列（openai_emb_bin）に保存する。
+    """
     connection = create_db_connection()
     try:
         with connection.cursor() as cursor:
-            # テーブルが存在しない場合は作成
-            create_table_query = """
-            CREATE TABLE IF NOT EXISTS aoyama_openai_emb (
-                aoyama_kougi_id INT PRIMARY KEY,
-                audi_text TEXT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci,  
-                openai_emb JSON
-            )
-            """
-            cursor.execute(create_table_query)
-
-            # 外部キー制約を追加
-            try:
-                alter_table_query = """
-                ALTER TABLE aoyama_openai_emb
-                ADD CONSTRAINT fk_aoyama_kougi
-                FOREIGN KEY (aoyama_kougi_id) REFERENCES aoyama_kougi(id)
-                ON DELETE CASCADE
-                """
-                cursor.execute(alter_table_query)
-            except Exception as e:
-                # 外部キー制約がすでに存在する場合は何もしない
-                print()
-            
-            
-            # 埋め込みベクトルをJSONとして保存
-            embedding_json = json.dumps(embedding)
-
-            # 講義情報にベクトルを追加するSQLクエリ
+            ensure_embedding_table(cursor)
+
+            # 講義情報にベクトルを追加するSQLクエリ（作り直した場合は置き換える）
             sql = """
-            INSERT INTO aoyama_openai_emb (aoyama_kougi_id, audi_text, openai_emb)
-            VALUES (%s, %s, %s)
+            INSERT INTO aoyama_openai_emb (aoyama_kougi_id, audi_text, openai_emb_bin, openai_emb_dtype)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                audi_text = VALUES(audi_text),
+                openai_emb = NULL,
+                openai_emb_bin = VALUES(openai_emb_bin),
+                openai_emb_dtype = VALUES(openai_emb_dtype)
             """
-            cursor.execute(sql, (id, text, embedding_json))  # embedding_jsonを使用
+            cursor.executemany(sql, [
+                (id, text, encode_vector(embedding, EMBEDDING_STORE_DTYPE), EMBEDDING_STORE_DTYPE)
+                for id, text, embedding in rows
+            ])
 
         connection.commit()
     finally:
         connection.close()
 
+def store_embedding_in_db(id, text, embedding):
+    store_embeddings_in_db([(id, text, embedding)])
+
 # メイン処理
 def main(start_id=None):
     # 処理済みIDを記録するファイル
@@ -164,6 +173,37 @@ def main(start_id=None):
         with open(progress_file, "r") as f:
             processed_ids = set(map(int, f.read().splitlines()))
 
+    # ベクトル化待ちの (講義ID, 受講者情報)
+    pending = []
+
+    def flush_pending():
+        # 3. 溜まった受講者情報をまとめてベクトル化（1リクエストで最大 EMBEDDING_BATCH_SIZE 件）
+        try:
+            embeddings = get_embeddings([audience_info for _, audience_info in pending])
+        except Exception as e:
+            print(f"Error embedding IDs {[lecture_id for lecture_id, _ in pending]}: {e}")
+            pending.clear()
+            return
+
+        try:
+            # 4. ベクトルをデータベースにまとめて保存
+            store_embeddings_in_db([
+                (lecture_id, audience_info, embedding)
+                for (lecture_id, audience_info), embedding in zip(pending, embeddings)
+            ])
+        except Exception as e:
+            print(f"Error storing IDs {[lecture_id for lecture_id, _ in pending]}: {e}")
+            pending.clear()
+            return
+
+        # 処理済みIDを記録
+        with open(progress_file, "a") as f:
+            for lecture_id, _ in pending:
+                f.write(f"{lecture_id}\n")
+        print(f"Lecture IDs: {[lecture_id for lecture_id, _ in pending]}, Embeddings stored in DB.")
+        pending.clear()
+        print()
+
     # 1. 講義情報をデータベースから取得
     lectures = fetch_lecture_info()
 
@@ -181,22 +221,16 @@ def main(start_id=None):
             # 2. GPT-4を使って最適な受講者像を生成
             audience_info = generate_audience_info(text)
             print(f"Lecture ID: {lecture_id}, Audience Info: {audience_info}")
-
-            # 3. 生成された受講者情報をベクトル化
-            embedding = get_embedding(audience_info)
-
-            # 4. ベクトルをデータベースに保存
-            store_embedding_in_db(lecture_id, audience_info, embedding)
-            print(f"Lecture ID: {lecture_id}, Embedding stored in DB.")
         except Exception as e:
             print(f"Error processing ID {lecture_id}: {e}")
             continue
 
-        # 処理済みIDを記録
-        with open(progress_file, "a") as f:
-            f.write(f"{lecture_id}\n")
+        pending.append((lecture_id, audience_info))
+        if len(pending) >= EMBEDDING_BATCH_SIZE:
+            flush_pending()
 
-        print()
+    if pending:
+        flush_pending()
 
 # 実行
 if __name__ == "__main__":
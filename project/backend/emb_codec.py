@@ -0,0 +1,59 @@
+import json
+import numpy as np
+
+# aoyama_openai_emb.openai_emb_bin に保存するベクトルの型（リトルエンディアン）
+# f4: float32（既定） / f2: float16（サイズ半分・精度は検索に十分）
+VECTOR_DTYPES = {
+    "f4": np.dtype("<f4"),
+    "f2": np.dtype("<f2"),
+}
+DEFAULT_VECTOR_DTYPE = "f4"
+
+
+def encode_vector(vector, dtype=DEFAULT_VECTOR_DTYPE):
+    """ベクトルを生のバイト列に変換する"""
+    return np.asarray(vector).astype(VECTOR_DTYPES[dtype], copy=False).tobytes()
+
+
+def decode_vector(blob, dtype=DEFAULT_VECTOR_DTYPE):
+    """
+    バイト列をベクトルに戻す。
+    float32 はコピーせずにバイト列を参照する（読み取り専用）。float16 は float32 に変換する。
+    """
+    vector = np.frombuffer(blob, dtype=VECTOR_DTYPES[dtype or DEFAULT_VECTOR_DTYPE])
+    if vector.dtype != np.float32:
+        vector = vector.astype(np.float32)
+    return vector
+
+
+def decode_json_vector(raw):
+    """移行前の行に残っている openai_emb（JSON文字列）をベクトルに戻す"""
+    if isinstance(raw, bytes):
+        raw = raw.decode('utf-8')  # bytesをstrにデコード
+    return np.asarray(json.loads(raw), dtype=np.float32)
+
+
+def decode_embedding(blob, dtype, raw_json):
+    """バイナリ列があればそれを、なければJSON列を使ってベクトルを返す"""
+    if blob is not None:
+        return decode_vector(blob, dtype)
+    return decode_json_vector(raw_json)
+
+
+def decode_embedding_into(blob, dtype, raw_json, out):
+    """decode_embedding と同じく、確保済みの float32 配列の1行（out）に直接書き込む"""
+    if blob is not None:
+        # バイナリ列はパースせずにバイト列をそのまま参照してコピーするだけ
+        out[:] = np.frombuffer(blob, dtype=VECTOR_DTYPES[dtype or DEFAULT_VECTOR_DTYPE])
+        return
+    # 移行前の行はJSONをパースする
+    if isinstance(raw_json, bytes):
+        raw_json = raw_json.decode('utf-8')  # bytesをstrにデコード
+    out[:] = json.loads(raw_json)
+
+
+# バイナリ列を優先し、JSON列はバイナリ列が空の行だけ転送させるためのSELECT句
+EMBEDDING_COLUMNS_SQL = (
+    "openai_emb_bin, openai_emb_dtype, "
+    "CASE WHEN openai_emb_bin IS NULL THEN openai_emb END AS openai_emb"
+)
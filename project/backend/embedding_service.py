@@ -0,0 +1,215 @@
+import asyncio
+import hashlib
+import os
+import time
+import numpy as np
+from dotenv import load_dotenv
+from openai import OpenAI, AsyncOpenAI
+from redis.exceptions import RedisError
+from cache import LocalTTLCache
+from emb_codec import encode_vector, decode_vector
+from redis_config import redis_sync_client, redis_async_client
+
+load_dotenv()
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+# 1回の embeddings.create にまとめる件数
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "100"))
+# Redisに保存したベクトルの有効期限（秒）。既定は90日
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", str(60 * 60 * 24 * 90)))
+# プロセス内LRUに保持する件数（1件あたり約6KB）
+EMBEDDING_CACHE_LOCAL_SIZE = int(os.getenv("EMBEDDING_CACHE_LOCAL_SIZE", "2048"))
+# API呼び出しのリトライ設定（試行回数と、n 回目の失敗後に待つ秒数 BACKOFF × 2^(n-1)）
+# オフラインのベクトル作成（emb/emb.py・同期版のメソッド）は粘り強くやり直す
+EMBEDDING_RETRIES = 5
+EMBEDDING_BACKOFF_FACTOR = 1
+# オンライン検索（/answer・非同期版のメソッド）は利用者を待たせないよう、すぐに1回だけやり直す
+EMBEDDING_ONLINE_RETRIES = int(os.getenv("EMBEDDING_ONLINE_RETRIES", "2"))
+EMBEDDING_ONLINE_BACKOFF_FACTOR = float(os.getenv("EMBEDDING_ONLINE_BACKOFF_FACTOR", "0.2"))
+
+
+def embedding_cache_key(text: str, model: str = EMBEDDING_MODEL) -> str:
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"emb:{model}:{digest}"
+
+
+class EmbeddingService:
+    """
+    埋め込みベクトルの取得をまとめて扱うクラス。
+    同じ文章は内容のハッシュでキャッシュ（プロセス内LRU → Redis）から返し、
+    キャッシュにない文章だけを EMBEDDING_BATCH_SIZE 件ずつ1リクエストにまとめてAPIに投げる。
+    オンライン検索（openai_search）とオフラインのベクトル作成（emb/emb.py）の両方から使う。
+    """
+
+    def __init__(self, model: str = EMBEDDING_MODEL, batch_size: int = EMBEDDING_BATCH_SIZE):
+        self.model = model
+        self.batch_size = batch_size
+        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.local = LocalTTLCache(EMBEDDING_CACHE_LOCAL_SIZE, EMBEDDING_CACHE_TTL)
+        self.counters = {
+            "local_hits": 0,
+            "redis_hits": 0,
+            "misses": 0,
+            "api_requests": 0,
+            "redis_errors": 0,
+        }
+
+    # ---------- キャッシュ ----------
+
+    def _split_cached(self, texts):
+        """プロセス内キャッシュにあるものを埋め、残りのキーを返す"""
+        keys = [embedding_cache_key(text, self.model) for text in texts]
+        vectors = [self.local.get(key) for key in keys]
+        self.counters["local_hits"] += sum(v is not None for v in vectors)
+        return keys, vectors
+
+    def _apply_redis_values(self, keys, vectors, missing, raws):
+        for i, raw in zip(missing, raws):
+            if raw is None:
+                continue
+            # ベクトルはリトルエンディアンのfloat32バイト列としてRedisに保存している
+            vector = decode_vector(raw)
+            vectors[i] = vector
+            self.local.set(keys[i], vector)
+            self.counters["redis_hits"] += 1
+
+    def _store(self, keys, vectors, indices):
+        mapping = {}
+        for i in indices:
+            self.local.set(keys[i], vectors[i])
+            mapping[keys[i]] = encode_vector(vectors[i])
+        return mapping
+
+    # ---------- API呼び出し ----------
+
+    def _request(self, texts, retries=EMBEDDING_RETRIES, backoff=EMBEDDING_BACKOFF_FACTOR):
+        for attempt in range(retries):
+            try:
+                self.counters["api_requests"] += 1
+                response = self.client.embeddings.create(model=self.model, input=texts)
+                return [np.asarray(d.embedding, dtype=np.float32) for d in response.data]
+            except Exception as e:
+                print(f"Error on attempt {attempt + 1}: {e}")
+                if attempt == retries - 1:
+                    raise
+                time.sleep(backoff * (2 ** attempt))
+
+    async def _arequest(self, texts, retries=EMBEDDING_ONLINE_RETRIES, backoff=EMBEDDING_ONLINE_BACKOFF_FACTOR):
+        for attempt in range(retries):
+            try:
+                self.counters["api_requests"] += 1
+                response = await self.async_client.embeddings.create(model=self.model, input=texts)
+                return [np.asarray(d.embedding, dtype=np.float32) for d in response.data]
+            except Exception as e:
+                print(f"Error on attempt {attempt + 1}: {e}")
+                if attempt == retries - 1:
+                    raise
+                await asyncio.sleep(backoff * (2 ** attempt))
+
+    def _unique_missing(self, texts, vectors):
+        """未取得の文章を重複なしで返す（同じ文章は1回だけAPIに送る）"""
+        pending = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                pending.setdefault(texts[i], []).append(i)
+        return pending
+
+    # ---------- 公開メソッド ----------
+
+    def embed_texts(self, texts, retries=EMBEDDING_RETRIES, backoff=EMBEDDING_BACKOFF_FACTOR):
+        """
+        複数の文章をベクトル化する。retries・backoff はAPI呼び出しの試行回数と待ち時間の係数。
+
+        Returns:
+            np.ndarray: shape (len(texts), EMBEDDING_DIM) の float32 配列。
+        """
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+        keys, vectors = self._split_cached(texts)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            try:
+                raws = redis_sync_client.mget([keys[i] for i in missing])
+                self._apply_redis_values(keys, vectors, missing, raws)
+            except RedisError:
+                self.counters["redis_errors"] += 1
+
+        pending = self._unique_missing(texts, vectors)
+        self.counters["misses"] += len(pending)
+        uniques = list(pending)
+        for start in range(0, len(uniques), self.batch_size):
+            chunk = uniques[start:start + self.batch_size]
+            filled = []
+            for text, vector in zip(chunk, self._request(chunk, retries, backoff)):
+                for i in pending[text]:
+                    vectors[i] = vector
+                filled.append(pending[text][0])
+            try:
+                pipe = redis_sync_client.pipeline(transaction=False)
+                for key, raw in self._store(keys, vectors, filled).items():
+                    pipe.setex(key, EMBEDDING_CACHE_TTL, raw)
+                pipe.execute()
+            except RedisError:
+                self.counters["redis_errors"] += 1
+
+        return np.vstack(vectors).astype(np.float32, copy=False)
+
+    async def aembed_texts(self, texts, retries=EMBEDDING_ONLINE_RETRIES, backoff=EMBEDDING_ONLINE_BACKOFF_FACTOR):
+        """embed_texts の非同期版（APIサーバー用。既定ではすぐに1回だけやり直す）"""
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+        keys, vectors = self._split_cached(texts)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            try:
+                raws = await redis_async_client.mget([keys[i] for i in missing])
+                self._apply_redis_values(keys, vectors, missing, raws)
+            except RedisError:
+                self.counters["redis_errors"] += 1
+
+        pending = self._unique_missing(texts, vectors)
+        self.counters["misses"] += len(pending)
+        uniques = list(pending)
+        for start in range(0, len(uniques), self.batch_size):
+            chunk = uniques[start:start + self.batch_size]
+            filled = []
+            for text, vector in zip(chunk, await self._arequest(chunk, retries, backoff)):
+                for i in pending[text]:
+                    vectors[i] = vector
+                filled.append(pending[text][0])
+            try:
+                pipe = redis_async_client.pipeline(transaction=False)
+                for key, raw in self._store(keys, vectors, filled).items():
+                    pipe.setex(key, EMBEDDING_CACHE_TTL, raw)
+                await pipe.execute()
+            except RedisError:
+                self.counters["redis_errors"] += 1
+
+        return np.vstack(vectors).astype(np.float32, copy=False)
+
+    def embed(self, text, retries=EMBEDDING_RETRIES, backoff=EMBEDDING_BACKOFF_FACTOR):
+        """1件の文章をベクトル化する。FAISSにそのまま渡せる shape (1, EMBEDDING_DIM) で返す"""
+        return self.embed_texts([text], retries, backoff)
+
+    async def aembed(self, text, retries=EMBEDDING_ONLINE_RETRIES, backoff=EMBEDDING_ONLINE_BACKOFF_FACTOR):
+        """embed の非同期版（APIサーバー用）"""
+        return await self.aembed_texts([text], retries, backoff)
+
+    def stats(self):
+        hits = self.counters["local_hits"] + self.counters["redis_hits"]
+        lookups = hits + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "local_size": len(self.local),
+            "model": self.model,
+        }
+
+
+embedding_service = EmbeddingService()
@@ -1,6 +1,7 @@
 from fastapi import Request, HTTPException
 from fastapi.responses import JSONResponse
 from sqlalchemy.exc import IntegrityError, OperationalError
+from vector_search import SearchIndexNotReady
 
 # カスタム例外ハンドラー
 async def http_exception_handler(request: Request, exc: HTTPException):
@@ -22,6 +23,13 @@ async def operational_error_handler(request: Request, exc: OperationalError):
         content={"detail": "Database operational error: an unexpected issue occurred."},
     )
 
+# FAISSインデックスの読み込み前（起動直後）
+async def search_index_not_ready_handler(request: Request, exc: SearchIndexNotReady):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Search index is not ready yet. Please retry shortly."},
+    )
+
 # 予期しない例外をキャッチ
 async def unhandled_exception_handler(request: Request, exc: Exception):
     return JSONResponse(
@@ -0,0 +1,126 @@
+import argparse
+import time
+import faiss
+import numpy as np
+from dotenv import load_dotenv
+from database import SessionLocal
+from models import chat_log
+from embedding_service import embedding_service
+from faiss_create_db import fetch_embeddings, build_index
+from vector_search import VectorSearchEngine
+
+load_dotenv()
+
+# 何も指定しなかったときに比較する構成
+DEFAULT_CONFIGS = [
+    "flat:metric=ip",
+    "ivf:nprobe=8",
+    "ivf:nprobe=32",
+    "hnsw:hnsw_m=32,ef_search=64",
+    "hnsw:hnsw_m=32,ef_search=64,metric=ip",
+    "ivfpq:pq_m=64,nprobe=32",
+]
+INT_OPTIONS = {"nlist", "nprobe", "hnsw_m", "ef_construction", "ef_search", "pq_m", "pq_nbits"}
+
+
+def parse_config(spec):
+    """"ivf:nlist=256,nprobe=16" のような指定を build_index の引数に変換する"""
+    index_type, _, rest = spec.partition(":")
+    options = {"index_type": index_type}
+    for item in filter(None, rest.split(",")):
+        key, value = item.split("=", 1)
+        options[key] = int(value) if key in INT_OPTIONS else value
+    return options
+
+
+def fetch_logged_queries(limit):
+    """chat_log に残っている書き換え後のクエリ（重複なし・新しい順）を取得する"""
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(chat_log.generated_input)
+            .filter(chat_log.generated_input.isnot(None))
+            .order_by(chat_log.id.desc())
+            .limit(limit * 3)
+            .all()
+        )
+    finally:
+        db.close()
+    queries = list(dict.fromkeys(row.generated_input for row in rows if row.generated_input))
+    return queries[:limit]
+
+
+def measure(engine, queries, k):
+    """1クエリずつ検索し、結果とレイテンシ（ミリ秒）を返す"""
+    results = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        ids = engine.search(query[np.newaxis, :], k=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(ids)
+    return results, np.asarray(latencies)
+
+
+def recall_at_k(results, truths, k):
+    hits = [len(set(result[:k]) & set(truth[:k])) / k for result, truth in zip(results, truths)]
+    return float(np.mean(hits))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="chat_log のクエリを使い、各インデックスの recall@k とレイテンシをFlat(L2)と比較する"
+    )
+    parser.add_argument("configs", nargs="*", default=DEFAULT_CONFIGS,
+                        help='比較する構成（例: "ivf:nlist=256,nprobe=16" "hnsw:ef_search=128,metric=ip"）')
+    parser.add_argument("--queries", type=int, default=500, help="使うクエリ数")
+    parser.add_argument("--k", type=int, default=9, help="recall@k の k（/answer は9件）")
+    parser.add_argument("--replicate", type=int, default=1,
+                        help="コーパスを擬似的にN倍に増やして計測する（複数年度分の想定）")
+    args = parser.parse_args()
+
+    ids, emb = fetch_embeddings()
+    if args.replicate > 1:
+        # 少しだけノイズを加えた複製で件数を増やす（IDは重ならないよう付け替える）
+        rng = np.random.default_rng(0)
+        copies = [emb] + [
+            emb + rng.normal(scale=0.01, size=emb.shape).astype(np.float32)
+            for _ in range(args.replicate - 1)
+        ]
+        emb = np.vstack(copies)
+        ids = np.arange(1, len(emb) + 1, dtype=np.int64)
+    print(f"コーパス: {len(ids)} 件")
+
+    queries = fetch_logged_queries(args.queries)
+    if not queries:
+        raise SystemExit("chat_log に generated_input がありません。")
+    query_vectors = embedding_service.embed_texts(queries)
+    print(f"クエリ: {len(queries)} 件")
+
+    baseline = VectorSearchEngine.from_index(build_index(ids, emb, index_type="flat"))
+    truths, base_latency = measure(baseline, query_vectors, args.k)
+    base_memory = len(faiss.serialize_index(baseline._owner))
+
+    header = f"{'config':<42} {'build[s]':>9} {'recall@' + str(args.k):>10} {'p50[ms]':>8} {'p95[ms]':>8} {'p99[ms]':>8} {'memory[MB]':>11}"
+    print(header)
+    print("-" * len(header))
+    print(f"{'flat (l2, baseline)':<42} {'-':>9} {1.0:>10.4f} "
+          f"{np.percentile(base_latency, 50):>8.2f} {np.percentile(base_latency, 95):>8.2f} "
+          f"{np.percentile(base_latency, 99):>8.2f} {base_memory / 1e6:>11.1f}")
+
+    for spec in args.configs:
+        options = parse_config(spec)
+        start = time.perf_counter()
+        index = build_index(ids, emb, **options)
+        build_time = time.perf_counter() - start
+
+        engine = VectorSearchEngine.from_index(index)
+        results, latency = measure(engine, query_vectors, args.k)
+        memory = len(faiss.serialize_index(index))
+        print(f"{spec:<42} {build_time:>9.2f} {recall_at_k(results, truths, args.k):>10.4f} "
+              f"{np.percentile(latency, 50):>8.2f} {np.percentile(latency, 95):>8.2f} "
+              f"{np.percentile(latency, 99):>8.2f} {memory / 1e6:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,178 @@
 from db_config import create_db_connection  # DB接続をインポート
+import argparse
+import time
 import faiss
 import numpy as np
-import pandas as pd
-import ast
-
-index = faiss.IndexFlatL2(1536)
-connection = create_db_connection()
-try:
-    with connection.cursor() as cursor:
-        # 講義情報を取得するSQLクエリ
-        sql = """
-            select aoyama_kougi_id,openai_emb from aoyama_openai_emb
-        """
-        cursor.execute(sql)
-        result = cursor.fetchall()
-        df = pd.DataFrame(result, columns=['aoyama_kougi_id', 'openai_emb'])
-        
-
-        # 'emb' をリストに変換し、numpy配列に変換
-        def decode_and_convert(x):
-            if isinstance(x, bytes):
-                x = x.decode('utf-8')  # bytesをstrにデコード
-            return np.array(ast.literal_eval(x)).reshape(1, -1)
-
-        df['openai_emb'] = df['openai_emb'].apply(decode_and_convert)
-        two_d_list = [arr.flatten().tolist() for arr in df['openai_emb'].tolist()]
-        emb = np.array(two_d_list).astype('float32')
-
-        index.add(emb)
-        faiss.write_index(index,"faiss_index.bin")
-
-        
-finally:
-    connection.close()
+import pymysql
+from vector_search import INDEX_TYPES, METRICS, create_index, set_search_params
+from emb_codec import EMBEDDING_COLUMNS_SQL, decode_embedding_into
 
+EMBEDDING_DIM = 1536
+# DBから読み込む／インデックスに追加する単位
+CHUNK_SIZE = 4096
+
+
+def count_embeddings():
+    connection = create_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) AS n FROM aoyama_openai_emb")
+            return cursor.fetchone()['n']
+    finally:
+        connection.close()
+
+
+def iter_embedding_chunks(chunk_size=CHUNK_SIZE):
+    """
+    サーバーサイドカーソルで aoyama_openai_emb を少しずつ読み、(講義ID, ベクトル) を chunk_size 件ずつ返す。
+    全件を fetchall しないので、読み込み中のメモリはチャンク1つ分で済む。
+
+    返す配列は次のチャンクで上書きされるバッファなので、呼び出し側はその場で使い切る（コピーする）こと。
+    """
+    ids = np.empty(chunk_size, dtype=np.int64)
+    vectors = np.empty((chunk_size, EMBEDDING_DIM), dtype=np.float32)
+
+    connection = create_db_connection()
+    try:
+        with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(f"SELECT aoyama_kougi_id, {EMBEDDING_COLUMNS_SQL} FROM aoyama_openai_emb")
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for i, (kougi_id, blob, dtype, raw_json) in enumerate(rows):
+                    ids[i] = kougi_id
+                    decode_embedding_into(blob, dtype, raw_json, vectors[i])
+                yield ids[:len(rows)], vectors[:len(rows)]
+    finally:
+        connection.close()
+
+
+class Progress:
+    """読み込み・追加の進み具合と経過時間を表示する"""
+
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.started = time.perf_counter()
+
+    def advance(self, n):
+        self.done += n
+        elapsed = time.perf_counter() - self.started
+        percent = self.done / self.total * 100 if self.total else 100.0
+        print(f"  {self.label}: {self.done:,} / {self.total:,} 件 ({percent:.1f}%) {elapsed:.1f}秒")
+
+
+def fetch_embeddings(chunk_size=CHUNK_SIZE):
+    """aoyama_openai_emb の全ベクトルを、件数分だけ確保した float32 配列に読み込む"""
+    total = count_embeddings()
+    ids = np.empty(total, dtype=np.int64)
+    emb = np.empty((total, EMBEDDING_DIM), dtype=np.float32)
+
+    progress = Progress("読み込み", total)
+    n = 0
+    for chunk_ids, chunk_vectors in iter_embedding_chunks(chunk_size):
+        # 読み込み中に行が増えていた場合は、確保した件数までで打ち切る
+        size = min(len(chunk_ids), total - n)
+        ids[n:n + size] = chunk_ids[:size]
+        emb[n:n + size] = chunk_vectors[:size]
+        n += size
+        progress.advance(size)
+        if n == total:
+            break
+    return ids[:n], emb[:n]
+
+
+def build_index(ids, emb, index_type="flat", metric="l2", nlist=None, nprobe=None,
+                hnsw_m=32, ef_construction=40, ef_search=None, pq_m=64, pq_nbits=8):
+    """指定した種類のインデックスを作り、講義IDつきでベクトルを追加する"""
+    if metric == "ip":
+        # 内積で比較するため、ベクトルを単位長に正規化しておく
+        emb = emb.copy()
+        faiss.normalize_L2(emb)
+
+    # 行番号ではなく講義ID（aoyama_kougi_id）でベクトルを引けるよう IndexIDMap2 で包まれている
+    index = create_index(
+        index_type, emb.shape[1], metric=metric, nlist=nlist, ntotal=len(ids),
+        hnsw_m=hnsw_m, ef_construction=ef_construction, pq_m=pq_m, pq_nbits=pq_nbits,
+    )
+    if not index.is_trained:
+        index.train(emb)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        index.add_with_ids(emb[start:start + CHUNK_SIZE], ids[start:start + CHUNK_SIZE])
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+    return index
+
+
+def build_index_from_db(index_type="flat", metric="l2", nlist=None, nprobe=None,
+                        hnsw_m=32, ef_construction=40, ef_search=None, pq_m=64, pq_nbits=8):
+    """
+    DBから直接インデックスを作る。
+    学習の要らない flat / hnsw はチャンクごとにそのまま追加し、全件の配列を持たない。
+    学習が必要な ivf / ivfpq は全件を確保済み配列に読み込んでから学習・追加する。
+    """
+    total = count_embeddings()
+    index = create_index(
+        index_type, EMBEDDING_DIM, metric=metric, nlist=nlist, ntotal=total,
+        hnsw_m=hnsw_m, ef_construction=ef_construction, pq_m=pq_m, pq_nbits=pq_nbits,
+    )
+
+    if not index.is_trained:
+        ids, emb = fetch_embeddings()
+        started = time.perf_counter()
+        index = build_index(
+            ids, emb, index_type=index_type, metric=metric, nlist=nlist, nprobe=nprobe,
+            hnsw_m=hnsw_m, ef_construction=ef_construction, ef_search=ef_search,
+            pq_m=pq_m, pq_nbits=pq_nbits,
+        )
+        print(f"  学習・追加: {time.perf_counter() - started:.1f}秒")
+        return index
+
+    progress = Progress("追加", total)
+    for chunk_ids, chunk_vectors in iter_embedding_chunks():
+        if metric == "ip":
+            faiss.normalize_L2(chunk_vectors)
+        index.add_with_ids(chunk_vectors, chunk_ids)
+        progress.advance(len(chunk_ids))
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+    return index
+
+
+def add_index_arguments(parser):
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat", help="インデックスの種類")
+    parser.add_argument("--metric", choices=list(METRICS), default="l2", help="l2: L2距離 / ip: 正規化ベクトルの内積")
+    parser.add_argument("--nlist", type=int, default=None, help="IVFのクラスタ数（省略時は件数から自動）")
+    parser.add_argument("--nprobe", type=int, default=16, help="IVFの検索時に調べるクラスタ数")
+    parser.add_argument("--hnsw-m", type=int, default=32, help="HNSWの各ノードのリンク数")
+    parser.add_argument("--ef-construction", type=int, default=40, help="HNSW構築時の探索幅")
+    parser.add_argument("--ef-search", type=int, default=64, help="HNSW検索時の探索幅")
+    parser.add_argument("--pq-m", type=int, default=64, help="PQの分割数（1536を割り切れる値）")
+    parser.add_argument("--pq-nbits", type=int, default=8, help="PQの各コードのビット数")
+
+
+def index_options(args):
+    return {
+        "index_type": args.index_type,
+        "metric": args.metric,
+        "nlist": args.nlist,
+        "nprobe": args.nprobe,
+        "hnsw_m": args.hnsw_m,
+        "ef_construction": args.ef_construction,
+        "ef_search": args.ef_search,
+        "pq_m": args.pq_m,
+        "pq_nbits": args.pq_nbits,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="aoyama_openai_emb からFAISSインデックスを作成する")
+    parser.add_argument("--output", default="faiss_index.bin", help="出力するインデックスファイル")
+    add_index_arguments(parser)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    index = build_index_from_db(**index_options(args))
+    faiss.write_index(index, args.output)
+    elapsed = time.perf_counter() - started
+    print(f"✅ {args.index_type}（{args.metric}）のインデックスを作成しました（{index.ntotal} 件、{elapsed:.1f}秒）。")
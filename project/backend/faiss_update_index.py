@@ -0,0 +1,141 @@
+import argparse
+import os
+import time
+import faiss
+import numpy as np
+from dotenv import load_dotenv
+from db_config import create_db_connection  # DB接続をインポート
+from emb_codec import EMBEDDING_COLUMNS_SQL, decode_embedding
+
+load_dotenv()
+
+FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "faiss_index.bin")
+# IN句に一度に渡すIDの数
+FETCH_CHUNK_SIZE = 500
+
+
+def load_index(path):
+    """インデックスを読み込む。旧形式（ID対応なし）なら IndexIDMap2 に変換する"""
+    index = faiss.read_index(path)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return index
+
+    print("旧形式のインデックスのため、行番号+1を講義IDとみなして IndexIDMap2 に変換します。")
+    vectors = index.reconstruct_n(0, index.ntotal)
+    converted = faiss.IndexIDMap2(faiss.IndexFlatL2(index.d))
+    converted.add_with_ids(vectors, np.arange(1, index.ntotal + 1, dtype=np.int64))
+    return converted
+
+
+def fetch_all_ids(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT aoyama_kougi_id FROM aoyama_openai_emb")
+        return {row['aoyama_kougi_id'] for row in cursor.fetchall()}
+
+
+def fetch_vectors(connection, ids):
+    """指定した講義IDのベクトルを取得する。DBに存在しないIDは結果に含まれない"""
+    found_ids = []
+    vectors = []
+    ids = sorted(ids)
+    with connection.cursor() as cursor:
+        for start in range(0, len(ids), FETCH_CHUNK_SIZE):
+            chunk = ids[start:start + FETCH_CHUNK_SIZE]
+            cursor.execute(
+                f"SELECT aoyama_kougi_id, {EMBEDDING_COLUMNS_SQL} FROM aoyama_openai_emb WHERE aoyama_kougi_id IN %s",
+                (chunk,),
+            )
+            for row in cursor.fetchall():
+                found_ids.append(row['aoyama_kougi_id'])
+                vectors.append(decode_embedding(row['openai_emb_bin'], row['openai_emb_dtype'], row['openai_emb']))
+
+    if not vectors:
+        return np.empty(0, dtype=np.int64), None
+    return np.asarray(found_ids, dtype=np.int64), np.vstack(vectors)
+
+
+def remove_vectors(index, ids):
+    if len(ids) == 0:
+        return 0
+    # IndexIDMap2 の remove_ids は行番号 → 講義IDの対応表を詰め直す。
+    # Flat は内側のベクトルも同じように詰まるので対応が保たれるが、IVF は転置リストに古い行番号が残り、
+    # 以降の検索結果が別の講義を指すようになる（HNSW はそもそも削除できない）
+    if not isinstance(faiss.downcast_index(index.index), faiss.IndexFlat):
+        raise SystemExit("flat 以外のインデックスは削除・置換に対応していません。faiss_create_db.py で再構築してください。")
+    return index.remove_ids(np.asarray(sorted(ids), dtype=np.int64))
+
+
+def upsert_vectors(index, ids, vectors):
+    """既存のベクトルがあれば消してから追加し直す（＝置き換え）"""
+    if len(ids) == 0:
+        return
+    existing = np.intersect1d(ids, faiss.vector_to_array(index.id_map))
+    remove_vectors(index, existing)
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        # 内積インデックスは正規化したベクトルで作られている
+        faiss.normalize_L2(vectors)
+    index.add_with_ids(vectors, ids)
+
+
+def write_index_atomically(index, path):
+    """
+    一時ファイルに書き出してから rename で置き換える。
+    APIは読み込み途中の壊れたファイルを見ることがなく、更新時刻の変化で新しいインデックスに切り替わる。
+    """
+    tmp_path = f"{path}.tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="aoyama_openai_emb の変更分だけFAISSインデックスに反映する（全件再構築しない）"
+    )
+    parser.add_argument("--index", default=FAISS_INDEX_PATH, help="インデックスファイルのパス")
+    parser.add_argument(
+        "--ids", type=int, nargs="+", default=[],
+        help="ベクトルを置き換える講義ID。DBから消えているIDはインデックスからも削除する",
+    )
+    parser.add_argument(
+        "--sync", action="store_true",
+        help="DBにあってインデックスにないIDを追加し、DBから消えたIDを削除する",
+    )
+    args = parser.parse_args()
+
+    if not args.ids and not args.sync:
+        parser.error("--ids か --sync のどちらかを指定してください")
+
+    start = time.perf_counter()
+    index = load_index(args.index)
+    print(f"インデックスを読み込みました（{index.ntotal} 件）。")
+
+    connection = create_db_connection()
+    try:
+        to_upsert = set(args.ids)
+        to_remove = set()
+
+        if args.sync:
+            db_ids = fetch_all_ids(connection)
+            index_ids = set(faiss.vector_to_array(index.id_map).tolist())
+            to_upsert |= db_ids - index_ids
+            to_remove |= index_ids - db_ids
+
+        found_ids, vectors = fetch_vectors(connection, to_upsert)
+        # --ids で指定されたがDBに存在しないものは削除扱い
+        to_remove |= to_upsert - set(found_ids.tolist())
+    finally:
+        connection.close()
+
+    upsert_vectors(index, found_ids, vectors)
+    removed = remove_vectors(index, to_remove)
+    write_index_atomically(index, args.index)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"✅ 追加/置換 {len(found_ids)} 件、削除 {removed} 件を反映しました"
+        f"（合計 {index.ntotal} 件、{elapsed:.2f} 秒）。"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+/answer のハイブリッド検索。
+
+FAISS（書き換えたクエリの埋め込みの近さ）の順位と、ユーザーの入力そのものと
+科目・教員・講義要約（audi_text）の語句一致の順位を Reciprocal Rank Fusion（RRF）で統合する。
+入力が講義名・教員名をほぼそのまま含む（語句一致が確か）ときは、LLMによるクエリ書き換えを省く（rewrite=auto / never）。
+"""
+import asyncio
+import os
+from dotenv import load_dotenv
+from async_utils import run_blocking
+from course_catalog import get_course_catalog_or_none
+from text_index import normalize_text
+from openai_search import adaptive_search_async
+
+# ec２サーバーで作成した.envファイルを読み込む。.envはgitignoreに追加
+load_dotenv()
+
+# RRF の定数（大きいほど上位と下位の差が小さくなる）
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+# それぞれの検索から統合の候補として取り出す件数
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "50"))
+# 入力が講義名・教員名に含まれる講義がこの件数以下なら「語句一致が確か」とみなす
+HYBRID_CONFIDENT_MAX_HITS = int(os.getenv("HYBRID_CONFIDENT_MAX_HITS", "3"))
+
+# 語句一致の対象の列
+LEXICAL_FIELDS = ("科目", "教員", "audi_text")
+# 最上位のスコアに対してこの割合に満たない語句一致は、たまたま文字が重なっただけとして捨てる
+LEXICAL_MIN_RATIO = 0.5
+
+SEARCH_MODES = ("hybrid", "vector")
+
+
+def lexical_search(text, id_mask=None, k=HYBRID_CANDIDATES):
+    """
+    入力そのものと 科目・教員・audi_text の語句一致で講義IDを順位づけする。
+    講義カタログが読み込み中・読み込みに失敗したときは空のリスト（FAISS の順位だけになる）
+    """
+    catalog = get_course_catalog_or_none()
+    if catalog is None:
+        return []
+    hits = catalog.text_index.search(text, k=k, fields=LEXICAL_FIELDS, id_mask=id_mask)
+    if not hits:
+        return []
+    threshold = hits[0][1] * LEXICAL_MIN_RATIO
+    return [kougi_id for kougi_id, score in hits if score >= threshold]
+
+
+def confident_lexical_ids(text, id_mask=None):
+    """
+    入力（2文字以上）が講義名か教員名にそのまま含まれ、該当が HYBRID_CONFIDENT_MAX_HITS 件以下なら、その講義IDを返す。
+    講義名・教員名で講義を探している（書き換えが要らない）入力の判定に使う。該当しなければ
+    （講義カタログが読み込み中・読み込みに失敗したときも）空のリスト。
+    """
+    if len(normalize_text(text)) < 2:
+        return []
+
+    catalog = get_course_catalog_or_none()
+    if catalog is None:
+        return []
+    for field in ("科目", "教員"):
+        ids = catalog.text_index.contains(field, text)
+        if id_mask is not None:
+            ids = ids[ids < len(id_mask)]
+            ids = ids[id_mask[ids]]
+        if 0 < len(ids) <= HYBRID_CONFIDENT_MAX_HITS:
+            return ids.tolist()
+    return []
+
+
+def reciprocal_rank_fusion(rankings, k=HYBRID_RRF_K):
+    """複数の順位リストを RRF（各リストでの順位 r に 1/(k + r) を足し合わせる）で1つにまとめる"""
+    scores = {}
+    for ranking in rankings:
+        for rank, kougi_id in enumerate(ranking, start=1):
+            scores[kougi_id] = scores.get(kougi_id, 0.0) + 1.0 / (k + rank)
+    # 同点なら先に渡したリストでの順位が高いものを優先する（dict の挿入順を保つ sorted は安定）
+    return sorted(scores, key=lambda kougi_id: -scores[kougi_id])
+
+
+async def hybrid_search_async(id_mask, text, k=9, rewrite="auto", on_token=None):
+    """
+    ハイブリッド検索を行い、(講義IDのリスト, 埋め込みに使ったクエリ, 経路, 確信度) を返す。
+    経路と確信度は openai_search.adaptive_search と同じ。on_token は書き換えのトークンを受け取る。
+    """
+    # 語句一致と、書き換え・FAISS 検索は並行して行う
+    # （語句一致が確かかどうかは、adaptive_search_async が経路を決めるのに必要になったときに待つ）
+    confident_task = (
+        asyncio.ensure_future(run_blocking(confident_lexical_ids, text, id_mask)) if rewrite != "always" else None
+    )
+    try:
+        lexical_ids, (vector_ids, question, path, confidence) = await asyncio.gather(
+            run_blocking(lexical_search, text, id_mask),
+            adaptive_search_async(
+                id_mask, text, k=max(k, HYBRID_CANDIDATES), rewrite=rewrite, known_topic=confident_task or False,
+                on_token=on_token,
+            ),
+        )
+        confident_ids = await confident_task if confident_task else []
+    except BaseException:
+        if confident_task:
+            confident_task.cancel()
+        raise
+
+    if confident_ids:
+        # 講義名・教員名で探している入力なので、名前が一致した講義を先頭に置く（書き換えも省かれる）
+        lexical_ids = confident_ids + [kougi_id for kougi_id in lexical_ids if kougi_id not in confident_ids]
+    # 同点のときは、語句一致が確かなら語句一致の順位を、そうでなければ FAISS の順位を優先する
+    rankings = [lexical_ids, vector_ids] if confident_ids else [vector_ids, lexical_ids]
+    return reciprocal_rank_fusion(rankings)[:k], question, path, confidence
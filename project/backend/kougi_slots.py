@@ -0,0 +1,140 @@
+"""
+aoyama_kougi.時限（例: "[青山]金２（後期）"、"[相模原]月１（前期）月２（前期）"）を、
+コマ単位の行（kougi_slot）に分解する。"[…]" がキャンパス、"（…）" が学期。
+
+分解はスクレイピングで講義を登録するとき（と backfill_kougi_slot.py）に1回だけ行い、
+検索の絞り込みや時間割の重複判定では kougi_slot の索引を引く。
+"""
+
+DAYS = "月火水木金土"
+PERIODS = "１２３４５６"
+# 曜日・時限で表せるコマ（"月１"～"土６"）
+DAY_PERIODS = {f"{day}{period}" for day in DAYS for period in PERIODS}
+# 時限に現れる学期（画面の学期リストから「指定なし」を除いたもの）
+SEMESTERS = [
+    "前期", "通年", "後期", "後期前半", "後期後半", "通年隔１", "前期前半", "前期後半",
+    "通年隔２", "前期集中", "夏休集中", "集中", "春休集中", "後期集中", "前期隔２", "前期隔１",
+    "後期隔２", "後期隔１", "通年集中"
+]
+# 部分一致で長いものを優先する（"前期集中" を "前期" と判定しないため）
+_SEMESTERS_BY_LENGTH = sorted(SEMESTERS, key=len, reverse=True)
+
+CREATE_KOUGI_SLOT_SQL = """
+CREATE TABLE IF NOT EXISTS kougi_slot (
+    id INT PRIMARY KEY AUTO_INCREMENT,
+    kougi_id INT NOT NULL,
+    label VARCHAR(50),
+    day VARCHAR(1),
+    period INT,
+    campus VARCHAR(50),
+    semester VARCHAR(50),
+    INDEX idx_kougi_slot_kougi_id (kougi_id),
+    INDEX idx_kougi_slot_day_period (day, period, kougi_id),
+    INDEX idx_kougi_slot_campus (campus, kougi_id),
+    INDEX idx_kougi_slot_semester (semester, kougi_id)
+);
+"""
+
+INSERT_KOUGI_SLOT_SQL = """
+INSERT INTO kougi_slot (kougi_id, label, day, period, campus, semester)
+VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+
+def detect_semester(jigen):
+    """時限の文字列に含まれる学期を返す（見つからなければ None）"""
+    for semester in _SEMESTERS_BY_LENGTH:
+        if semester in jigen:
+            return semester
+    return None
+
+
+def parse_jigen(jigen):
+    """
+    時限の文字列をコマごとの dict（label, day, period, campus, semester）のリストにする。
+
+    コマは「（」の直前2文字（これまで insert_user_kougi が user_kougi.period に入れていた値）で、
+    キャンパスはそのコマより前にある直近の「[]」の中、学期はコマの「（）」の中から取る。
+    "月１" のような曜日・時限は day / period にも分けて持ち、"不定" などそれ以外のコマは day / period を NULL にする。
+    コマが1つもない講義も、キャンパス・学期で絞り込めるよう label なしの1行を返す。
+    """
+    if not jigen:
+        return []
+
+    slots = []
+    campus = None
+    i = 0
+    while i < len(jigen):
+        if jigen[i] == "[":
+            end = jigen.find("]", i)
+            if end == -1:
+                break
+            campus = jigen[i+1:end].strip() or None
+            i = end + 1
+            continue
+        if jigen[i] == "（" and i >= 2:
+            # "[青山]（後期）" のように「（」の前がキャンパスならコマはない
+            label = jigen[i-2:i] if "]" not in jigen[i-2:i] else None
+            end = jigen.find("）", i)
+            inner = jigen[i+1:end] if end != -1 else jigen[i+1:]
+            day, period = (label[0], PERIODS.index(label[1]) + 1) if label in DAY_PERIODS else (None, None)
+            slot = {
+                "label": label, "day": day, "period": period, "campus": campus,
+                "semester": detect_semester(inner) or detect_semester(jigen),
+            }
+            if slot not in slots:
+                slots.append(slot)
+            i = end + 1 if end != -1 else len(jigen)
+            continue
+        i += 1
+
+    if not slots:
+        semester = detect_semester(jigen)
+        if campus or semester:
+            slots.append({"label": None, "day": None, "period": None, "campus": campus, "semester": semester})
+    return slots
+
+
+def slot_rows(kougi_id, jigen):
+    """INSERT_KOUGI_SLOT_SQL にそのまま渡せるタプルのリスト"""
+    return [
+        (kougi_id, slot["label"], slot["day"], slot["period"], slot["campus"], slot["semester"])
+        for slot in parse_jigen(jigen)
+    ]
+
+
+def replace_kougi_slots(cursor, kougi_id, jigen):
+    """講義1件分のコマを入れ直す（pymysql のカーソルを受け取る。コミットは呼び出し側で行う）"""
+    cursor.execute("DELETE FROM kougi_slot WHERE kougi_id = %s", (kougi_id,))
+    rows = slot_rows(kougi_id, jigen)
+    if rows:
+        cursor.executemany(INSERT_KOUGI_SLOT_SQL, rows)
+    return len(rows)
+
+
+def split_day_period(value):
+    """
+    画面から来る曜日・時限の指定（"月１"、"月"、"１"）を (day, period) に分ける。
+    どちらかは None になりうる。曜日・時限として解釈できない値は None を返す。
+    """
+    if not value:
+        return None
+    day = value[0] if value[0] in DAYS else None
+    rest = value[1:] if day else value
+    if not rest:
+        return (day, None)
+    if len(rest) == 1 and rest in PERIODS:
+        return (day, PERIODS.index(rest) + 1)
+    return None
+
+
+def expand_semesters(requested):
+    """
+    学期の指定を、kougi_slot.semester に入りうる値の一覧に広げる。
+    これまでの 時限 LIKE '%前期%' と同じく、"前期" で "前期集中" や "前期隔１" なども対象にする。
+    """
+    expanded = list(dict.fromkeys(requested))
+    for semester in SEMESTERS:
+        if semester not in expanded and any(value and value in semester for value in requested):
+            expanded.append(semester)
+    return expanded
@@ -1,33 +1,61 @@
-from fastapi import Depends, FastAPI, HTTPException, Request, Response
-from fastapi.responses import HTMLResponse
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from contextlib import asynccontextmanager
 from fastapi.openapi.utils import get_openapi
 from sqlalchemy.orm import Session
 from fastapi.middleware.cors import CORSMiddleware
-from openai_search import subset_search_batch, generate_input
+from openai_search import (
+    adaptive_search_async, rewrite_cache, REWRITE_MODES, ANSWER_REWRITE_MODE,
+    load_search_index, refresh_search_engine, get_search_engine,
+)
+from vector_search import SearchIndexNotReady, describe_engine
+from embedding_service import embedding_service
+from hybrid_search import hybrid_search_async, SEARCH_MODES
+from course_catalog import get_course_catalog, load_course_catalog, bump_catalog_version
+from kougi_slots import parse_jigen
+from async_utils import run_blocking
+from auth import (
+    SESSION_COOKIE, SESSION_TTL, store_session, delete_session,
+    current_user, require_user, own_calendar_id, own_calendar, require_own_calendar,
+)
+from write_behind import start_writers, stop_writers, writer_stats
+from public_calendar_cache import (
+    cached_public_calendars, calendar_etag, cached_calendar_detail, confirm_calendar_version,
+)
+from public_calendar_stats import (
+    get_public_calendar_stats, reconcile_public_calendar_stats, PUBLIC_STATS_RECONCILE_INTERVAL,
+)
+import public_calendar_cache
 from crud import (
     get_user, get_user_by_name,
-    create_user, filter_course_ids, read_db,
-    get_matching_kougi_ids, insert_user_kougi,
+    create_user, filter_course_ids, filter_course_mask, read_db,
+    register_user_kougi_batch,
     delete_user_kougi, calendar_list, get_user_kougi,
-    create_calendar, update_calendar, delete_calendar, get_calendar,
-    update_user_def_calendar, insert_chat, get_kougi_summary,
-    duplicate_calendar
+    create_calendar, update_calendar, delete_calendar, get_calendar, set_calendar_public,
+    update_user_def_calendar, log_chat, get_kougi_summary,
+    duplicate_calendars, search_public_calendars, get_public_calendar_detail,
+    get_user_async, filter_course_ids_async, read_db_async,
+    calendar_list_async, get_kougi_summary_async,
 )
 # user_calendar を追加
-from models import User, RequiredCourse, user_calendar
-from schemas import User, UserCreate, SearchRequest, UserCalendarModel
-from database import SessionLocal, engine, Base
+from models import User, RequiredCourse, user_calendar, aoyama_kougi, kougi_slot
+from schemas import User, UserCreate, SearchRequest, UserCalendarModel, CurrentUser, CalendarImportRequest
+from database import SessionLocal, AsyncSessionLocal, engine, Base, pool_stats, get_db
+from sqlalchemy.ext.asyncio import AsyncSession
 import sys
+import traceback
 import uvicorn
 import bcrypt
 import asyncio
-import redis
+import json
 import uuid
 from fastapi.exceptions import RequestValidationError
 from error_handlers import (
     http_exception_handler,
     integrity_error_handler,
     operational_error_handler,
+    search_index_not_ready_handler,
     unhandled_exception_handler,
 )
 from sqlalchemy.exc import IntegrityError, OperationalError
@@ -89,14 +117,113 @@ def initialize_required_courses_on_startup():
     finally:
         db.close()
 
-# 初期化処理を実行
-initialize_required_courses_on_startup()
+# ---------------------------------------------------------
+# 起動時に時限を分解したコマの表（kougi_slot）を作る関数
+# ---------------------------------------------------------
+def initialize_kougi_slots_on_startup():
+    """kougi_slot が空なら aoyama_kougi.時限 を分解して登録する関数（以降は backfill_kougi_slot.py で更新）"""
+    db = SessionLocal()
+    try:
+        # 既にデータがあるか確認（データがあれば何もしない）
+        if db.query(kougi_slot).first():
+            print("✅ kougi_slot は既に存在するため、スキップします。")
+            return
+
+        print("🔄 kougi_slot の初期化を開始します...")
+        slots = [
+            kougi_slot(kougi_id=kougi.id, **slot)
+            for kougi in db.query(aoyama_kougi.id, aoyama_kougi.時限)
+            for slot in parse_jigen(kougi.時限)
+        ]
+        db.add_all(slots)
+        db.commit()
+        print(f"✅ {len(slots)} 件のコマを kougi_slot に登録しました。")
+
+    except Exception as e:
+        print(f"❌ kougi_slot の初期化中にエラーが発生しました: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+# 検索機能の準備状況（/ready で返す）
+readiness = {"index": "loading", "catalog": "loading", "errors": []}
+
+# ---------------------------------------------------------
+# 起動時に絞り込み用の講義カタログを読み込む関数
+# ---------------------------------------------------------
+def load_course_catalog_on_startup():
+    """学部・時限のビットマップを作っておき、最初の検索を待たせないようにする関数"""
+    try:
+        catalog = get_course_catalog()
+        readiness["catalog"] = "ready"
+        print(f"✅ 講義カタログを読み込みました（{len(catalog)} 件）。")
+    except Exception as e:
+        readiness["catalog"] = "error"
+        readiness["errors"].append(f"catalog: {e}")
+        print(f"❌ 講義カタログの読み込み中にエラーが発生しました: {e}")
+
+# ---------------------------------------------------------
+# 起動時にFAISSインデックスを読み込む関数
+# ---------------------------------------------------------
+def load_search_index_on_startup():
+    """FAISSインデックスを読み込む関数（FAISS_MMAP=1 なら mmap で読み込む）"""
+    try:
+        engine = load_search_index()
+        readiness["index"] = "ready"
+        print(f"✅ FAISSインデックスを読み込みました（{engine.ntotal} 件、mmap={engine.mmap}）。")
+    except Exception as e:
+        readiness["index"] = "error"
+        readiness["errors"].append(f"index: {e}")
+        print(f"❌ FAISSインデックスの読み込み中にエラーが発生しました: {e}")
+
+def load_search_resources_on_startup():
+    load_search_index_on_startup()
+    load_course_catalog_on_startup()
+
+async def reconcile_public_calendar_stats_periodically():
+    """
+    公開カレンダーの統計を定期的にDBから数え直す（少しずつの更新で生じたずれを直す）。
+    数え直すのは、その回のロックを取れた1つのワーカーだけ
+    """
+    while True:
+        try:
+            stats = await run_blocking(reconcile_public_calendar_stats)
+            if stats is not None:
+                print(f"✅ 公開カレンダーの統計を数え直しました（{stats[0]} 件）。")
+        except Exception as e:
+            print(f"❌ 公開カレンダーの統計の数え直しに失敗しました: {e}")
+        await asyncio.sleep(PUBLIC_STATS_RECONCILE_INTERVAL)
+
+# ---------------------------------------------------------
+# 起動・終了処理
+# ---------------------------------------------------------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 初期化処理を実行
+    await run_blocking(initialize_required_courses_on_startup)
+    await run_blocking(initialize_kougi_slots_on_startup)
+    # 重い読み込みはバックグラウンドで行い、APIはすぐに起動させる（完了までは /ready が 503 を返す）
+    app.state.search_loader = asyncio.create_task(run_blocking(load_search_resources_on_startup))
+    # chat_log などの書き込みキューを起動する
+    start_writers()
+    # 公開カレンダーの統計の数え直し（ワーカーのうち1つだけが PUBLIC_STATS_RECONCILE_INTERVAL 秒に1回数える）
+    reconciler = None
+    if PUBLIC_STATS_RECONCILE_INTERVAL > 0:
+        reconciler = asyncio.create_task(reconcile_public_calendar_stats_periodically())
+    yield
+    # 読み込みや数え直しが終わっていなければ待たずに止める
+    background = [app.state.search_loader] + ([reconciler] if reconciler else [])
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    # 終了時はキューに残っている行を書き込んでから止める
+    await run_blocking(stop_writers)
 
 # ---------------------------------------------------------
 # FastAPI アプリケーション設定
 # ---------------------------------------------------------
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "https://agu-syllabus.ddo.jp",
@@ -119,21 +246,18 @@ def init_required_courses():
         # CSV の絶対パス
         CSV_PATH = os.path.join(os.path.dirname(__file__), "required_courses.csv")
 
-        # DB 接続
-        connection = create_db_connection()
-        cursor = connection.cursor()
-
         with open(CSV_PATH, "r", encoding="utf-8-sig") as f:
-
             reader = csv.DictReader(f)
-            for row in reader:
-                cursor.execute("""
+            rows = [(row["department"], row["grade"], row["kougi_id"], row.get("campus", None)) for row in reader]
+
+        # DB 接続（プールから借り、抜けるときに返す）
+        with create_db_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.executemany("""
                     INSERT INTO required_courses (department, grade, kougi_id, campus)
                     VALUES (%s, %s, %s, %s)
-                """, (row["department"], row["grade"], row["kougi_id"], row.get("campus", None)))
-
-        connection.commit()
-        connection.close()
+                """, rows)
+            connection.commit()
 
         return {"message": "✅ 必修科目データを登録しました。"}
 
@@ -144,15 +268,13 @@ def init_required_courses():
 app.add_exception_handler(HTTPException, http_exception_handler)
 app.add_exception_handler(IntegrityError, integrity_error_handler)
 app.add_exception_handler(OperationalError, operational_error_handler)
+app.add_exception_handler(SearchIndexNotReady, search_index_not_ready_handler)
 app.add_exception_handler(Exception, unhandled_exception_handler)
 
-# Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+# async def のエンドポイント用（DBの応答を待つ間もイベントループを止めない）
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 def hash_password(password: str) -> str:
     # パスワードをハッシュ化
@@ -163,31 +285,6 @@ def verify_password(stored_hash: str, password: str) -> bool:
     # 入力されたパスワードとハッシュ化されたパスワードを照合
     return bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8'))
 
-# Redisクライアントの初期化
-redis_client = redis.StrictRedis(host='redis', port=6379, db=0)
-
-
-# セッションをRedisに保存する関数
-def store_session(session_id: str, user_id: int):
-    redis_client.setex(session_id, 86400, str(user_id))  # セッション有効期限を1日（86400秒）に設定
-
-# セッションをRedisから取得する関数
-def get_session(session_id: str):
-    if session_id is None:
-        return None
-    user_id = redis_client.get(session_id)
-    return int(user_id) if user_id else None
-
-def delete_session(session_id: str):
-    redis_client.delete(session_id)
-
-def get_userid(request: Request):
-    session_id = request.cookies.get("session_id")
-    if not get_session(session_id):
-        return 0  
-    else:
-        return int(get_session(session_id))
-
 @app.post("/users/register", response_model=User)
 def create_user_endpoint(user: UserCreate, db: Session = Depends(get_db)):
     db_user = get_user_by_name(db, name=user.name)
@@ -200,27 +297,28 @@ def create_user_endpoint(user: UserCreate, db: Session = Depends(get_db)):
     return create_user(db=db, user=user)
 
 @app.post("/users/login", response_model=User)
-def read_user(
+async def read_user(
     response: Response,
     name: str,
     password: str,
     db: Session = Depends(get_db)
 ):
-    user = get_user_by_name(db, name=name)
-    if not user or not verify_password(user.password, password):
+    # DBの参照とパスワードの照合（bcrypt）は重いのでスレッドプールで行う
+    user = await run_blocking(get_user_by_name, db, name=name)
+    if not user or not await run_blocking(verify_password, user.password, password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
     # セッションIDをクッキーに保存
     session_id = str(uuid.uuid4())
     
     # セッションIDとユーザーIDをRedisに保存
-    store_session(session_id, user.id)
+    await store_session(session_id, user.id)
     
     response.set_cookie(
-        key="session_id",
+        key=SESSION_COOKIE,
         value=session_id,
         httponly=True,
-        max_age=86400,  # クッキーの有効期限（1日）
+        max_age=SESSION_TTL,  # クッキーの有効期限（1日）
         samesite="None",
         secure=True,
     )
@@ -228,27 +326,18 @@ def read_user(
 
 #ユーザー情報（ページ遷移後に毎回実行）
 @app.get("/users/info")
-def get_current_user(
-    request: Request, 
-    db: Session = Depends(get_db)
+async def get_current_user(
+    current: CurrentUser = Depends(require_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    print(request.headers)
-    print(request.cookies)
-    
-    # クッキーからセッションIDを取得
-    session_id = request.cookies.get("session_id")
-    if not session_id:
-        print(session_id)
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    user_id = get_session(session_id)
+    user_id = current.id
     
     # データベースからユーザー情報を取得
-    user = get_user(db,user_id)
+    user = await get_user_async(db,user_id)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    calendar = calendar_list(user_id,db)
+    calendar = await calendar_list_async(user_id,db)
     
     return {
         "user_info": {
@@ -261,39 +350,192 @@ def get_current_user(
 
 #ログアウト
 @app.post("/users/logout")
-def logout_user(request: Request, response: Response):
-    session_id = request.cookies.get("session_id")
+async def logout_user(request: Request, response: Response):
+    session_id = request.cookies.get(SESSION_COOKIE)
     
     if session_id:
-        delete_session(session_id)  # セッションをRedisから削除
+        await delete_session(session_id)  # セッションをRedisとプロセス内の記憶から削除
 
     # セッションIDをクッキーから削除
-    response.delete_cookie("session_id")
+    response.delete_cookie(SESSION_COOKIE)
     return {"detail": "Logged out successfully"}
 
 #チャット検索
+# mode=hybrid（既定）: FAISS と語句一致（科目・教員・講義要約）の順位を統合する / mode=vector: FAISS 検索のみ
+# rewrite=auto（既定）: 短い入力や講義名・教員名に一致する入力は書き換えずに埋め込み、確信度が低いときだけLLMで書き換える
+# rewrite=always: 常に書き換える / rewrite=never: 書き換えない。どの経路で検索したかは path で返す
+# /answer で返す講義数の上限
+ANSWER_MAX_K = 50
+
+def check_answer_options(mode: str, rewrite: str):
+    if mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail=f"mode は {', '.join(SEARCH_MODES)} のいずれかを指定してください")
+    if rewrite not in REWRITE_MODES:
+        raise HTTPException(status_code=400, detail=f"rewrite は {', '.join(REWRITE_MODES)} のいずれかを指定してください")
+
+def rewritten_input(question, path):
+    """chat_log の generated_input に残す値。LLMで書き換えていなければ None（入力のままの組を書き換え結果として残さない）"""
+    return question if path == "rewrite" else None
+
+async def search_answer(id_mask, text, k, mode, rewrite, on_token=None):
+    """(講義IDのリスト, 埋め込んだクエリ, 経路, 確信度) を返す"""
+    if mode == "hybrid":
+        return await hybrid_search_async(id_mask, text, k=k, rewrite=rewrite, on_token=on_token)
+    return await adaptive_search_async(id_mask, text, k=k, rewrite=rewrite, on_token=on_token)
+
 @app.post("/answer/{text}")
-async def get_answer(request: Request,text: str,searchrequest: SearchRequest, calendar_id:int, db: Session = Depends(get_db)):
-    id_list = filter_course_ids(db, searchrequest)
-    question = generate_input(text)
-    answer = subset_search_batch(id_list,question)
-    
-    user_id = get_userid(request)
-    print(user_id)
+async def get_answer(request: Request,text: str,searchrequest: SearchRequest, calendar_id:int, k: int = Query(9, ge=1, le=ANSWER_MAX_K), mode: str = "hybrid", rewrite: str = ANSWER_REWRITE_MODE, db: AsyncSession = Depends(get_async_db), user: CurrentUser = Depends(current_user)):
+    check_answer_options(mode, rewrite)
+
+    # 同期処理はスレッドプールで実行し、イベントループを止めない
+    id_mask = await run_blocking(filter_course_mask, None, searchrequest)
+    answer, question, path, confidence = await search_answer(id_mask, text, k, mode, rewrite)
     
-    owner_id = get_calendar(calendar_id,db).user_id
-    print(owner_id)
+    user_id = user.id
     
-    print(owner_id == user_id)
-    if not owner_id == user_id:
-        calendar_id = 0
-    print(calendar_id)
+    # 他人のカレンダーなら登録済みの判定はしない
+    calendar_id = await own_calendar_id(calendar_id, user, db)
     
-    insert_chat(user_id,text,question,answer,db)
-    kougi_summary = get_kougi_summary(answer,db)
-    results = read_db(db, answer, calendar_id)
-    print(results)
-    return {"generated_input":question,"results": results,"kougi_summary":kougi_summary}
+    # chat_log はキューに積むだけで、書き込みは応答の後で行われる
+    log_chat(user_id, text, rewritten_input(question, path), answer)
+    kougi_summary = await get_kougi_summary_async(answer, db)
+    results = await read_db_async(db, answer, calendar_id)
+    return {"generated_input":question,"results": results,"kougi_summary":kougi_summary,"path":path,"confidence":confidence}
+
+
+def sse_event(event: str, data) -> str:
+    """Server-Sent Events の1イベント分の文字列"""
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data), ensure_ascii=False)}\n\n"
+
+#チャット検索（ストリーミング版）
+# /answer と同じ検索を行い、結果ができた順に Server-Sent Events で送る
+#   token   : LLM による書き換えのトークン（書き換える経路のときのみ）
+#   query   : 検索に使ったクエリと経路 {"generated_input", "path", "confidence"}
+#   results : 講義の一覧（/answer の results と同じ）
+#   summary : 講義要約（/answer の kougi_summary と同じ）
+#   done / error
+@app.post("/answer/{text}/stream")
+async def stream_answer(request: Request,text: str,searchrequest: SearchRequest, calendar_id:int, k: int = Query(9, ge=1, le=ANSWER_MAX_K), mode: str = "hybrid", rewrite: str = ANSWER_REWRITE_MODE, db: AsyncSession = Depends(get_async_db), user: CurrentUser = Depends(current_user)):
+    check_answer_options(mode, rewrite)
+
+    # 所有者の確認と絞り込みは送信を始める前に済ませる
+    user_id = user.id
+    calendar_id = await own_calendar_id(calendar_id, user, db)
+    id_mask = await run_blocking(filter_course_mask, None, searchrequest)
+
+    async def events():
+        queue = asyncio.Queue()
+
+        async def on_token(token):
+            await queue.put(sse_event("token", {"text": token}))
+
+        search = asyncio.create_task(search_answer(id_mask, text, k, mode, rewrite, on_token=on_token))
+        try:
+            # 検索が終わるまでは、届いた書き換えのトークンをそのまま送る
+            while not search.done() or not queue.empty():
+                getter = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({getter, search}, return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    yield getter.result()
+                else:
+                    getter.cancel()
+
+            answer, question, path, confidence = search.result()
+            log_chat(user_id, text, rewritten_input(question, path), answer)
+            yield sse_event("query", {"generated_input": question, "path": path, "confidence": confidence})
+
+            # 依存性の DB セッションは送信前に閉じられるので、送信中は別のセッションを使う
+            async with AsyncSessionLocal() as stream_db:
+                results = await read_db_async(stream_db, answer, calendar_id)
+                yield sse_event("results", results)
+                kougi_summary = await get_kougi_summary_async(answer, stream_db)
+                yield sse_event("summary", kougi_summary)
+            yield sse_event("done", {})
+        except SearchIndexNotReady:
+            yield sse_event("error", {"detail": "Search index is not ready yet. Please retry shortly."})
+        except Exception as e:
+            # 例外の内容（SQLやOpenAIのエラー）はクライアントに送らず、サーバーのログにだけ残す
+            print(f"❌ ストリーミング検索中にエラーが発生しました: {e!r}")
+            traceback.print_exc()
+            yield sse_event("error", {"detail": "An unexpected error occurred."})
+        finally:
+            search.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # nginx にバッファさせず、イベントをすぐにクライアントへ届ける
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+#キャッシュの統計情報（ヒット率の確認用）
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return {"rewrite": rewrite_cache.stats(), "embedding": embedding_service.stats(), "public_calendar": public_calendar_cache.stats()}
+
+
+#DB接続プールの統計情報（checked_out が size + max_overflow に張り付く、wait_avg_ms が伸びる場合はプールが足りない）
+@app.get("/db/pool/stats")
+async def get_db_pool_stats():
+    return pool_stats()
+
+
+#書き込みキュー（chat_log など）の統計情報（dropped が増えていればキューが溢れている）
+@app.get("/write_behind/stats")
+async def get_write_behind_stats():
+    return writer_stats()
+
+
+#起動状態の確認（FAISSインデックスと講義カタログの読み込みが終わるまでは 503）
+@app.get("/ready")
+async def readiness_check():
+    engine = get_search_engine()
+    if engine is None and readiness["index"] != "loading":
+        # 起動時に読み込めなかったインデックスも、ファイルが置かれていれば読み込む
+        try:
+            engine = await run_blocking(refresh_search_engine)
+            readiness["index"] = "ready"
+        except SearchIndexNotReady:
+            pass
+        except Exception as e:
+            print(f"❌ FAISSインデックスの読み込み中にエラーが発生しました: {e}")
+    ready = engine is not None and readiness["catalog"] == "ready"
+    content = {
+        "status": "ready" if ready else "not_ready",
+        "index": describe_engine(engine) if engine else {"status": readiness["index"]},
+        "catalog": {"status": readiness["catalog"]},
+        "errors": readiness["errors"],
+    }
+    return JSONResponse(status_code=200 if ready else 503, content=content)
+
+
+#FAISSインデックスの即時差し替え（faiss_update_index.py 実行後に呼ぶ。呼ばなくても数秒で自動的に切り替わる）
+def check_admin_token(request: Request):
+    """管理用APIの認証（ヘッダー X-Admin-Token が環境変数 ADMIN_TOKEN と一致すること）"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or request.headers.get("X-Admin-Token") != admin_token:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.post("/admin/index/reload")
+async def reload_search_index(request: Request):
+    check_admin_token(request)
+
+    engine = await run_blocking(refresh_search_engine, True)
+    readiness["index"] = "ready"
+    return {"ntotal": engine.ntotal, "version": engine.version}
+
+
+#講義カタログの読み直し（このプロセスはすぐに、他のプロセスは版の確認時（CATALOG_CHECK_INTERVAL 秒以内）に読み直す）
+@app.post("/admin/catalog/reload")
+async def reload_course_catalog(request: Request):
+    check_admin_token(request)
+
+    version = await run_blocking(bump_catalog_version)
+    catalog = await run_blocking(load_course_catalog, None, version)
+    readiness["catalog"] = "ready"
+    return {"courses": len(catalog), "version": catalog.version}
 
 
 #講義要約文章確認
@@ -306,25 +548,19 @@ def api_get_kougi_summary(kougi_ids: list[int], db: Session = Depends(get_db)):
 
 # シラバス検索
 @app.post("/search")
-async def search_courses(request: Request,searchrequest: SearchRequest, calendar_id:int, db: Session = Depends(get_db)):
-    id_list = filter_course_ids(db, searchrequest)
-    
-    user_id = get_userid(request)
+async def search_courses(request: Request,searchrequest: SearchRequest, calendar_id:int, db: AsyncSession = Depends(get_async_db), user: CurrentUser = Depends(current_user)):
+    id_list = await filter_course_ids_async(searchrequest)
     
-    owner_id = get_calendar(calendar_id,db).user_id
-    if not owner_id == user_id:
-        calendar_id = 0
+    calendar_id = await own_calendar_id(calendar_id, user, db)
     
-    results = read_db(db,id_list,calendar_id)
-    print(sys.getrefcount(results)) 
-    print(results)
+    results = await read_db_async(db,id_list,calendar_id)
     return {"results": results}
 
 
 #カレンダー作成・更新
 @app.post("/calendar/c-u/{mode}")
-def calendar_action_cu(request: Request, mode: str, calendar_data: UserCalendarModel, db: Session = Depends(get_db)):
-    user_id = get_userid(request)
+def calendar_action_cu(request: Request, mode: str, calendar_data: UserCalendarModel, db: Session = Depends(get_db), user: CurrentUser = Depends(current_user)):
+    user_id = user.id
     try:
         if mode == "c":
             if not calendar_data.user_id == user_id:
@@ -332,9 +568,7 @@ def calendar_action_cu(request: Request, mode: str, calendar_data: UserCalendarM
             calendar = create_calendar(calendar_data,db)
             
         elif mode == "u":
-            owner_id = get_calendar(calendar_data.id,db).user_id
-            if not owner_id == user_id:
-                return {"detail":"not login"}
+            own_calendar(calendar_data.id, user, db)
             calendar = update_calendar(calendar_data,db)
             
         else:
@@ -345,21 +579,21 @@ def calendar_action_cu(request: Request, mode: str, calendar_data: UserCalendarM
         print(calendar)
         return {"calendar":calendar}
     
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()  # 例外発生時にロールバック
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")        
 
 #カレンダー参照・削除
 @app.post("/calendar/r-d/{mode}")
-def calendar_action_rd(request: Request, mode: str, user_id:int, calendar_id: int, db: Session = Depends(get_db)):
-    user_id = get_userid(request)
+def calendar_action_rd(request: Request, mode: str, user_id:int, calendar_id: int, db: Session = Depends(get_db), user: CurrentUser = Depends(current_user)):
+    user_id = user.id
     try:
         if mode == "r":
             calendar = get_calendar(calendar_id, db)
         elif mode == "d":
-            owner_id = get_calendar(calendar_id,db).user_id
-            if not owner_id == user_id:
-                return {"detail":"not login"}
+            own_calendar(calendar_id, user, db)
             calendar = delete_calendar(calendar_id, db)
             calendar_id = None
         else:
@@ -370,6 +604,8 @@ def calendar_action_rd(request: Request, mode: str, user_id:int, calendar_id: in
         print(calendar_id)
         return {"calendar":calendar}
         
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()  # 例外発生時にロールバック
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")    
@@ -381,34 +617,27 @@ def api_check_user_kougi(
     request: Request,
     kougi_ids: list[int],
     calendar_id: int,
-    db: Session = Depends(get_db)  
+    db: Session = Depends(get_db),
+    calendar: user_calendar = Depends(require_own_calendar)
 ):
     print("Request Headers:", request.headers)
     print("Request Cookies:", request.cookies)
     success = []
     failures = []
     errors = []
-    user_id = get_userid(request)
-    
-    owner_id = get_calendar(calendar_id,db).user_id
-    if not owner_id == user_id:
-        return {"detail":"not login"}
-            
-    for kougi_id in kougi_ids:
-        try:
-            id_list = get_matching_kougi_ids(db, kougi_id, calendar_id)
-            
-            if id_list == []:
-                insert_user_kougi(db, kougi_id, calendar_id) 
-                success.append({"kougi_id": kougi_id})
-            
-            elif id_list:
-                obstacles = read_db(db, id_list,calendar_id)
-                print(failures)
-                failures.append({"kougi_id": kougi_id, "obstacles": obstacles})
-                print(failures)
-        except Exception as e:
-            errors.append({"kougi_id": kougi_id, "error": str(e)})
+
+    # 重複の判定と登録はまとめて行う（同じリクエストの講義どうしの重複も判定される）
+    result = register_user_kougi_batch(db, kougi_ids, calendar_id)
+    success = [{"kougi_id": kougi_id} for kougi_id in result["registered"]]
+    errors = result["errors"]
+
+    # 重なった講義の情報はまとめて1回で取得する
+    obstacle_ids = [other for _, others in result["conflicts"] for other in others]
+    kougi_by_id = {kougi["id"]: kougi for kougi in read_db(db, obstacle_ids, calendar_id)}
+    for kougi_id, others in result["conflicts"]:
+        obstacles = [kougi_by_id[other] for other in others if other in kougi_by_id]
+        failures.append({"kougi_id": kougi_id, "obstacles": obstacles})
+    print(failures)
             
     return {"success": success, "failures": failures,"errors":errors}
 
@@ -420,15 +649,11 @@ def api_delete_user_kougi(
     request: Request,
     kougi_ids: list[int],
     calendar_id: int,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    calendar: user_calendar = Depends(require_own_calendar)
 ):
     print("Request Headers:", request.headers)
     print("Request Cookies:", request.cookies)
-    user_id = get_userid(request)
-    
-    owner_id = get_calendar(calendar_id,db).user_id
-    if not owner_id == user_id:
-        return {"detail":"not login"}
             
     for kougi_id in kougi_ids:
         delete_user_kougi(db, kougi_id, calendar_id)
@@ -475,54 +700,67 @@ async def get_departments():
 async def get_semesters():
     return {"semesters": SEMESTERS}
 
+# 公開カレンダーの1ページの件数（既定と上限）
+PUBLIC_CALENDAR_PAGE_SIZE = int(os.getenv("PUBLIC_CALENDAR_PAGE_SIZE", "50"))
+PUBLIC_CALENDAR_MAX_PAGE_SIZE = 200
+
+def public_calendar_page(db, cursor, limit, **filters):
+    """公開カレンダーの1ページ分を JSON にできる dict で返す（Redis に短時間キャッシュする）"""
+    limit = max(1, min(limit or PUBLIC_CALENDAR_PAGE_SIZE, PUBLIC_CALENDAR_MAX_PAGE_SIZE))
+
+    def load():
+        calendars, next_cursor = search_public_calendars(db, cursor=cursor, limit=limit, **filters)
+        return {
+            "calendars": [UserCalendarModel.model_validate(cal).model_dump() for cal in calendars],
+            "next_cursor": next_cursor,
+        }
+
+    return cached_public_calendars("page", {**filters, "cursor": cursor, "limit": limit}, load)
+
 # 公開されているカレンダー一覧を取得（後輩閲覧用）
+# 新しい順に limit 件ずつ返す。続きは next_cursor を cursor に渡して取得する
 @app.get("/calendar/public")
-def get_public_calendars(db: Session = Depends(get_db)):
-    calendars = db.query(user_calendar).filter(user_calendar.is_public == True).all()
-    return {"public_calendars": calendars}
+def get_public_calendars(cursor: Optional[int] = None, limit: Optional[int] = None, db: Session = Depends(get_db)):
+    page = public_calendar_page(db, cursor, limit)
+    return {"public_calendars": page["calendars"], "next_cursor": page["next_cursor"]}
+
+# 公開カレンダーの統計情報API（オプション）
+# /calendar/public/{calendar_id} より先に定義する（後にすると "stats" がカレンダーIDとして扱われる）
+@app.get("/calendar/public/stats")
+def get_public_calendar_stats_endpoint(db: Session = Depends(get_db)):
+    """
+    公開カレンダーの統計情報を取得
+    - 学部別の公開数
+    - キャンパス別の公開数
+    - 学期別の公開数
+    カレンダーの変更のたびに Redis の集計を更新しているので、ここでは読むだけ
+    """
+    total, counts = get_public_calendar_stats(db)
+    
+    return {
+        "total_public": total,
+        "by_department": counts["department"],
+        "by_campus": counts["campus"],
+        "by_semester": counts["semester"]
+    }
 
 # 公開カレンダー詳細取得
+# ETag はカレンダーの版から作るので、If-None-Match が一致すれば MySQL に問い合わせずに 304 を返す
 @app.get("/calendar/public/{calendar_id}")
-def get_public_calendar_detail(calendar_id: int, db: Session = Depends(get_db)):
+def get_public_calendar_detail_endpoint(calendar_id: int, request: Request, db: Session = Depends(get_db)):
     """
     公開されたカレンダーの詳細情報と登録講義を取得するAPI
     """
-    from models import user_calendar, user_kougi, aoyama_kougi
-
-    # カレンダーを取得
-    calendar = db.query(user_calendar).filter(user_calendar.id == calendar_id).first()
-    if not calendar:
-        raise HTTPException(status_code=404, detail="Calendar not found")
-
-    if not calendar.is_public:
-        raise HTTPException(status_code=403, detail="This calendar is not public")
-
-    # 講義を取得
-    registered = db.query(user_kougi).filter(user_kougi.calendar_id == calendar_id).all()
-
-    # 講義の詳細情報をまとめる
-    lecture_data = []
-    for item in registered:
-        kougi = db.query(aoyama_kougi).filter(aoyama_kougi.id == item.kougi_id).first()
-        if kougi:
-            lecture_data.append({
-                "period": item.period,
-                "subject": kougi.科目,
-                "teacher": kougi.教員,
-                "semester": kougi.開講,
-                "url": kougi.url,
-            })
+    etag, confirmed = calendar_etag(calendar_id)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"} if etag else {}
+    # 304 は公開中と確かめ済みの版だけ（存在しない・非公開のカレンダーは毎回 404 / 403 になる）
+    if confirmed and etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
 
-    return {
-        "calendar_id": calendar.id,
-        "calendar_name": calendar.calendar_name,
-        "campus": calendar.campus,
-        "department": calendar.department,
-        "semester": calendar.semester,
-        "sat_flag": calendar.sat_flag,
-        "sixth_period_flag": calendar.sixth_period_flag,
-        "lectures": lecture_data
-    }
+    detail = cached_calendar_detail(calendar_id, etag, lambda: get_public_calendar_detail(db, calendar_id))
+    if etag and not confirmed:
+        confirm_calendar_version(calendar_id)
+    return JSONResponse(content=detail, headers=headers)
 
 # ---------------------------------------------------------
 # 公開カレンダーの検索・統計機能 (追加分)
@@ -537,12 +775,14 @@ class PublicScheduleSearchRequest(BaseModel):
 
 # 公開カレンダーの詳細検索API
 @app.post("/calendar/public/search")
-def search_public_calendars(
+def search_public_calendars_endpoint(
     search_request: PublicScheduleSearchRequest,
+    cursor: Optional[int] = None,
+    limit: Optional[int] = None,
     db: Session = Depends(get_db)
 ):
     """
-    公開されているカレンダーを条件で検索する
+    公開されているカレンダーを条件で検索する（新しい順に limit 件。続きは next_cursor を cursor に渡す）
     
     Parameters:
     - department: 学部名（部分一致）
@@ -550,40 +790,18 @@ def search_public_calendars(
     - semester: 学期（完全一致）
     - keyword: カレンダー名のキーワード（部分一致）
     """
-    
-    # 基本クエリ: 公開されているカレンダーのみ
-    query = db.query(user_calendar).filter(user_calendar.is_public == True)
-    
-    # すべてのカレンダーを取得してPythonでフィルタリング
-    all_calendars = query.all()
-    filtered_calendars = []
-    
-    for cal in all_calendars:
-        # 学部でフィルタリング
-        if search_request.department:
-            if not cal.department or search_request.department not in str(cal.department):
-                continue
-        
-        # キャンパスでフィルタリング
-        if search_request.campus:
-            if not cal.campus or search_request.campus not in cal.campus:
-                continue
-        
-        # 学期でフィルタリング
-        if search_request.semester:
-            if not cal.semester or search_request.semester not in cal.semester:
-                continue
-        
-        # キーワード検索（カレンダー名）
-        if search_request.keyword:
-            if not cal.calendar_name or search_request.keyword not in cal.calendar_name:
-                continue
-        
-        filtered_calendars.append(cal)
+    page = public_calendar_page(
+        db, cursor, limit,
+        department=search_request.department,
+        campus=search_request.campus,
+        semester=search_request.semester,
+        keyword=search_request.keyword,
+    )
     
     return {
-        "count": len(filtered_calendars),
-        "calendars": filtered_calendars,
+        "count": len(page["calendars"]),
+        "calendars": page["calendars"],
+        "next_cursor": page["next_cursor"],
         "search_params": {
             "department": search_request.department,
             "campus": search_request.campus,
@@ -592,47 +810,6 @@ def search_public_calendars(
         }
     }
 
-# 公開カレンダーの統計情報API（オプション）
-@app.get("/calendar/public/stats")
-def get_public_calendar_stats(db: Session = Depends(get_db)):
-    """
-    公開カレンダーの統計情報を取得
-    - 学部別の公開数
-    - キャンパス別の公開数
-    - 学期別の公開数
-    """
-    from sqlalchemy import func
-    
-    calendars = db.query(user_calendar).filter(user_calendar.is_public == True).all()
-    
-    # 学部別集計
-    dept_counts = {}
-    campus_counts = {}
-    semester_counts = {}
-    
-    for cal in calendars:
-        # 学部
-        if cal.department:
-            for dept in cal.department:
-                dept_counts[dept] = dept_counts.get(dept, 0) + 1
-        
-        # キャンパス
-        if cal.campus:
-            for cp in cal.campus:
-                campus_counts[cp] = campus_counts.get(cp, 0) + 1
-        
-        # 学期
-        if cal.semester:
-            for sem in cal.semester:
-                semester_counts[sem] = semester_counts.get(sem, 0) + 1
-    
-    return {
-        "total_public": len(calendars),
-        "by_department": dept_counts,
-        "by_campus": campus_counts,
-        "by_semester": semester_counts
-    }
-
 # ======== 時間割の公開設定API ========
 
 @app.put("/calendar/{calendar_id}/public")
@@ -640,28 +817,16 @@ def update_calendar_public(
     request: Request,
     calendar_id: int,
     is_public: bool,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    calendar: user_calendar = Depends(require_own_calendar)
 ):
     """
     時間割（user_calendar）の公開設定を変更するAPI
     - 認証済みユーザーのみ
-    - 自分のカレンダーだけ変更可能
+    - 自分のカレンダーだけ変更可能（require_own_calendar が確かめ、db のカレンダーを渡す）
     """
-    user_id = get_userid(request)  # 現在のログインユーザーのIDを取得
-
-    # カレンダーを取得
-    calendar = get_calendar(calendar_id, db)
-    if not calendar:
-        raise HTTPException(status_code=404, detail="Calendar not found")
-
-    # 自分のカレンダーでなければ拒否
-    if calendar.user_id != user_id:
-        raise HTTPException(status_code=403, detail="You are not the owner of this calendar")
-
-    # 公開設定を更新
-    calendar.is_public = is_public
-    db.commit()
-    db.refresh(calendar)
+    # 公開設定を更新（統計・キャッシュへの反映も行われる）
+    calendar = set_calendar_public(calendar, is_public, db)
 
     return {
         "calendar_id": calendar.id,
@@ -670,45 +835,85 @@ def update_calendar_public(
     }
 
 # カレンダーのインポート（コピー）機能
+# コピーできるのは公開されているカレンダーか自分のカレンダー
 @app.post("/calendar/import/{source_calendar_id}")
 def import_calendar(
     request: Request,
     source_calendar_id: int,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    user: CurrentUser = Depends(current_user)
 ):
     # ログイン中のユーザーIDを取得
-    user_id = get_userid(request)
+    user_id = user.id
     if not user_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
     try:
         # コピー処理を実行
-        new_calendar = duplicate_calendar(db, user_id, source_calendar_id)
+        new_calendar_id = duplicate_calendars(db, [(user_id, source_calendar_id)])[0]
         
         # コピーしたカレンダーをデフォルトに設定（任意：すぐ使えるようにするならアリ）
-        update_user_def_calendar(user_id, new_calendar.id, db)
+        update_user_def_calendar(user_id, new_calendar_id, db)
         
-        return {"message": "Calendar imported successfully", "new_calendar_id": new_calendar.id}
+        return {"message": "Calendar imported successfully", "new_calendar_id": new_calendar_id}
     
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Import failed: {str(e)}")
 
+# 一度にコピーできるカレンダーの数
+CALENDAR_IMPORT_MAX = int(os.getenv("CALENDAR_IMPORT_MAX", "500"))
+
+# カレンダーの一括インポート
+# - user_ids なし: source_calendar_ids のカレンダーをすべてログイン中のユーザーにコピーする
+# - user_ids あり: source_calendar_ids の各カレンダーを user_ids の各ユーザーにコピーする（管理用。X-Admin-Token が必要）
+# 全件を1つのトランザクションでコピーし、どれか1つでも失敗すれば何もコピーしない
+@app.post("/calendar/import")
+def import_calendars(
+    request: Request,
+    import_request: CalendarImportRequest,
+    db: Session = Depends(get_db),
+    user: CurrentUser = Depends(current_user)
+):
+    if import_request.user_ids:
+        check_admin_token(request)
+        pairs = [(user_id, source_id) for source_id in import_request.source_calendar_ids for user_id in import_request.user_ids]
+        check_access = False
+    else:
+        if not user.is_authenticated:
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        pairs = [(user.id, source_id) for source_id in import_request.source_calendar_ids]
+        check_access = True
+
+    if len(pairs) > CALENDAR_IMPORT_MAX:
+        raise HTTPException(status_code=400, detail=f"一度にコピーできるのは {CALENDAR_IMPORT_MAX} 件までです")
+
+    try:
+        new_calendar_ids = duplicate_calendars(db, pairs, check_access=check_access)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Import failed: {str(e)}")
+
+    return {
+        "message": "Calendars imported successfully",
+        "imported": [
+            {"user_id": user_id, "source_calendar_id": source_id, "new_calendar_id": new_calendar_id}
+            for (user_id, source_id), new_calendar_id in zip(pairs, new_calendar_ids)
+        ],
+    }
+
 # 必修科目の一括登録API (新規追加)
 @app.post("/kougi/register_required")
 def api_register_required_courses(
     request: Request,
     calendar_id: int,
     grade: int,  # 学年を指定 (例: 1)
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    calendar: user_calendar = Depends(require_own_calendar)  # カレンダーの所有権確認
 ):
-    user_id = get_userid(request)
-    
-    # カレンダーの所有権確認
-    calendar = get_calendar(calendar_id, db)
-    if calendar.user_id != user_id:
-        raise HTTPException(status_code=403, detail="Not authorized")
-
     # カレンダーに設定されている学部を取得 (リストの1つ目を使用すると仮定)
     if not calendar.department or len(calendar.department) == 0:
         raise HTTPException(status_code=400, detail="学部が設定されていません")
@@ -727,34 +932,15 @@ def api_register_required_courses(
     if not required_courses:
         return {"message": "該当する必修科目が見つかりませんでした。", "count": 0}
 
-    registered_count = 0
-    skipped_count = 0
-    errors = []
-
-    # 講義登録処理 (既存の /kougi/insert のロジックを流用)
-    for course in required_courses:
-        try:
-            kougi_id = course.kougi_id
-            
-            # 重複チェック (同じ時限に既に授業があるか)
-            id_list = get_matching_kougi_ids(db, kougi_id, calendar_id)
-            
-            if id_list == []:
-                # 重複がなければ登録
-                insert_user_kougi(db, kougi_id, calendar_id)
-                registered_count += 1
-            else:
-                # 重複がある場合はスキップ (既に登録済みの場合も含む)
-                skipped_count += 1
-                
-        except Exception as e:
-            errors.append({"kougi_id": kougi_id, "error": str(e)})
+    # 講義登録処理 (/kougi/insert と同じ一括登録)
+    # 同じ時限に既に授業がある講義はスキップ (既に登録済みの場合も含む)
+    result = register_user_kougi_batch(db, [course.kougi_id for course in required_courses], calendar_id)
 
     return {
         "message": "処理完了",
-        "registered": registered_count,
-        "skipped": skipped_count,
-        "errors": errors
+        "registered": len(result["registered"]),
+        "skipped": len(result["conflicts"]),
+        "errors": result["errors"]
     }
 
 
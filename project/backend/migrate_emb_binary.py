@@ -0,0 +1,102 @@
+import argparse
+import time
+from db_config import create_db_connection  # DB接続をインポート
+from emb_codec import VECTOR_DTYPES, DEFAULT_VECTOR_DTYPE, encode_vector, decode_json_vector
+
+# 1回のSELECT/UPDATEで扱う件数
+BATCH_SIZE = 500
+
+NEW_COLUMNS = {
+    "openai_emb_bin": "BLOB",
+    "openai_emb_dtype": "VARCHAR(4)",
+}
+
+
+def add_binary_columns(cursor):
+    """aoyama_openai_emb にバイナリ列がなければ追加する"""
+    cursor.execute(
+        """
+        SELECT COLUMN_NAME FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'aoyama_openai_emb'
+        """
+    )
+    existing = {row['COLUMN_NAME'] for row in cursor.fetchall()}
+    for name, column_type in NEW_COLUMNS.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE aoyama_openai_emb ADD COLUMN {name} {column_type}")
+            print(f"列 {name} を追加しました。")
+
+
+def backfill(connection, dtype, batch_size):
+    """openai_emb（JSON）からバイナリ列を埋める。講義ID順に batch_size 件ずつ処理する"""
+    converted = 0
+    last_id = 0
+    started = time.perf_counter()
+    with connection.cursor() as cursor:
+        while True:
+            cursor.execute(
+                """
+                SELECT aoyama_kougi_id, openai_emb FROM aoyama_openai_emb
+                WHERE aoyama_kougi_id > %s AND openai_emb_bin IS NULL AND openai_emb IS NOT NULL
+                ORDER BY aoyama_kougi_id
+                LIMIT %s
+                """,
+                (last_id, batch_size),
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            cursor.executemany(
+                "UPDATE aoyama_openai_emb SET openai_emb_bin = %s, openai_emb_dtype = %s WHERE aoyama_kougi_id = %s",
+                [
+                    (encode_vector(decode_json_vector(row['openai_emb']), dtype), dtype, row['aoyama_kougi_id'])
+                    for row in rows
+                ],
+            )
+            connection.commit()
+
+            converted += len(rows)
+            last_id = rows[-1]['aoyama_kougi_id']
+            print(f"  {converted:,} 件を変換しました（{time.perf_counter() - started:.1f}秒）")
+    return converted
+
+
+def drop_json(connection):
+    """バイナリ列に移行済みの行のJSONを消して容量を空ける"""
+    with connection.cursor() as cursor:
+        cursor.execute("UPDATE aoyama_openai_emb SET openai_emb = NULL WHERE openai_emb_bin IS NOT NULL")
+        cleared = cursor.rowcount
+    connection.commit()
+    return cleared
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="aoyama_openai_emb.openai_emb（JSON）をバイナリ列 openai_emb_bin に移行する"
+    )
+    parser.add_argument("--dtype", choices=list(VECTOR_DTYPES), default=DEFAULT_VECTOR_DTYPE,
+                        help="保存する型（f4: float32 / f2: float16）")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--drop-json", action="store_true",
+                        help="移行後にJSON列をNULLにする（OPTIMIZE TABLE で領域が解放される）")
+    args = parser.parse_args()
+
+    connection = create_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            add_binary_columns(cursor)
+        connection.commit()
+
+        converted = backfill(connection, args.dtype, args.batch_size)
+        print(f"✅ {converted} 件をバイナリ列に移行しました。")
+
+        if args.drop_json:
+            cleared = drop_json(connection)
+            print(f"✅ {cleared} 件のJSONを削除しました。領域の解放には OPTIMIZE TABLE aoyama_openai_emb を実行してください。")
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, Integer, String,Float,Text, ForeignKey, PrimaryKeyConstraint,JSON,DateTime
+from sqlalchemy import Boolean, Column, Integer, String,Float,Text, ForeignKey, PrimaryKeyConstraint,JSON,DateTime,LargeBinary,Index
 from database import Base
 
 class User(Base):
@@ -23,6 +23,24 @@ class aoyama_kougi(Base):
     メッセージ = Column(Text)
     url = Column(Text)
     
+class kougi_slot(Base):
+    """aoyama_kougi.時限 を登録時に分解したもの（1コマ1行）。絞り込みは 時限 の部分一致ではなくこの表の索引で行う"""
+    __tablename__ = "kougi_slot"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kougi_id = Column(Integer, nullable=False, index=True)
+    label = Column(String(50))      # 「（」の直前2文字（"月１"、"不定" など）。user_kougi.period と同じ値
+    day = Column(String(1))         # 曜日（月～土）。曜日・時限で表せないコマは NULL
+    period = Column(Integer)        # 時限（1～6）。同上
+    campus = Column(String(50))     # コマより前の直近の「[]」内のキャンパス
+    semester = Column(String(50))   # コマの「（）」内の学期（"前期"、"通年隔１" など）
+
+    __table_args__ = (
+        Index('idx_kougi_slot_day_period', 'day', 'period', 'kougi_id'),
+        Index('idx_kougi_slot_campus', 'campus', 'kougi_id'),
+        Index('idx_kougi_slot_semester', 'semester', 'kougi_id'),
+    )
+
 class chat_log(Base):
     __tablename__ = "chat_log"
     
@@ -38,7 +56,9 @@ class aoyama_openai_emb(Base):
     
     aoyama_kougi_id = Column(Integer, primary_key=True, autoincrement=True)
     audi_text = Column(Text)
-    openai_emb = Column(JSON)
+    openai_emb = Column(JSON)  # 旧形式（JSON）。migrate_emb_binary.py でバイナリ列へ移行する
+    openai_emb_bin = Column(LargeBinary)  # リトルエンディアンのfloat32/float16の生バイト列
+    openai_emb_dtype = Column(String(4))  # "f4" / "f2"
     
 class user_calendar(Base):
     __tablename__ = "user_calendar"
@@ -51,6 +71,11 @@ class user_calendar(Base):
     sat_flag = Column(Boolean,default=True)
     sixth_period_flag = Column(Boolean,default=True)
     is_public = Column(Boolean, default=False)
+
+    __table_args__ = (
+        # 公開カレンダーの一覧・検索（is_public で絞り、IDの降順にページング）
+        Index('idx_user_calendar_public', 'is_public', 'id'),
+    )
     
     def __repr__(self):
         return f"<user_calendar(id={self.id})>"
@@ -1,7 +1,8 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import os
+import threading
+import time
 import numpy as np
-import faiss
 from dotenv import load_dotenv
 from database import SessionLocal
 from sqlalchemy.orm import Session
@@ -10,6 +11,11 @@ from models import aoyama_kougi
 from schemas import AoyamaKougiBase
 from crud import read_db
 from database import SessionLocal, engine, Base
+from async_utils import run_blocking
+from rewrite_cache import RewriteCache
+from embedding_service import embedding_service
+from vector_search import load_search_engine, SearchIndexNotReady
+from course_catalog import ids_to_mask
 
 # ec２サーバーで作成した.envファイルを読み込む。.envはgitignoreに追加
 load_dotenv()
@@ -24,12 +30,40 @@ def get_db():
 
 # OpenAIクライアントのインスタンスを作成
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-index = faiss.read_index("faiss_index.bin")
+# APIサーバーからはイベントループを止めないよう非同期クライアントを使う
+async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+# FAISSインデックス（講義IDつき）。faiss_update_index.py でファイルが差し替えられたら読み込み直す
+FAISS_INDEX_PATH = os.getenv(
+    "FAISS_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "faiss_index.bin")
+)
+# 1 なら mmap で読み込み、複数ワーカー間でインデックスのメモリを共有する
+FAISS_MMAP = os.getenv("FAISS_MMAP", "0") == "1"
+# ファイルの更新を確認する間隔（秒）
+FAISS_INDEX_CHECK_INTERVAL = float(os.getenv("FAISS_INDEX_CHECK_INTERVAL", "10"))
+# インデックスはインポート時ではなく、APIの起動処理（lifespan）で load_search_index から読み込む
+search_engine = None
+_index_checked_at = 0.0
+_index_reload_lock = threading.Lock()
 
-def generate_input(text):
+# クエリ書き換え（LLM）の使い方。always: 常に書き換える / never: 入力をそのまま埋め込む /
+# auto: 短い入力（REWRITE_AUTO_MAX_CHARS 文字以下）はまず入力のまま検索し、確信度が REWRITE_CONFIDENCE_GAP 未満のときだけ書き換える
+REWRITE_MODES = ("auto", "always", "never")
+# /answer の rewrite の既定値
+ANSWER_REWRITE_MODE = os.getenv("ANSWER_REWRITE_MODE", "auto")
+REWRITE_AUTO_MAX_CHARS = int(os.getenv("REWRITE_AUTO_MAX_CHARS", "30"))
+REWRITE_CONFIDENCE_GAP = float(os.getenv("REWRITE_CONFIDENCE_GAP", "0.05"))
+# 確信度は1件目と何件目の類似度の差で測るか
+REWRITE_CONFIDENCE_K = int(os.getenv("REWRITE_CONFIDENCE_K", "9"))
+
+# クエリ書き換えプロンプトのバージョン。プロンプトを変更したら必ず更新すること（キャッシュが切り替わる）
+REWRITE_PROMPT_VERSION = "v1"
+rewrite_cache = RewriteCache(prompt_version=REWRITE_PROMPT_VERSION)
+
+
+def build_input_messages(text):
     # メッセージのリストを作成
-    messages = [
+    return [
         {"role": "system", "content": "あなたは教育ガイダンスの専門家です。"},
         {
             "role": "user",
@@ -61,24 +95,70 @@ def generate_input(text):
         }
     ]
 
+def generate_input(text):
+    # 同じ入力の書き換え結果があればLLMを呼ばずに返す
+    cached = rewrite_cache.get(text)
+    if cached is not None:
+        return cached
+
     # チャットコンプリーションの生成
     completion = client.chat.completions.create(
         model="gpt-4o-mini",  # 使用するモデルを指定
-        messages=messages,
+        messages=build_input_messages(text),
         temperature=0,
         max_tokens=1000  # 適切なトークン数に変更
     )
 
     # 生成されたテキストを返す
-    return completion.choices[0].message.content.strip()  # オブジェクトのプロパティとしてアクセス
+    generated = completion.choices[0].message.content.strip()  # オブジェクトのプロパティとしてアクセス
+    rewrite_cache.set(text, generated)
+    return generated
+
+async def generate_input_async(text, on_token=None):
+    # generate_input の非同期版（APIサーバー用）
+    # on_token（async 関数）を渡すと、生成されたトークンを届いた順に渡す（SSE での逐次表示用）
+    cached = await rewrite_cache.aget(text)
+    if cached is not None:
+        if on_token is not None:
+            await on_token(cached)
+        return cached
+
+    if on_token is None:
+        completion = await async_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=build_input_messages(text),
+            temperature=0,
+            max_tokens=1000
+        )
+        generated = completion.choices[0].message.content.strip()
+    else:
+        stream = await async_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=build_input_messages(text),
+            temperature=0,
+            max_tokens=1000,
+            stream=True
+        )
+        tokens = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            token = chunk.choices[0].delta.content
+            if token:
+                tokens.append(token)
+                await on_token(token)
+        generated = "".join(tokens).strip()
+
+    await rewrite_cache.aset(text, generated)
+    return generated
 
 def get_embedding(text):
-    response = client.embeddings.create(
-        model="text-embedding-3-small",  # モデル名を適切なものに変更
-        input=text
-    )
-    # 埋め込みベクトルを取得
-    return  np.array([response.data[0].embedding]).astype("float32")
+    # 埋め込みベクトルを取得（同じ文章はキャッシュから返る）
+    return embedding_service.embed(text)
+
+async def get_embedding_async(text):
+    # get_embedding の非同期版（APIサーバー用）
+    return await embedding_service.aembed(text)
 
 #絞り込みの確認用
 def get_shakai_joho_id(session: Session):
@@ -88,33 +168,152 @@ def get_shakai_joho_id(session: Session):
 
     return result
 
-#絞り込み対応
-def subset_search_batch(id_list, question):
+def load_search_index():
+    """FAISSインデックスを読み込む（起動時に1度だけ呼ぶ）"""
+    global search_engine, _index_checked_at
+    with _index_reload_lock:
+        search_engine = load_search_engine(FAISS_INDEX_PATH, mmap=FAISS_MMAP)
+        _index_checked_at = time.monotonic()
+    return search_engine
+
+def get_search_engine():
+    """読み込み済みの検索エンジンを返す（未読み込みなら None）"""
+    return search_engine
+
+def refresh_search_engine(force=False):
+    """
+    インデックスファイルが更新されていれば読み込み直し、検索エンジンを丸ごと差し替える。
+    差し替えは参照の付け替えだけなので、検索中のリクエストは古いエンジンのまま最後まで動く。
+    未読み込み（起動時の読み込みに失敗した場合など）なら、同じ間隔でファイルを確認し、現れた時点で読み込む。
+    """
+    global search_engine, _index_checked_at
+    now = time.monotonic()
+    if not force and now - _index_checked_at < FAISS_INDEX_CHECK_INTERVAL:
+        return _ready_search_engine()
+
+    # 起動時の読み込み中なら、終わるのを待たずに未準備として返す
+    if not _index_reload_lock.acquire(blocking=force or search_engine is not None):
+        return _ready_search_engine()
+    try:
+        _index_checked_at = now
+        try:
+            version = os.path.getmtime(FAISS_INDEX_PATH)
+        except OSError:
+            version = None
+        if version is not None and (force or search_engine is None or version != search_engine.version):
+            search_engine = load_search_engine(FAISS_INDEX_PATH, mmap=FAISS_MMAP)
+            print(f"✅ FAISSインデックスを読み込み直しました（{search_engine.ntotal} 件）。")
+    finally:
+        _index_reload_lock.release()
+    return _ready_search_engine()
+
+def _ready_search_engine():
+    if search_engine is None:
+        raise SearchIndexNotReady("FAISS index is not loaded yet")
+    return search_engine
+
+#絞り込み対応（講義IDのビットマップで絞り込む）
+def search_by_mask(id_mask, embedding, k=9):
+    return refresh_search_engine().search(embedding, k=k, id_mask=id_mask)
+
+def search_by_embedding(id_list, embedding, k=9):
+    id_mask = ids_to_mask(id_list)
+    return search_by_mask(id_mask, embedding, k=k)
+
+def search_with_distances_by_mask(id_mask, embedding, k=9):
+    return refresh_search_engine().search_with_distances(embedding, k=k, id_mask=id_mask)
+
+def search_confidence(distances):
+    """
+    検索結果の確信度。1件目と REWRITE_CONFIDENCE_K 件目のコサイン類似度の差で、大きいほど1件目が抜きん出ている。
+    候補が1件以下なら、どのクエリでも結果は変わらないので 1.0 とする。
+    """
+    if len(distances) < 2:
+        return 1.0
+    similarities = refresh_search_engine().similarities(distances[:REWRITE_CONFIDENCE_K])
+    return float(similarities[0] - similarities[-1])
+
+def _direct_path(text, rewrite, known_topic):
+    """入力のまま埋め込んで検索する場合の経路名（入力のまま検索しないなら None）"""
+    if rewrite == "always":
+        return None
+    if rewrite == "never":
+        return "direct"
+    # auto: 講義名・教員名に一致した入力と短い入力は、まず入力のまま検索する
+    if known_topic:
+        return "lexical"
+    if len(text.strip()) <= REWRITE_AUTO_MAX_CHARS:
+        return "direct"
+    return None
+
+def _keep_direct(rewrite, path, confidence):
+    """入力のままの検索結果を採用するか（auto の短い入力は、確信度が低ければ書き換えてやり直す）"""
+    return rewrite == "never" or path == "lexical" or confidence >= REWRITE_CONFIDENCE_GAP
+
+def adaptive_search(id_mask, text, k=9, rewrite="always", known_topic=False):
+    """
+    rewrite（auto / always / never）の方針で検索し、(講義IDのリスト, 埋め込んだクエリ, 経路, 確信度) を返す。
+    経路は "rewrite"（LLMで書き換えた）、"direct"（入力のまま）、"lexical"（講義名・教員名に一致したので入力のまま）。
+    確信度は入力のまま検索したときの search_confidence（入力のまま検索していなければ None）。
+    """
+    confidence = None
+    path = _direct_path(text, rewrite, known_topic)
+    if path:
+        ids, distances = search_with_distances_by_mask(id_mask, get_embedding(text), k)
+        confidence = search_confidence(distances)
+        if _keep_direct(rewrite, path, confidence):
+            return ids, text, path, confidence
+
+    question = generate_input(text)
+    ids, _ = search_with_distances_by_mask(id_mask, get_embedding(question), k)
+    return ids, question, "rewrite", confidence
+
+async def _resolve_known_topic(known_topic):
+    return known_topic if isinstance(known_topic, bool) else bool(await known_topic)
+
+async def adaptive_search_async(id_mask, text, k=9, rewrite="always", known_topic=False, on_token=None):
+    # adaptive_search の非同期版（APIサーバー用）。FAISS検索はスレッドプールで実行する
+    # on_token は書き換えのトークンを受け取る（generate_input_async と同じ）
+    # known_topic には判定中のタスク（結果が真なら講義名・教員名に一致）も渡せる。
+    # 判定の結果は経路を決めるのに必要になるまで待たない（短い入力なら入力のままの検索と並行して判定できる）
+    confidence = None
+    if rewrite == "auto" and len(text.strip()) > REWRITE_AUTO_MAX_CHARS:
+        known_topic = await _resolve_known_topic(known_topic)
+    path = _direct_path(text, rewrite, known_topic is True)
+    if path:
+        embedding = await get_embedding_async(text)
+        ids, distances = await run_blocking(search_with_distances_by_mask, id_mask, embedding, k)
+        confidence = await run_blocking(search_confidence, distances)
+        if rewrite == "auto" and path == "direct" and await _resolve_known_topic(known_topic):
+            path = "lexical"
+        if _keep_direct(rewrite, path, confidence):
+            return ids, text, path, confidence
+
+    question = await generate_input_async(text, on_token=on_token)
+    embedding = await get_embedding_async(question)
+    ids, _ = await run_blocking(search_with_distances_by_mask, id_mask, embedding, k)
+    return ids, question, "rewrite", confidence
+
+def subset_search_batch(id_list, question, rewrite="never"):
+    # 既定（never）は question をそのまま埋め込む。auto / always なら question をユーザーの入力として書き換えも行う
     print(question)
-    # id_list のすべての値を 1 減算
-    id_list = [id - 1 for id in id_list]
-    sel = faiss.IDSelectorBatch(id_list)
-    params = faiss.SearchParametersIVF(sel=sel)
-    D,I = index.search(
-        get_embedding(question), k=9, params=params
-    )
-    # Iの各値に1を加算
-    incremented_ids = [id + 1 for sublist in I for id in sublist]  # 一次元リストにフラット化しつつ加算
-    return incremented_ids
+    return adaptive_search(ids_to_mask(id_list), question, rewrite=rewrite)[0]
+
+async def subset_search_async(id_mask, question, k=9):
+    # 埋め込みは非同期APIで取得し、FAISS検索はスレッドプールで実行する
+    embedding = await get_embedding_async(question)
+    return await run_blocking(search_by_mask, id_mask, embedding, k)
 
 #絞り込み未対応
 def index_search(question):
     print(question)
-    D,I = index.search(get_embedding(question), 3)#3件取得
-    # Iの各値に1を加算
-    incremented_ids = [id + 1 for sublist in I for id in sublist]  # 一次元リストにフラット化しつつ加算
-    return incremented_ids
-
+    return refresh_search_engine().search(get_embedding(question), k=3)#3件取得
 
 
 
 
 if __name__ == "__main__":
+    load_search_index()
     db = next(get_db()) 
     question = str(input())
     question = generate_input(question)
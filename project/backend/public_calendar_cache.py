@@ -0,0 +1,164 @@
+"""
+公開カレンダーの一覧・検索結果と詳細の Redis キャッシュ。
+
+一覧・検索のキーには公開カレンダーの版（public_calendar:version）を含める。
+公開設定の切り替えや公開中のカレンダーの更新・削除のたびに版を INCR するので、
+古い結果は参照されなくなり、PUBLIC_CALENDAR_CACHE_TTL 秒で消える。
+
+詳細はカレンダーごとの版（calendar:{id}:version）と講義カタログの版から ETag を作り、
+カレンダーや登録講義が変わるたびにカレンダーの版を INCR する。
+版は初めは PUBLIC_CALENDAR_VERSION_SEED_TTL 秒で消える仮のキーとして作り、
+公開中であることを確かめてから期限をなくす（存在しないIDを引かれても Redis が増え続けないように）。
+"""
+import hashlib
+import json
+import os
+import time
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+from redis_config import redis_sync_client
+from course_catalog import CATALOG_VERSION_KEY
+
+load_dotenv()
+
+# 検索結果をキャッシュする秒数
+PUBLIC_CALENDAR_CACHE_TTL = int(os.getenv("PUBLIC_CALENDAR_CACHE_TTL", "30"))
+# 公開カレンダーの版
+PUBLIC_CALENDAR_VERSION_KEY = "public_calendar:version"
+# 公開カレンダーの詳細をキャッシュする秒数（0で無効。ETag による 304 は有効のまま）
+PUBLIC_CALENDAR_DETAIL_CACHE_TTL = int(os.getenv("PUBLIC_CALENDAR_DETAIL_CACHE_TTL", "300"))
+
+# まだ公開中と確かめていないカレンダーの版を残しておく秒数
+PUBLIC_CALENDAR_VERSION_SEED_TTL = int(os.getenv("PUBLIC_CALENDAR_VERSION_SEED_TTL", "600"))
+
+counters = {"hits": 0, "misses": 0, "redis_errors": 0}
+
+
+def bump_public_calendar_version():
+    """公開カレンダーの一覧が変わったら呼ぶ。キャッシュ済みの結果はすべて使われなくなる"""
+    try:
+        return redis_sync_client.incr(PUBLIC_CALENDAR_VERSION_KEY)
+    except RedisError as e:
+        counters["redis_errors"] += 1
+        print(f"公開カレンダーの版の更新に失敗しました: {e}")
+        return None
+
+
+def cached_public_calendars(kind, params, loader):
+    """
+    loader() の結果（JSON にできる dict）を kind と params ごとにキャッシュして返す。
+    Redis に繋がらないときは毎回 loader() を呼ぶ。
+    """
+    try:
+        version = int(redis_sync_client.get(PUBLIC_CALENDAR_VERSION_KEY) or 0)
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+        key = f"public_calendar:{kind}:{version}:{digest}"
+        raw = redis_sync_client.get(key)
+    except RedisError:
+        counters["redis_errors"] += 1
+        return loader()
+
+    if raw is not None:
+        counters["hits"] += 1
+        return json.loads(raw)
+
+    counters["misses"] += 1
+    result = loader()
+    try:
+        redis_sync_client.setex(key, PUBLIC_CALENDAR_CACHE_TTL, json.dumps(result, ensure_ascii=False))
+    except RedisError:
+        counters["redis_errors"] += 1
+    return result
+
+
+def calendar_version_key(calendar_id):
+    return f"calendar:{calendar_id}:version"
+
+
+def _seed_calendar_version(pipe, key):
+    """版がまだなければ現在時刻（ミリ秒）から始める（Redis が空になっても以前の ETag と重ならないように）"""
+    pipe.set(key, int(time.time() * 1000), nx=True, ex=PUBLIC_CALENDAR_VERSION_SEED_TTL)
+
+
+def bump_calendar_version(calendar_id):
+    """カレンダーやその登録講義を変えたら呼ぶ（詳細の ETag が変わる）"""
+    key = calendar_version_key(calendar_id)
+    try:
+        # 期限つきの仮の版も INCR で期限はそのまま残る
+        pipe = redis_sync_client.pipeline(transaction=True)
+        _seed_calendar_version(pipe, key)
+        pipe.incr(key)
+        return pipe.execute()[-1]
+    except RedisError as e:
+        counters["redis_errors"] += 1
+        print(f"カレンダーの版の更新に失敗しました: {e}")
+        return None
+
+
+def forget_calendar_version(calendar_id):
+    """カレンダーを削除したら呼ぶ（版を消すので、以前の ETag で 304 が返ることはない）"""
+    try:
+        redis_sync_client.delete(calendar_version_key(calendar_id))
+    except RedisError as e:
+        counters["redis_errors"] += 1
+        print(f"カレンダーの版の削除に失敗しました: {e}")
+
+
+def calendar_etag(calendar_id):
+    """
+    カレンダーの詳細の ETag（カレンダーの版と講義カタログの版から作る）と、
+    その版が公開中と確かめ済み（期限のないキー）かどうかを返す。Redis に繋がらなければ (None, False)。
+    版がまだなければ期限つきの仮の版を作る（確かめ済みにはならない）。
+    """
+    key = calendar_version_key(calendar_id)
+    try:
+        pipe = redis_sync_client.pipeline(transaction=True)
+        _seed_calendar_version(pipe, key)
+        pipe.get(key)
+        pipe.ttl(key)
+        pipe.get(CATALOG_VERSION_KEY)
+        _, version, ttl, catalog_version = pipe.execute()
+    except RedisError:
+        counters["redis_errors"] += 1
+        return None, False
+    return f'"cal-{calendar_id}-{int(version)}-{int(catalog_version or 0)}"', ttl == -1
+
+
+def confirm_calendar_version(calendar_id):
+    """公開中のカレンダーの詳細を返せたら呼ぶ。版の期限をなくし、以降は同じ ETag に 304 を返せるようにする"""
+    try:
+        redis_sync_client.persist(calendar_version_key(calendar_id))
+    except RedisError:
+        counters["redis_errors"] += 1
+
+
+def cached_calendar_detail(calendar_id, etag, loader):
+    """loader() の結果（公開カレンダーの詳細）を ETag ごとにキャッシュして返す"""
+    if etag is None or PUBLIC_CALENDAR_DETAIL_CACHE_TTL <= 0:
+        return loader()
+
+    key = f"public_calendar:detail:{calendar_id}:{hashlib.sha256(etag.encode('utf-8')).hexdigest()[:16]}"
+    try:
+        raw = redis_sync_client.get(key)
+    except RedisError:
+        counters["redis_errors"] += 1
+        return loader()
+    if raw is not None:
+        counters["hits"] += 1
+        return json.loads(raw)
+
+    counters["misses"] += 1
+    result = loader()
+    try:
+        redis_sync_client.setex(key, PUBLIC_CALENDAR_DETAIL_CACHE_TTL, json.dumps(result, ensure_ascii=False))
+    except RedisError:
+        counters["redis_errors"] += 1
+    return result
+
+
+def stats():
+    lookups = counters["hits"] + counters["misses"]
+    return {
+        **counters,
+        "hit_rate": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+    }
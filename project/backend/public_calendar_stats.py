@@ -0,0 +1,158 @@
+"""
+公開カレンダーの統計（学部・キャンパス・学期ごとの公開数）を Redis のハッシュに持ち、少しずつ更新する。
+
+カレンダーの作成・更新・削除と公開設定の切り替えのたびに apply_calendar_change で差分だけを足し引きし、
+/calendar/public/stats はハッシュを読むだけで返す。
+Redis の障害や同時更新でずれた分は、rebuild_public_calendar_stats（定期実行）でDBから数え直して直す。
+定期実行は各ワーカーで動くが、Redis のロックを取れた1つだけが PUBLIC_STATS_RECONCILE_INTERVAL 秒に1回数え直す。
+"""
+import argparse
+import os
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+from database import SessionLocal
+from models import user_calendar
+from redis_config import redis_sync_client
+
+load_dotenv()
+
+# DBから数え直す間隔（秒）。0で無効
+PUBLIC_STATS_RECONCILE_INTERVAL = int(os.getenv("PUBLIC_STATS_RECONCILE_INTERVAL", "600"))
+
+# 集計する列と、その Redis のキー
+STATS_FIELDS = ("department", "campus", "semester")
+STATS_KEYS = {field: f"public_calendar:stats:{field}" for field in STATS_FIELDS}
+STATS_TOTAL_KEY = "public_calendar:stats:total"
+# 定期的な数え直しのロック（数え直したワーカーが取り、PUBLIC_STATS_RECONCILE_INTERVAL 秒で消える）
+STATS_RECONCILE_LOCK_KEY = "public_calendar:stats:reconcile_lock"
+
+
+def calendar_snapshot(calendar):
+    """集計に使う値（公開かどうかと学部・キャンパス・学期）の写し。calendar が None なら None"""
+    if calendar is None:
+        return None
+    snapshot = {"is_public": bool(calendar.is_public)}
+    for field in STATS_FIELDS:
+        snapshot[field] = list(getattr(calendar, field) or [])
+    return snapshot
+
+
+def apply_calendar_change(before, after):
+    """
+    カレンダーの変更前・変更後の calendar_snapshot から、公開数の差分を Redis に反映する。
+    作成は before=None、削除は after=None。失敗してもAPIは止めない（次の数え直しで直る）。
+    """
+    deltas = {field: {} for field in STATS_FIELDS}
+    total = 0
+    for snapshot, sign in ((before, -1), (after, 1)):
+        if not snapshot or not snapshot["is_public"]:
+            continue
+        total += sign
+        for field in STATS_FIELDS:
+            for value in snapshot[field]:
+                deltas[field][value] = deltas[field].get(value, 0) + sign
+
+    if not total and not any(delta for values in deltas.values() for delta in values.values()):
+        return
+
+    try:
+        pipe = redis_sync_client.pipeline(transaction=True)
+        if total:
+            pipe.incrby(STATS_TOTAL_KEY, total)
+        for field, values in deltas.items():
+            for value, delta in values.items():
+                if delta:
+                    pipe.hincrby(STATS_KEYS[field], value, delta)
+        pipe.execute()
+    except RedisError as e:
+        print(f"公開カレンダーの統計の更新に失敗しました: {e}")
+
+
+def count_public_calendar_stats(db):
+    """DBの公開カレンダーから統計を数える"""
+    counts = {field: {} for field in STATS_FIELDS}
+    rows = db.query(
+        user_calendar.department, user_calendar.campus, user_calendar.semester,
+    ).filter(user_calendar.is_public == True).all()
+    for row in rows:
+        for field in STATS_FIELDS:
+            for value in getattr(row, field) or []:
+                counts[field][value] = counts[field].get(value, 0) + 1
+    return len(rows), counts
+
+
+def rebuild_public_calendar_stats(db=None):
+    """DBから数え直して Redis の統計を置き換える（読み手には置き換え前か後のどちらかだけが見える）"""
+    session = db or SessionLocal()
+    try:
+        total, counts = count_public_calendar_stats(session)
+    finally:
+        if db is None:
+            session.close()
+
+    pipe = redis_sync_client.pipeline(transaction=True)
+    pipe.delete(*STATS_KEYS.values())
+    for field, values in counts.items():
+        if values:
+            pipe.hset(STATS_KEYS[field], mapping=values)
+    pipe.set(STATS_TOTAL_KEY, total)
+    pipe.execute()
+    return total, counts
+
+
+def reconcile_public_calendar_stats(interval=PUBLIC_STATS_RECONCILE_INTERVAL):
+    """
+    定期的な数え直し。ロック（SET NX EX）を取れたときだけ数え直して (total, counts) を返し、
+    interval 秒以内に他のワーカーが数え直していれば何もせずに None を返す。
+    """
+    if not redis_sync_client.set(STATS_RECONCILE_LOCK_KEY, os.getpid(), nx=True, ex=max(int(interval), 1)):
+        return None
+    return rebuild_public_calendar_stats()
+
+
+def read_public_calendar_stats():
+    """Redis から統計を読む。まだ数えていなければ None"""
+    pipe = redis_sync_client.pipeline(transaction=False)
+    pipe.get(STATS_TOTAL_KEY)
+    for field in STATS_FIELDS:
+        pipe.hgetall(STATS_KEYS[field])
+    total, *hashes = pipe.execute()
+    if total is None:
+        return None
+
+    counts = {}
+    for field, values in zip(STATS_FIELDS, hashes):
+        # 差分で 0 になった値は返さない
+        counts[field] = {
+            key.decode("utf-8"): int(count) for key, count in values.items() if int(count) > 0
+        }
+    return int(total), counts
+
+
+def get_public_calendar_stats(db=None):
+    """統計を返す。Redis にまだなければDBから数えて作る。Redis に繋がらないときはDBから数えて返す"""
+    try:
+        stats = read_public_calendar_stats()
+        if stats is None:
+            stats = rebuild_public_calendar_stats(db)
+        return stats
+    except RedisError as e:
+        print(f"公開カレンダーの統計を Redis から読めないため、DBから数えます: {e}")
+
+    session = db or SessionLocal()
+    try:
+        return count_public_calendar_stats(session)
+    finally:
+        if db is None:
+            session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="公開カレンダーの統計をDBから数え直す")
+    parser.parse_args()
+    total, counts = rebuild_public_calendar_stats()
+    print(f"✅ 公開カレンダー {total:,} 件の統計を数え直しました（学部 {len(counts['department'])} 種類）。")
+
+
+if __name__ == "__main__":
+    main()
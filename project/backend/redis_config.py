@@ -0,0 +1,23 @@
+import os
+import redis
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+
+# ec２サーバーで作成した.envファイルを読み込む。.envはgitignoreに追加
+load_dotenv()
+
+# Redis接続の設定
+# タイムアウトを短めにしておき、Redisが不調でもAPIが固まらないようにする
+redisConfig = {
+    "host": os.getenv("REDIS_HOST", "redis"),
+    "port": int(os.getenv("REDIS_PORT", "6379")),
+    "db": int(os.getenv("REDIS_DB", "0")),
+    "socket_timeout": float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.5")),
+    "socket_connect_timeout": float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.5")),
+}
+
+# 同期クライアント（起動処理・バッチ処理用）
+redis_sync_client = redis.Redis(**redisConfig)
+
+# 非同期クライアント（APIのリクエスト処理用）
+redis_async_client = aioredis.Redis(**redisConfig)
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import re
+import unicodedata
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+from cache import LocalTTLCache
+from redis_config import redis_sync_client, redis_async_client
+
+load_dotenv()
+
+# キャッシュの有効期限（秒）。既定は30日
+REWRITE_CACHE_TTL = int(os.getenv("REWRITE_CACHE_TTL", str(60 * 60 * 24 * 30)))
+# プロセス内LRUに保持する件数
+REWRITE_CACHE_LOCAL_SIZE = int(os.getenv("REWRITE_CACHE_LOCAL_SIZE", "1024"))
+# これより長い入力は使い回される見込みが薄いのでキャッシュしない
+REWRITE_CACHE_MAX_INPUT_CHARS = int(os.getenv("REWRITE_CACHE_MAX_INPUT_CHARS", "200"))
+
+
+def normalize_query(text: str) -> str:
+    """全角/半角・大文字/小文字・空白の揺れを吸収したキャッシュ用の文字列を返す"""
+    text = unicodedata.normalize("NFKC", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.lower()
+
+
+class RewriteCache:
+    """
+    generate_input（LLMによるクエリ書き換え）の結果キャッシュ。
+    プロセス内LRU → Redis の順に参照し、どちらにもなければミスとして扱う。
+    temperature=0 で出力が決まるため、正規化した入力とプロンプトのバージョンをキーにする。
+    プロンプトのバージョンを上げると古い書き換え結果は参照されなくなり、REWRITE_CACHE_TTL で消える。
+    """
+
+    def __init__(self, prompt_version: str):
+        self.prompt_version = prompt_version
+        self.local = LocalTTLCache(REWRITE_CACHE_LOCAL_SIZE, REWRITE_CACHE_TTL)
+        self.counters = {
+            "local_hits": 0,
+            "redis_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "redis_errors": 0,
+        }
+
+    def make_key(self, text: str):
+        normalized = normalize_query(text)
+        if not normalized or len(normalized) > REWRITE_CACHE_MAX_INPUT_CHARS:
+            return None
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        return f"rewrite:{self.prompt_version}:{digest}"
+
+    def _lookup_local(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self.counters["local_hits"] += 1
+        return value
+
+    def _on_redis_value(self, key, raw):
+        if raw is None:
+            self.counters["misses"] += 1
+            return None
+        value = raw.decode("utf-8")
+        self.counters["redis_hits"] += 1
+        self.local.set(key, value)
+        return value
+
+    def get(self, text: str):
+        key = self.make_key(text)
+        if key is None:
+            self.counters["misses"] += 1
+            return None
+        value = self._lookup_local(key)
+        if value is not None:
+            return value
+        try:
+            raw = redis_sync_client.get(key)
+        except RedisError:
+            self.counters["redis_errors"] += 1
+            raw = None
+        return self._on_redis_value(key, raw)
+
+    async def aget(self, text: str):
+        key = self.make_key(text)
+        if key is None:
+            self.counters["misses"] += 1
+            return None
+        value = self._lookup_local(key)
+        if value is not None:
+            return value
+        try:
+            raw = await redis_async_client.get(key)
+        except RedisError:
+            self.counters["redis_errors"] += 1
+            raw = None
+        return self._on_redis_value(key, raw)
+
+    def set(self, text: str, generated: str):
+        key = self.make_key(text)
+        if key is None:
+            return
+        self.local.set(key, generated)
+        self.counters["stores"] += 1
+        try:
+            redis_sync_client.setex(key, REWRITE_CACHE_TTL, generated)
+        except RedisError:
+            self.counters["redis_errors"] += 1
+
+    async def aset(self, text: str, generated: str):
+        key = self.make_key(text)
+        if key is None:
+            return
+        self.local.set(key, generated)
+        self.counters["stores"] += 1
+        try:
+            await redis_async_client.setex(key, REWRITE_CACHE_TTL, generated)
+        except RedisError:
+            self.counters["redis_errors"] += 1
+
+    def stats(self):
+        hits = self.counters["local_hits"] + self.counters["redis_hits"]
+        lookups = hits + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "local_size": len(self.local),
+            "prompt_version": self.prompt_version,
+        }
@@ -48,4 +48,18 @@ class UserCalendarModel(BaseModel):
     is_public: bool = False  # ← 追加
     
     class Config:
-        from_attributes = True 
\ No newline at end of file
+        from_attributes = True 
+
+class CalendarImportRequest(BaseModel):
+    source_calendar_ids: list[int]
+    # 空ならログイン中のユーザーにコピーする。他のユーザーへのコピーは管理用（X-Admin-Token が必要）
+    user_ids: list[int] = []
+
+class CurrentUser(BaseModel):
+    """リクエストのログインユーザー（auth.current_user が返す）。未ログインは id=0"""
+    id: int = 0
+    session_id: Optional[str] = None
+
+    @property
+    def is_authenticated(self) -> bool:
+        return self.id != 0
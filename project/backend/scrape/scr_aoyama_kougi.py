@@ -13,6 +13,8 @@ import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from db_config import create_db_connection
+from kougi_slots import CREATE_KOUGI_SLOT_SQL, replace_kougi_slots
+from course_catalog import bump_catalog_version
 
 
 # セットアップ
@@ -101,6 +103,8 @@ def insert_data_to_db(data):
             );
             """
             cursor.execute(create_table_query)
+            # 時限を分解したコマの表（検索の絞り込み用）
+            cursor.execute(CREATE_KOUGI_SLOT_SQL)
 
             # データを挿入
             insert_query = """
@@ -118,9 +122,13 @@ def insert_data_to_db(data):
                     entry.get('メッセージ'),
                     entry.get('url')
                 ))
+                # 時限はここで1回だけ分解して kougi_slot に入れておく
+                replace_kougi_slots(cursor, cursor.lastrowid, entry.get('時限'))
 
         # コミットして変更を反映
         connection.commit()
+        # 各APIプロセスの講義カタログを読み直させる
+        bump_catalog_version()
     finally:
         connection.close()
 
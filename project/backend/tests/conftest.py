@@ -0,0 +1,10 @@
+import os
+import sys
+
+# backend のモジュールは平置きなので、テストからもそのまま import できるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# database.py は import 時にエンジンを作る（接続はしない）ので、.env がなくても import できるようにする
+os.environ.setdefault("DB_PORT", "3306")
+# OpenAI のクライアントも import 時に作られる（テストでは API を呼ばない）
+os.environ.setdefault("OPENAI_API_KEY", "test")
@@ -0,0 +1,33 @@
+from sqlalchemy import create_engine
+import database
+
+# openai_search は import 時にテーブルを作る（create_all）ので、MySQL の代わりにメモリ上の SQLite に向ける
+database.engine = create_engine("sqlite://")
+
+import course_catalog
+import hybrid_search
+from hybrid_search import reciprocal_rank_fusion
+
+
+def test_rrf_sums_reciprocal_ranks():
+    # 2 は両方で2位、1 と 3 は片方だけで1位（1/61 + 1/62 > 1/61）
+    assert reciprocal_rank_fusion([[1, 2], [3, 2]], k=60) == [2, 1, 3]
+
+
+def test_rrf_ties_follow_the_first_ranking():
+    # 1 と 3、2 と 4 は同点。先に渡したリストの順位が優先される
+    assert reciprocal_rank_fusion([[1, 2], [3, 4]]) == [1, 3, 2, 4]
+    assert reciprocal_rank_fusion([[3, 4], [1, 2]]) == [3, 1, 4, 2]
+
+
+def test_rrf_handles_empty_rankings():
+    assert reciprocal_rank_fusion([[], [5, 6]]) == [5, 6]
+    assert reciprocal_rank_fusion([[], []]) == []
+
+
+def test_lexical_search_without_catalog_returns_nothing(monkeypatch):
+    # 講義カタログが読み込み中・読み込みに失敗したときは、FAISS の順位だけで答える
+    monkeypatch.setattr(course_catalog, "_catalog", None)
+    monkeypatch.setattr(course_catalog, "load_course_catalog", lambda *a: (_ for _ in ()).throw(AssertionError("loaded")))
+    assert hybrid_search.lexical_search("プログラミング") == []
+    assert hybrid_search.confident_lexical_ids("プログラミング") == []
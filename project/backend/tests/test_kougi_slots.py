@@ -0,0 +1,39 @@
+from kougi_slots import parse_jigen, slot_rows
+
+
+def test_campus_from_brackets_and_semester_from_parentheses():
+    assert parse_jigen("[青山]金２（後期）") == [
+        {"label": "金２", "day": "金", "period": 2, "campus": "青山", "semester": "後期"},
+    ]
+    assert parse_jigen("[相模原]木３（後期）") == [
+        {"label": "木３", "day": "木", "period": 3, "campus": "相模原", "semester": "後期"},
+    ]
+
+
+def test_multiple_slots_share_campus():
+    slots = parse_jigen("[相模原]月１（前期）月２（前期）")
+    assert [(s["label"], s["campus"], s["semester"]) for s in slots] == [
+        ("月１", "相模原", "前期"),
+        ("月２", "相模原", "前期"),
+    ]
+
+
+def test_campus_changes_between_slots():
+    slots = parse_jigen("[青山]月１（前期）[相模原]火２（前期）")
+    assert [(s["label"], s["campus"]) for s in slots] == [("月１", "青山"), ("火２", "相模原")]
+
+
+def test_longest_semester_wins():
+    assert parse_jigen("[青山]金５（前期集中）")[0]["semester"] == "前期集中"
+
+
+def test_non_day_period_slot():
+    assert parse_jigen("[青山]不定（集中）") == [
+        {"label": "不定", "day": None, "period": None, "campus": "青山", "semester": "集中"},
+    ]
+
+
+def test_empty_and_rows():
+    assert parse_jigen("") == []
+    assert parse_jigen(None) == []
+    assert slot_rows(7, "[青山]金２（後期）") == [(7, "金２", "金", 2, "青山", "後期")]
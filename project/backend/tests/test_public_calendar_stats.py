@@ -0,0 +1,51 @@
+import pytest
+import public_calendar_stats
+
+
+class LockOnlyRedis:
+    """SET NX EX だけを真似る（期限は expire() で切らせる）"""
+
+    def __init__(self):
+        self.values = {}
+        self.ttls = {}
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        self.ttls[key] = ex
+        return True
+
+    def expire_now(self, key):
+        self.values.pop(key, None)
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = LockOnlyRedis()
+    monkeypatch.setattr(public_calendar_stats, "redis_sync_client", client)
+    return client
+
+
+@pytest.fixture
+def rebuilds(monkeypatch):
+    calls = []
+    monkeypatch.setattr(public_calendar_stats, "rebuild_public_calendar_stats", lambda: calls.append(1) or (0, {}))
+    return calls
+
+
+def test_only_one_worker_reconciles_per_interval(redis_client, rebuilds):
+    # 同じ間隔の中で各ワーカーが呼んでも、数え直すのは最初の1回だけ
+    results = [public_calendar_stats.reconcile_public_calendar_stats(interval=600) for _ in range(3)]
+
+    assert results == [(0, {}), None, None]
+    assert rebuilds == [1]
+    assert redis_client.ttls[public_calendar_stats.STATS_RECONCILE_LOCK_KEY] == 600
+
+
+def test_reconciles_again_after_the_lock_expires(redis_client, rebuilds):
+    public_calendar_stats.reconcile_public_calendar_stats(interval=600)
+    redis_client.expire_now(public_calendar_stats.STATS_RECONCILE_LOCK_KEY)
+    public_calendar_stats.reconcile_public_calendar_stats(interval=600)
+
+    assert rebuilds == [1, 1]
@@ -0,0 +1,82 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+import crud
+from models import aoyama_kougi, kougi_slot, user_kougi
+
+CALENDAR_ID = 1
+
+# 講義ID → 時限
+KOUGI = {
+    1: "[青山]月１（前期）",
+    2: "[青山]月１（前期）",            # 1 と同じコマ
+    3: "[青山]火２（前期）火３（前期）",
+    4: "[青山]火３（前期）",            # 3 の2コマ目と重なる
+    5: "[青山]不定（前期）",            # 曜日・時限で表せないコマは重複判定しない
+    6: "[青山]不定（前期）",
+    7: "[相模原]水４（後期）",          # kougi_slot がまだない講義
+    8: "",                              # 時限なし
+}
+
+
+@pytest.fixture
+def db(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    tables = [aoyama_kougi.__table__, kougi_slot.__table__, user_kougi.__table__]
+    aoyama_kougi.metadata.create_all(engine, tables=tables)
+    session = sessionmaker(bind=engine)()
+    for kougi_id, jigen in KOUGI.items():
+        session.add(aoyama_kougi(id=kougi_id, 時限=jigen))
+        if kougi_id != 7:
+            for slot in crud.parse_jigen(jigen):
+                session.add(kougi_slot(kougi_id=kougi_id, **slot))
+    session.commit()
+
+    bumped = []
+    monkeypatch.setattr(crud, "bump_calendar_version", bumped.append)
+    session.bumped = bumped
+    yield session
+    session.close()
+
+
+def registered_rows(db):
+    return sorted(db.query(user_kougi.kougi_id, user_kougi.period).filter(user_kougi.calendar_id == CALENDAR_ID))
+
+
+def test_conflicts_within_the_same_batch(db):
+    result = crud.register_user_kougi_batch(db, [1, 2, 3, 4, 5, 6], CALENDAR_ID)
+
+    assert result["registered"] == [1, 3, 5, 6]
+    assert result["conflicts"] == [(2, [1]), (4, [3])]
+    assert result["errors"] == []
+    assert registered_rows(db) == [(1, "月１"), (3, "火２"), (3, "火３"), (5, "不定"), (6, "不定")]
+    assert db.bumped == [CALENDAR_ID]
+
+
+def test_conflicts_with_already_registered_kougi(db):
+    crud.register_user_kougi_batch(db, [1], CALENDAR_ID)
+
+    result = crud.register_user_kougi_batch(db, [2, 1, 5, 5], CALENDAR_ID)
+
+    # 登録済みの講義はその講義自身と重複しているとして扱う（同じバッチで2回目に出てきた講義も同じ）
+    assert result["registered"] == [5]
+    assert result["conflicts"] == [(2, [1]), (1, [1]), (5, [5])]
+
+
+def test_falls_back_to_jigen_and_reports_missing_kougi(db):
+    result = crud.register_user_kougi_batch(db, [7, 8, 99], CALENDAR_ID)
+
+    assert result["registered"] == [7]
+    assert [error["kougi_id"] for error in result["errors"]] == [8, 99]
+    assert registered_rows(db) == [(7, "水４")]
+
+
+def test_nothing_to_register_does_not_write(db):
+    crud.register_user_kougi_batch(db, [1], CALENDAR_ID)
+    db.bumped.clear()
+
+    result = crud.register_user_kougi_batch(db, [1, 99], CALENDAR_ID)
+
+    assert result["registered"] == []
+    assert db.bumped == []
@@ -0,0 +1,62 @@
+import numpy as np
+from text_index import TextIndex, normalize_text
+
+IDS = [3, 7, 10, 12, 20]
+FIELDS = {
+    "科目": ["プログラミング演習Ⅰ", "ﾌﾟﾛｸﾞﾗﾐﾝｸﾞ基礎", "統計学入門", "English Reading", "バス経営論"],
+    "教員": ["山田 太郎", "やまだ はなこ", "佐藤 一郎", "SMITH John", "鈴木 次郎"],
+}
+
+
+def make_index():
+    return TextIndex(IDS, FIELDS)
+
+
+def like(field, query):
+    """LIKE '%query%' を正規化後の文字列で素直に判定した結果"""
+    needle = normalize_text(query)
+    return [kougi_id for kougi_id, text in zip(IDS, FIELDS[field]) if needle in normalize_text(text)]
+
+
+def test_normalize_text_folds_width_case_kana_and_spaces():
+    assert normalize_text("ﾌﾟﾛｸﾞﾗﾐﾝｸﾞ") == normalize_text("プログラミング") == normalize_text("ぷろぐらみんぐ")
+    assert normalize_text("ＥＮＧＬＩＳＨ") == "english"
+    assert normalize_text(" 山田　太郎 ") == "山田太郎"
+    assert normalize_text(None) == ""
+
+
+def test_normalize_text_keeps_dakuten_and_small_kana():
+    assert normalize_text("ハス") != normalize_text("バス")
+    assert normalize_text("ヤ") != normalize_text("ャ")
+
+
+def test_contains_matches_substring_like():
+    index = make_index()
+    queries = ["プ", "プロ", "ぷろぐら", "ﾌﾟﾛｸﾞﾗﾐﾝｸﾞ演習", "統計", "english", "ng", "g", "入門編", "経営", "ハス"]
+    for query in queries:
+        assert index.contains("科目", query).tolist() == like("科目", query), query
+    for query in ["山田", "やまだ", "ヤマダ", "田太", "smith", "次郎", "郎"]:
+        assert index.contains("教員", query).tolist() == like("教員", query), query
+
+
+def test_contains_empty_query_returns_all():
+    assert make_index().contains("科目", " ").tolist() == IDS
+
+
+def test_search_ranks_and_respects_id_mask():
+    index = make_index()
+    hits = index.search("プログラミング", fields=("科目",))
+    assert [kougi_id for kougi_id, _ in hits][:2] == [3, 7]
+
+    id_mask = np.zeros(21, dtype=bool)
+    id_mask[7] = True
+    assert [kougi_id for kougi_id, _ in index.search("プログラミング", fields=("科目",), id_mask=id_mask)] == [7]
+
+    # 索引より小さいビットマップでも、範囲外の講義は対象外になるだけ
+    assert index.search("バス", fields=("科目",), id_mask=np.ones(5, dtype=bool)) == []
+
+
+def test_rank_keeps_order_for_ties_and_unknown_ids():
+    index = make_index()
+    assert index.rank([12, 99, 10, 3], {"科目": "統計"}) == [10, 12, 99, 3]
+    assert index.rank([12, 99, 10], {"科目": ""}) == [12, 99, 10]
@@ -0,0 +1,91 @@
+import faiss
+import numpy as np
+import pytest
+import vector_search
+from vector_search import VectorSearchEngine, create_index, set_search_params
+
+DIM = 16
+N = 300
+# 講義IDは連続しない（行番号と講義IDがずれていることを確かめる）
+IDS = np.arange(N, dtype=np.int64) * 3 + 1000
+
+
+def make_engine(index_type, metric="l2"):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((N, DIM)).astype(np.float32)
+    if metric == "ip":
+        faiss.normalize_L2(vectors)
+    index = create_index(index_type, DIM, metric=metric, nlist=8, hnsw_m=16)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add_with_ids(vectors, IDS)
+    # 小さいデータなので全クラスタ・十分な探索幅で調べ、近似でも厳密な結果と一致させる
+    set_search_params(index, nprobe=8, ef_search=N)
+    return VectorSearchEngine.from_index(index), vectors
+
+
+def brute_force(vectors, query, allowed_rows, k, metric):
+    candidates = np.asarray(sorted(allowed_rows))
+    if metric == "ip":
+        q = query[0] / np.linalg.norm(query[0])
+        distances = -(vectors[candidates] @ q)
+    else:
+        distances = ((vectors[candidates] - query[0]) ** 2).sum(axis=1)
+    return IDS[candidates[np.argsort(distances)[:k]]].tolist()
+
+
+def id_mask_for(rows, size=None):
+    mask = np.zeros(size or int(IDS.max()) + 1, dtype=bool)
+    mask[IDS[rows]] = True
+    return mask
+
+
+@pytest.mark.parametrize("metric", ["l2", "ip"])
+@pytest.mark.parametrize("index_type", ["flat", "ivf", "hnsw"])
+@pytest.mark.parametrize("exact_max_rows", [10_000, 0])
+def test_filtered_search_matches_brute_force(monkeypatch, index_type, metric, exact_max_rows):
+    # exact_max_rows=10000 なら NumPy の厳密検索、0 なら IDSelectorBitmap の経路を通る
+    monkeypatch.setattr(vector_search, "EXACT_SEARCH_MAX_ROWS", exact_max_rows)
+    engine, vectors = make_engine(index_type, metric)
+    query = np.random.default_rng(1).standard_normal((1, DIM)).astype(np.float32)
+    rows = list(range(0, N, 7))
+
+    ids, distances = engine.search_with_distances(query, k=5, id_mask=id_mask_for(rows))
+
+    assert ids == brute_force(vectors, query, rows, 5, metric)
+    assert distances == sorted(distances)
+
+
+def test_small_selection_uses_exact_search_and_large_uses_bitmap(monkeypatch):
+    monkeypatch.setattr(vector_search, "EXACT_SEARCH_MAX_ROWS", 50)
+    engine, _ = make_engine("flat")
+    calls = []
+    monkeypatch.setattr(engine, "_exact_search", lambda *a: calls.append("exact") or ([], []))
+    monkeypatch.setattr(engine, "_bitmap_search", lambda *a: calls.append("bitmap") or ([], []))
+    query = np.zeros((1, DIM), dtype=np.float32)
+
+    engine.search(query, id_mask=id_mask_for(list(range(50))))
+    engine.search(query, id_mask=id_mask_for(list(range(51))))
+
+    assert calls == ["exact", "bitmap"]
+
+
+def test_id_mask_maps_to_index_rows():
+    engine, _ = make_engine("flat")
+    # ビットマップが一部の講義IDまでしか届かなくても、届かない講義は対象外になるだけ
+    short_mask = id_mask_for([0, 1, 2], size=int(IDS[5]))
+    assert engine._row_mask(short_mask).nonzero()[0].tolist() == [0, 1, 2]
+
+    query = np.zeros((1, DIM), dtype=np.float32)
+    assert sorted(engine.search(query, k=10, id_mask=short_mask)) == IDS[:3].tolist()
+    assert engine.search(query, id_mask=np.zeros(10, dtype=bool)) == []
+
+
+def test_legacy_index_maps_row_to_id_plus_one():
+    index = faiss.IndexFlatL2(DIM)
+    index.add(np.eye(DIM, dtype=np.float32))
+    engine = VectorSearchEngine.from_index(index)
+
+    query = np.eye(DIM, dtype=np.float32)[[4]]
+    assert engine.search(query, k=1) == [5]
+    assert engine.search(query, k=1, id_mask=id_mask_for([], size=DIM + 1)) == []
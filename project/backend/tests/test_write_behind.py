@@ -0,0 +1,65 @@
+import threading
+from models import chat_log
+from write_behind import WriteBehindWriter
+
+
+class RecordingWriter(WriteBehindWriter):
+    """DB に書き込む代わりに、書き込んだバッチを覚えておく"""
+
+    def __init__(self, **kwargs):
+        super().__init__(chat_log.__table__, **kwargs)
+        self.batches = []
+        self.written_event = threading.Event()
+
+    def _write(self, rows):
+        self.batches.append(list(rows))
+        self.counters["written"] += len(rows)
+        self.written_event.set()
+
+
+def written(writer):
+    return [row for batch in writer.batches for row in batch]
+
+
+def test_put_writes_inline_before_start():
+    writer = RecordingWriter()
+    assert writer.put({"n": 1})
+    assert writer.batches == [[{"n": 1}]]
+
+
+def test_put_drops_when_queue_is_full():
+    writer = RecordingWriter(maxsize=2, flush_interval=60)
+    writer.inline = False
+    # 書き込みスレッドが取り出さないよう、動いているように見せかける
+    writer._thread = threading.current_thread()
+
+    assert [writer.put({"n": n}) for n in range(4)] == [True, True, False, False]
+    assert writer.counters["enqueued"] == 2
+    assert writer.counters["dropped"] == 2
+    assert writer.stats()["queued"] == 2
+
+
+def test_stop_flushes_queued_rows_in_batches():
+    writer = RecordingWriter(batch_size=3, flush_interval=60)
+    writer.start()
+    # 最初の1件を取り出してスレッドが待ちに入るまで待つ
+    writer.put({"n": 0})
+    assert writer.written_event.wait(5)
+    for n in range(1, 8):
+        writer.put({"n": n})
+    writer.stop()
+
+    assert written(writer) == [{"n": n} for n in range(8)]
+    assert all(len(batch) <= 3 for batch in writer.batches)
+    assert writer.stats()["queued"] == 0
+    assert not writer.running
+
+
+def test_put_after_stop_is_dropped_not_written_inline():
+    writer = RecordingWriter(flush_interval=0.01)
+    writer.start()
+    writer.stop()
+
+    assert writer.put({"n": 1}) is False
+    assert writer.counters["dropped"] == 1
+    assert writer.batches == []
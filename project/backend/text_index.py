@@ -0,0 +1,154 @@
+"""
+講義名・教員名・メッセージ・講義要約（audi_text）の全文検索用の n-gram 転置索引（メモリ上）。
+
+文字列は normalize_text で正規化してから 1文字（unigram）と 2文字（bigram）に分けて索引にする。
+正規化で全角・半角（NFKC）、英字の大文字・小文字、カタカナ・ひらがなの違いと空白を無視するので、
+「ﾌﾟﾛｸﾞﾗﾐﾝｸﾞ」「ぷろぐらみんぐ」でも「プログラミング」に一致する。
+MySQL の utf8mb4_unicode_ci の LIKE とは少し違い、濁点・半濁点や小書きの仮名（「ハ」と「バ」、「ヤ」と「ャ」）は区別し、
+空白は無視する。
+"""
+import math
+import unicodedata
+from collections import defaultdict
+import numpy as np
+
+# 検索対象の列と、順位づけのときの重み
+TEXT_FIELDS = {"科目": 3.0, "教員": 2.0, "メッセージ": 1.0, "audi_text": 1.0}
+
+# カタカナ（ァ～ヶ）をひらがなに寄せる変換表
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord("ァ"), ord("ヶ") + 1)}
+
+_EMPTY_IDS = np.empty(0, dtype=np.int64)
+
+
+def normalize_text(text):
+    """全角・半角、大文字・小文字、カタカナ・ひらがなの違いと空白を無くした文字列にする"""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text).lower().translate(_KATAKANA_TO_HIRAGANA)
+    return "".join(text.split())
+
+
+def _grams(text):
+    """索引に使う n-gram（1文字なら unigram、2文字以上なら bigram）"""
+    if len(text) < 2:
+        return [text] if text else []
+    return list(dict.fromkeys(text[i:i+2] for i in range(len(text) - 1)))
+
+
+class TextIndex:
+    """
+    列ごとの n-gram 転置索引。
+
+    - contains(field, query): LIKE '%…%' と同じ部分一致（正規化後の文字列で判定）
+    - search(query): 全列を対象にした順位つき検索
+    - rank(ids, queries): 与えた講義IDを列ごとのクエリとの関連度順に並べ替える
+
+    どれも、クエリの n-gram の転置リストの長さに比例する時間で済み、講義の件数全体は走査しない
+    （3文字以上の部分一致だけは、転置リストの積集合で残った候補を実際の文字列で確かめる）。
+    """
+
+    def __init__(self, ids, fields, weights=None):
+        """fields は {列名: 文字列のリスト}。リストは ids と同じ順に並べる"""
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.weights = weights or TEXT_FIELDS
+        size = int(self.ids.max()) + 1 if self.ids.size else 1
+        # 講義ID → 行番号（索引にない講義は -1）
+        self.row_of = np.full(size, -1, dtype=np.int64)
+        self.row_of[self.ids] = np.arange(len(self.ids))
+
+        self.texts = {}
+        self.postings = {}
+        for field, texts in fields.items():
+            normalized = [normalize_text(text) for text in texts]
+            postings = defaultdict(list)
+            for row, text in enumerate(normalized):
+                for gram in set(text) | {text[i:i+2] for i in range(len(text) - 1)}:
+                    postings[gram].append(row)
+            self.texts[field] = normalized
+            self.postings[field] = {gram: np.asarray(rows, dtype=np.int32) for gram, rows in postings.items()}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _idf(self, field, gram):
+        df = len(self.postings[field].get(gram, ()))
+        return math.log((len(self.ids) + 1) / (df + 1)) + 1.0
+
+    def _matching_rows(self, field, text):
+        """正規化済みの text を部分文字列として含む行番号"""
+        postings = self.postings[field]
+        grams = sorted(_grams(text), key=lambda g: len(postings.get(g, ())))
+        rows = postings.get(grams[0])
+        if rows is None:
+            return rows
+        for gram in grams[1:]:
+            rows = np.intersect1d(rows, postings.get(gram, rows[:0]), assume_unique=True)
+            if not rows.size:
+                return rows
+        if len(text) > 2:
+            texts = self.texts[field]
+            rows = np.asarray([row for row in rows if text in texts[row]], dtype=np.int32)
+        return rows
+
+    def contains(self, field, query):
+        """field 列に query を部分文字列として含む講義IDを返す（空のクエリは全件）"""
+        text = normalize_text(query)
+        if not text:
+            return self.ids
+        rows = self._matching_rows(field, text)
+        if rows is None or not rows.size:
+            return _EMPTY_IDS
+        return self.ids[rows]
+
+    def scores(self, queries):
+        """
+        全行の関連度（行番号順の配列）を返す。queries は {列名: クエリ}。
+        クエリを空白で区切った語ごとに、列の重み ×（一致した n-gram の idf の割合 ＋ 語全体を含めば 1）を足し合わせる。
+        """
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for field, query in queries.items():
+            postings = self.postings[field]
+            weight = self.weights.get(field, 1.0)
+            for term in filter(None, (normalize_text(term) for term in (query or "").split())):
+                grams = _grams(term)
+                idfs = [self._idf(field, gram) for gram in grams]
+                total = sum(idfs)
+                for gram, idf in zip(grams, idfs):
+                    rows = postings.get(gram)
+                    if rows is not None:
+                        scores[rows] += weight * idf / total
+
+                # 語全体を部分文字列として含む行はさらに加点する
+                rows = self._matching_rows(field, term)
+                if rows is not None and rows.size:
+                    scores[rows] += weight
+        return scores
+
+    def search(self, query, k=None, fields=None, id_mask=None):
+        """
+        query に関連する講義を関連度の高い順に (講義ID, スコア) のリストで返す（既定は全列が対象）。
+        id_mask（講義IDを添字とする bool 配列）を渡すと、その講義だけを対象にする。
+        """
+        scores = self.scores({field: query for field in fields or self.weights})
+        rows = np.flatnonzero(scores > 0)
+        if id_mask is not None:
+            ids = self.ids[rows]
+            inside = ids < len(id_mask)
+            rows = rows[inside][id_mask[ids[inside]]]
+        order = rows[np.argsort(-scores[rows], kind="stable")]
+        if k is not None:
+            order = order[:k]
+        return [(int(self.ids[row]), float(scores[row])) for row in order]
+
+    def rank(self, id_list, queries):
+        """id_list を queries（{列名: クエリ}）との関連度の高い順に並べ替える（同じ関連度なら元の順）"""
+        ids = np.asarray(id_list, dtype=np.int64)
+        if not ids.size or not any(normalize_text(query) for query in queries.values()):
+            return list(id_list)
+        scores = self.scores(queries)
+        inside = ids < len(self.row_of)
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        rows[inside] = self.row_of[ids[inside]]
+        id_scores = np.where(rows >= 0, scores[rows], 0.0)
+        return ids[np.argsort(-id_scores, kind="stable")].tolist()
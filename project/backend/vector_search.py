@@ -0,0 +1,237 @@
+import os
+import faiss
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 絞り込み後の件数がこれ以下なら、該当行だけを取り出してNumPyで厳密に距離計算する
+EXACT_SEARCH_MAX_ROWS = int(os.getenv("EXACT_SEARCH_MAX_ROWS", "2000"))
+
+# faiss_create_db.py で選べるインデックスの種類
+INDEX_TYPES = ["flat", "ivf", "hnsw", "ivfpq"]
+# 距離の種類。ip は正規化したベクトルの内積（＝コサイン類似度）
+METRICS = {"l2": faiss.METRIC_L2, "ip": faiss.METRIC_INNER_PRODUCT}
+
+
+def default_nlist(ntotal):
+    # IVFのクラスタ数の目安（件数の平方根の4倍程度）
+    return max(1, int(4 * np.sqrt(max(ntotal, 1))))
+
+
+def create_index(index_type, dim, metric="l2", nlist=None, ntotal=0,
+                 hnsw_m=32, ef_construction=40, pq_m=64, pq_nbits=8):
+    """
+    講義IDつき（IndexIDMap2）の空インデックスを作る。ivf / ivfpq は追加前に train が必要。
+
+    Args:
+        index_type (str): flat / ivf / hnsw / ivfpq のいずれか。
+        metric (str): l2 / ip。ip の場合はベクトルを正規化してから追加すること。
+        nlist (int | None): IVFのクラスタ数。None なら ntotal から決める。
+        hnsw_m (int): HNSWの各ノードのリンク数。
+        ef_construction (int): HNSW構築時の探索幅。
+        pq_m (int): PQの分割数（dim を割り切れる値）。
+        pq_nbits (int): PQの各コードのビット数。
+    """
+    faiss_metric = METRICS[metric]
+    if index_type == "flat":
+        inner = faiss.IndexFlat(dim, faiss_metric)
+    elif index_type == "ivf":
+        quantizer = faiss.IndexFlat(dim, faiss_metric)
+        inner = faiss.IndexIVFFlat(quantizer, dim, nlist or default_nlist(ntotal), faiss_metric)
+    elif index_type == "ivfpq":
+        quantizer = faiss.IndexFlat(dim, faiss_metric)
+        inner = faiss.IndexIVFPQ(quantizer, dim, nlist or default_nlist(ntotal), pq_m, pq_nbits, faiss_metric)
+    elif index_type == "hnsw":
+        inner = faiss.IndexHNSWFlat(dim, hnsw_m, faiss_metric)
+        inner.hnsw.efConstruction = ef_construction
+    else:
+        raise ValueError(f"未対応のインデックス種類です: {index_type}")
+
+    return faiss.IndexIDMap2(inner)
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """検索時のパラメータをインデックスに設定する（write_index で一緒に保存される）"""
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if nprobe and isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = nprobe
+    if ef_search and isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = ef_search
+
+
+class VectorSearchEngine:
+    """
+    FAISSインデックスに対する絞り込み付き検索。
+
+    絞り込み条件は講義IDを添字とする bool 配列（course_catalog のビットマップ）で受け取り、
+    インデックスの行番号の空間に写してから、件数に応じて次のどちらかで検索する。
+      - 少数: 該当行のベクトルだけを集めて NumPy で距離計算
+      - 多数: ビットマップを IDSelectorBitmap として FAISS に渡す
+    """
+
+    def __init__(self, index, ids, version=None, owner=None):
+        self.index = index
+        # 内側のインデックスは外側（IndexIDMap2）が解放されると一緒に消えるため参照を保持しておく
+        self._owner = owner
+        # 行番号 → 講義ID
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.ntotal = index.ntotal
+        self.dim = index.d
+        # ip の場合はクエリも正規化し、スコアが大きいほど近いとみなす
+        self.inner_product = index.metric_type == faiss.METRIC_INNER_PRODUCT
+        if isinstance(index, faiss.IndexIVF):
+            # 少数件の厳密検索で行番号からベクトルを復元できるようにする
+            index.make_direct_map()
+        # 読み込んだインデックスファイルの更新時刻（ホットスワップの判定用）
+        self.version = version
+        self.path = None
+        self.mmap = False
+
+    @classmethod
+    def from_index(cls, index, version=None):
+        """
+        IndexIDMap2 なら内側のインデックスと行番号 → 講義IDの対応表を取り出す。
+        ID対応のない旧形式のインデックスは、行番号 i が講義ID i+1 に対応するとみなす。
+        """
+        if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            ids = faiss.vector_to_array(index.id_map)
+            return cls(faiss.downcast_index(index.index), ids, version, owner=index)
+        return cls(index, np.arange(1, index.ntotal + 1, dtype=np.int64), version)
+
+    def _row_mask(self, id_mask):
+        row_mask = np.zeros(self.ntotal, dtype=bool)
+        valid = self.ids < id_mask.size
+        row_mask[valid] = id_mask[self.ids[valid]]
+        return row_mask
+
+    def _vectors(self, rows):
+        if isinstance(self.index, faiss.IndexFlat):
+            # Flatインデックスはベクトルをそのまま持っているので、コピーせずに参照する
+            xb = faiss.rev_swig_ptr(self.index.get_xb(), self.ntotal * self.dim)
+            return xb.reshape(self.ntotal, self.dim)[rows]
+        return self.index.reconstruct_batch(rows)
+
+    def _to_results(self, labels, distances):
+        """行番号と距離を (講義IDのリスト, 距離のリスト) にする（見つからなかった -1 は除く）"""
+        found = [i for i, label in enumerate(labels) if label >= 0]
+        return [int(self.ids[labels[i]]) for i in found], [float(distances[i]) for i in found]
+
+    def _prepare_query(self, query):
+        query = np.ascontiguousarray(query, dtype=np.float32)
+        if self.inner_product:
+            query = query.copy()
+            faiss.normalize_L2(query)
+        return query
+
+    def _exact_search(self, query, rows, k):
+        vectors = self._vectors(rows)
+        if self.inner_product:
+            # 内積が大きい順に並べるため、符号を反転して距離として扱う
+            distances = -(vectors @ query[0])
+        else:
+            # IndexFlatL2 と同じく二乗L2距離で並べる
+            distances = ((vectors - query[0]) ** 2).sum(axis=1)
+        k = min(k, rows.size)
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        return self._to_results(rows[top], distances[top])
+
+    def _search_params(self, sel):
+        # インデックスの種類に合ったパラメータを渡す（IVFのnprobe等は既定値に戻らないよう引き継ぐ）
+        if isinstance(self.index, faiss.IndexIVF):
+            return faiss.SearchParametersIVF(sel=sel, nprobe=self.index.nprobe)
+        if isinstance(self.index, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=sel, efSearch=self.index.hnsw.efSearch)
+        return faiss.SearchParameters(sel=sel)
+
+    def _bitmap_search(self, query, row_mask, k):
+        bitmap = np.packbits(row_mask, bitorder="little")
+        sel = faiss.IDSelectorBitmap(bitmap.size, faiss.swig_ptr(bitmap))
+        distances, labels = self.index.search(query, k, params=self._search_params(sel))
+        return self._index_results(distances, labels)
+
+    def _index_results(self, distances, labels):
+        # 内積のインデックスは類似度（大きいほど近い）を返すので、符号を反転して距離にそろえる
+        distances = -distances[0] if self.inner_product else distances[0]
+        return self._to_results(labels[0], distances)
+
+    def search_with_distances(self, query, k=9, id_mask=None):
+        """
+        search と同じ検索を行い、(講義IDのリスト, 距離のリスト) を返す。
+        距離は小さいほど近い（L2 は二乗L2距離、内積は類似度の符号を反転したもの）。
+        """
+        query = self._prepare_query(query)
+        if id_mask is None:
+            distances, labels = self.index.search(query, k)
+            return self._index_results(distances, labels)
+
+        row_mask = self._row_mask(id_mask)
+        rows = np.flatnonzero(row_mask)
+        if rows.size == 0:
+            return [], []
+        if rows.size <= EXACT_SEARCH_MAX_ROWS:
+            return self._exact_search(query, rows, k)
+        return self._bitmap_search(query, row_mask, k)
+
+    def search(self, query, k=9, id_mask=None):
+        """
+        Args:
+            query (np.ndarray): shape (1, dim) の float32 クエリベクトル。
+            k (int): 取得件数。
+            id_mask (np.ndarray | None): 講義IDのビットマップ。None なら全件から検索。
+
+        Returns:
+            list[int]: 距離の近い順の講義ID。
+        """
+        return self.search_with_distances(query, k=k, id_mask=id_mask)[0]
+
+    def similarities(self, distances):
+        """
+        距離をコサイン類似度に直す（OpenAI の埋め込みは単位長なので、二乗L2距離 d は 1 - d/2 になる）。
+        L2 と内積のどちらのインデックスでも、同じ尺度で確信度を比べるために使う。
+        """
+        distances = np.asarray(distances, dtype=np.float32)
+        if self.inner_product:
+            return -distances
+        return 1.0 - distances / 2.0
+
+
+class SearchIndexNotReady(Exception):
+    """FAISSインデックスがまだ読み込まれていない（起動直後・ファイルなし）"""
+
+
+def read_index_file(path, mmap=False):
+    """
+    インデックスファイルを読み込む。
+    mmap=True なら IO_FLAG_MMAP でページキャッシュを参照し、同じマシンの複数ワーカーでメモリを共有する。
+    mmap 非対応の形式・バージョンなら通常の読み込みに切り替える。
+    """
+    if mmap:
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY), True
+        except RuntimeError as e:
+            print(f"⚠️ mmapで読み込めないため通常の読み込みに切り替えます: {e}")
+    return faiss.read_index(path), False
+
+
+def load_search_engine(path, mmap=False):
+    """インデックスファイルを読み込んで検索エンジンを作る"""
+    version = os.path.getmtime(path)
+    index, mmapped = read_index_file(path, mmap)
+    engine = VectorSearchEngine.from_index(index, version)
+    engine.path = path
+    engine.mmap = mmapped
+    return engine
+
+
+def describe_engine(engine):
+    """readiness 用にインデックスの概要を返す"""
+    return {
+        "type": type(engine.index).__name__,
+        "ntotal": engine.ntotal,
+        "dim": engine.dim,
+        "version": engine.version,
+        "path": engine.path,
+        "mmap": engine.mmap,
+    }
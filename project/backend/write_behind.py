@@ -0,0 +1,160 @@
+"""
+急がない書き込み（chat_log などのログ）を、リクエストの外でまとめて INSERT する仕組み。
+
+put() はキューに積むだけなのでリクエストの処理時間に影響しない。
+専用のスレッドがキューから取り出し、WRITE_BEHIND_BATCH_SIZE 件ごと（または
+WRITE_BEHIND_FLUSH_INTERVAL 秒ごと）に1回の executemany で書き込む。
+キューが一杯のときは待たずに捨てて dropped を数える（ログのためにAPIを遅くしない）。
+start() を呼ばないスクリプトから使うときは put() がその場で書き込む。アプリ（start() 後）では
+書き込みスレッドが止まっていても put() でDBを待たず、捨てて dropped を数える。
+"""
+import os
+import queue
+import threading
+from dotenv import load_dotenv
+from database import SessionLocal
+from models import chat_log
+
+load_dotenv()
+
+# キューに溜められる件数の上限。これを超えた分は捨てる
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", "10000"))
+# 1回の INSERT でまとめて書き込む件数
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "200"))
+# 件数が溜まらなくても、この間隔（秒）で書き込む
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "1.0"))
+
+
+class WriteBehindWriter:
+    """
+    1つのテーブルへの書き込みキュー。行は {列名: 値} の dict で渡す。
+    start() で書き込みスレッドを起動し、stop() でキューに残った行を書き切ってから止める。
+    inline が True（start() を呼ぶまで）のあいだは、put() がその場で書き込む。
+    """
+
+    def __init__(self, table, maxsize=WRITE_BEHIND_QUEUE_SIZE, batch_size=WRITE_BEHIND_BATCH_SIZE,
+                 flush_interval=WRITE_BEHIND_FLUSH_INTERVAL):
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stopping = threading.Event()
+        self._thread = None
+        # start() を呼ばないスクリプトからの put() はその場で書き込む
+        self.inline = True
+        self.counters = {
+            "enqueued": 0,
+            "written": 0,
+            "dropped": 0,
+            "failed": 0,
+            "batches": 0,
+        }
+
+    def put(self, row):
+        """行をキューに積む。キューが一杯か、アプリで書き込みスレッドが止まっていれば捨てて False を返す"""
+        if not self.inline and not self.running:
+            # アプリ（イベントループ）からの呼び出しでは、止まった後にその場で INSERT して待たせない
+            self.counters["dropped"] += 1
+            return False
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.counters["dropped"] += 1
+            return False
+        self.counters["enqueued"] += 1
+        # スクリプトから使う（start() を呼んでいない）ときはその場で書き込む
+        if self.inline:
+            self.flush()
+        return True
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        # 以降はスレッドが止まっても put() でその場で書き込まない
+        self.inline = False
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=f"write-behind-{self.table.name}", daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """書き込みスレッドを止める。キューに残っている行は書き込んでから終わる"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def _take_batch(self, timeout):
+        """キューから最大 batch_size 件を取り出す。最初の1件は timeout 秒まで待つ"""
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._take_batch(self.flush_interval)
+            if batch:
+                self._write(batch)
+
+    def flush(self):
+        """キューに残っている行をすべて書き込む"""
+        while True:
+            batch = self._take_batch(0)
+            if not batch:
+                return
+            self._write(batch)
+
+    def _write(self, rows):
+        db = SessionLocal()
+        try:
+            db.execute(self.table.insert(), rows)
+            db.commit()
+            self.counters["written"] += len(rows)
+            self.counters["batches"] += 1
+        except Exception as e:
+            db.rollback()
+            self.counters["failed"] += len(rows)
+            print(f"❌ {self.table.name} への書き込みに失敗しました（{len(rows)}件）: {e}")
+        finally:
+            db.close()
+
+    def stats(self):
+        return {
+            **self.counters,
+            "queued": self._queue.qsize(),
+            "running": self.running,
+        }
+
+
+# chat_log の書き込みキュー
+chat_log_writer = WriteBehindWriter(chat_log.__table__)
+
+# 起動・停止・統計をまとめて扱うための一覧（分析用のイベントなどを増やすときはここに足す）
+WRITERS = {"chat_log": chat_log_writer}
+
+
+def start_writers():
+    for writer in WRITERS.values():
+        writer.start()
+
+
+def stop_writers():
+    for writer in WRITERS.values():
+        writer.stop()
+
+
+def writer_stats():
+    return {name: writer.stats() for name, writer in WRITERS.items()}
@@ -12,19 +12,38 @@ import axios from "axios";
 
 export default function PublicScheduleList() {
   const [calendars, setCalendars] = useState([]);
+  // 続きのページの cursor（最後のページなら null）
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const navigate = useNavigate();
 
-  // ページ読み込み時にデータ取得
-  useEffect(() => {
-    axios
-      .get("http://localhost:8000/calendar/public")
+  // 1ページ分を取得する（cursor を渡すと続きを取得して後ろに足す）
+  const fetchCalendars = (cursor = null) => {
+    return axios
+      .get("http://localhost:8000/calendar/public", {
+        params: cursor ? { cursor } : {},
+      })
       .then((res) => {
         console.log(res.data);
-        setCalendars(res.data.public_calendars);
+        setCalendars((prev) =>
+          cursor ? [...prev, ...res.data.public_calendars] : res.data.public_calendars
+        );
+        setNextCursor(res.data.next_cursor);
       })
       .catch((err) => console.error("Error fetching calendars:", err));
+  };
+
+  // ページ読み込み時にデータ取得
+  useEffect(() => {
+    fetchCalendars();
   }, []);
 
+  // 「もっと見る」で続きを取得
+  const handleLoadMore = () => {
+    setLoadingMore(true);
+    fetchCalendars(nextCursor).finally(() => setLoadingMore(false));
+  };
+
   return (
     <Box sx={{ p: 4 }}>
       <Typography variant="h4" align="center" gutterBottom>
@@ -79,6 +98,19 @@ export default function PublicScheduleList() {
         </Grid>
       )}
 
+      {nextCursor && (
+        <Box textAlign="center" mt={4}>
+          <Button
+            variant="outlined"
+            color="primary"
+            onClick={handleLoadMore}
+            disabled={loadingMore}
+          >
+            {loadingMore ? "読み込み中..." : "もっと見る"}
+          </Button>
+        </Box>
+      )}
+
       <Box textAlign="center" mt={4}>
         <Button
           variant="contained"
@@ -25,6 +25,10 @@ export default function PublicScheduleSearch() {
   const [calendars, setCalendars] = useState([]);
   const [loading, setLoading] = useState(false);
   const [searched, setSearched] = useState(false);
+  // 続きのページの cursor（最後のページなら null）と、そのときの検索条件
+  const [nextCursor, setNextCursor] = useState(null);
+  const [lastQuery, setLastQuery] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   
   // 統計情報
   const [stats, setStats] = useState(null);
@@ -51,37 +55,65 @@ export default function PublicScheduleSearch() {
     }
   };
 
+  // 検索APIを呼ぶ（結果は新しい順に1ページ分。続きは next_cursor を cursor に渡す）
+  const fetchPage = async (query, cursor = null) => {
+    const params = cursor ? `?cursor=${cursor}` : "";
+    const res = await fetch(`${apiUrl}/calendar/public/search${params}`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify(query),
+    });
+    if (!res.ok) {
+      throw new Error(`HTTP error! status: ${res.status}`);
+    }
+    return res.json();
+  };
+
   // 検索実行
   const handleSearch = async () => {
     setLoading(true);
     setSearched(true);
+
+    const query = {
+      department: department || null,
+      campus: campus || null,
+      semester: semester || null,
+      keyword: keyword || null,
+    };
     
     try {
-      const res = await fetch(`${apiUrl}/calendar/public/search`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          department: department || null,
-          campus: campus || null,
-          semester: semester || null,
-          keyword: keyword || null,
-        }),
-      });
-      
-      const data = await res.json();
+      const data = await fetchPage(query);
       setCalendars(data.calendars || []); // デフォルト値を設定
+      setNextCursor(data.next_cursor || null);
+      setLastQuery(query);
       console.log("検索結果:", data);
     } catch (err) {
       console.error("検索エラー:", err);
       setCalendars([]); // エラー時は空配列を設定
+      setNextCursor(null);
       alert("検索に失敗しました。");
     } finally {
       setLoading(false);
     }
   };
 
+  // 「もっと見る」で同じ条件の続きを取得
+  const handleLoadMore = async () => {
+    setLoadingMore(true);
+    try {
+      const data = await fetchPage(lastQuery, nextCursor);
+      setCalendars((prev) => [...prev, ...(data.calendars || [])]);
+      setNextCursor(data.next_cursor || null);
+    } catch (err) {
+      console.error("検索エラー:", err);
+      alert("続きの取得に失敗しました。");
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   // 検索条件クリア
   const handleClear = () => {
     setDepartment("");
@@ -89,6 +121,7 @@ export default function PublicScheduleSearch() {
     setSemester("");
     setKeyword("");
     setSearched(false);
+    setNextCursor(null);
   };
 
 // カレンダー詳細へ遷移
@@ -424,7 +457,7 @@ export default function PublicScheduleSearch() {
       ) : searched ? (
         <>
           <div style={styles.resultsHeader}>
-            検索結果: {calendars?.length || 0}件
+            検索結果: {calendars?.length || 0}件{nextCursor && "以上"}
           </div>
 
           {!calendars || calendars.length === 0 ? (
@@ -470,6 +503,19 @@ export default function PublicScheduleSearch() {
               ))}
             </div>
           )}
+
+          {nextCursor && (
+            <div style={styles.centerButton}>
+              <button
+                className="button"
+                style={{...styles.button, ...styles.secondaryButton}}
+                onClick={handleLoadMore}
+                disabled={loadingMore}
+              >
+                {loadingMore ? "読み込み中..." : "もっと見る"}
+              </button>
+            </div>
+          )}
         </>
       ) : null}
 
@@ -21,6 +21,21 @@ CREATE TABLE IF NOT EXISTS aoyama_kougi (
     url TEXT
 );
 
+-- kougi_slotテーブル（aoyama_kougi.時限 を1コマ1行に分解したもの）
+CREATE TABLE IF NOT EXISTS kougi_slot (
+    id INT PRIMARY KEY AUTO_INCREMENT,
+    kougi_id INT NOT NULL,
+    label VARCHAR(50),
+    day VARCHAR(1),
+    period INT,
+    campus VARCHAR(50),
+    semester VARCHAR(50),
+    INDEX idx_kougi_slot_kougi_id (kougi_id),
+    INDEX idx_kougi_slot_day_period (day, period, kougi_id),
+    INDEX idx_kougi_slot_campus (campus, kougi_id),
+    INDEX idx_kougi_slot_semester (semester, kougi_id)
+);
+
 -- aoyama_kougi_detailテーブル
 CREATE TABLE IF NOT EXISTS aoyama_kougi_detail (
     aoyama_kougi_id INT PRIMARY KEY AUTO_INCREMENT,
@@ -42,7 +57,9 @@ CREATE TABLE IF NOT EXISTS chat_log (
 CREATE TABLE IF NOT EXISTS aoyama_openai_emb (
     aoyama_kougi_id INT PRIMARY KEY AUTO_INCREMENT,
     audi_text TEXT,
-    openai_emb JSON
+    openai_emb JSON,
+    openai_emb_bin BLOB,
+    openai_emb_dtype VARCHAR(4)
 );
 
 -- user_calendarテーブル
@@ -54,7 +71,9 @@ CREATE TABLE IF NOT EXISTS user_calendar (
     department JSON,
     semester JSON,
     sat_flag BOOLEAN DEFAULT TRUE,
-    sixth_period_flag BOOLEAN DEFAULT TRUE
+    sixth_period_flag BOOLEAN DEFAULT TRUE,
+    is_public BOOLEAN DEFAULT FALSE,
+    INDEX idx_user_calendar_public (is_public, id)
 );
 
 -- user_kougiテーブル